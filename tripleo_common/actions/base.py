@@ -12,10 +12,11 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-import json
-import zlib
+import functools
+import logging
 
 from glanceclient.v2 import client as glanceclient
+from heatclient import exc as heat_exc
 from heatclient.v1 import client as heatclient
 import ironic_inspector_client
 from ironicclient.v1 import client as ironicclient
@@ -26,6 +27,27 @@ from novaclient.client import Client as nova_client
 from swiftclient import client as swift_client
 from swiftclient import exceptions as swiftexceptions
 from tripleo_common import constants
+from tripleo_common.utils import cache as cache_utils
+from tripleo_common.utils import clients as clients_utils
+from tripleo_common.utils import plan as plan_utils
+
+LOG = logging.getLogger(__name__)
+
+# Service clients shared between the actions run by this process
+_clients = clients_utils.ClientRegistry(constants.CLIENT_REGISTRY_MAX_SIZE)
+
+# Endpoints found in the service catalog, shared by the client factories
+_endpoints = clients_utils.EndpointResolver(
+    lambda service: keystone_utils.get_endpoint_for_project(service),
+    constants.ENDPOINT_CACHE_TTL)
+
+# The build information of the Heat services, keyed by the endpoint URL
+# found in the service catalog
+_heat_build_info = cache_utils.LRUCache(16)
+
+# In-process tier of the plan cache, in front of the objects stored in
+# TRIPLEO_CACHE_CONTAINER. Entries are (plan generation, contents) tuples.
+_local_cache = cache_utils.LRUCache(constants.LOCAL_CACHE_MAX_SIZE)
 
 
 class TripleOAction(actions.Action):
@@ -34,7 +56,13 @@ class TripleOAction(actions.Action):
         super(TripleOAction, self).__init__()
 
     def get_object_client(self, context):
-        obj_ep = keystone_utils.get_endpoint_for_project('swift')
+        # swift connections can't be shared between threads, the client
+        # returned checks one out of a pool for every request
+        return _clients.get('swift', context, functools.partial(
+            self._create_object_client, context))
+
+    def _create_object_client(self, context):
+        obj_ep = _endpoints.get('swift', context)
 
         kwargs = {
             'preauthurl': obj_ep.url % {'tenant_id': context.project_id},
@@ -44,10 +72,18 @@ class TripleOAction(actions.Action):
             'max_backoff': 120
         }
 
-        return swift_client.Connection(**kwargs)
+        pool = clients_utils.ConnectionPool(
+            functools.partial(swift_client.Connection, **kwargs),
+            constants.CLIENT_POOL_MAX_IDLE)
+        return clients_utils.PooledClient(pool, url=kwargs['preauthurl'],
+                                          token=kwargs['preauthtoken'])
 
     def get_baremetal_client(self, context):
-        ironic_endpoint = keystone_utils.get_endpoint_for_project('ironic')
+        return _clients.get('ironic', context, functools.partial(
+            self._create_baremetal_client, context))
+
+    def _create_baremetal_client(self, context):
+        ironic_endpoint = _endpoints.get('ironic', context)
 
         # FIXME(lucasagomes): Use ironicclient.get_client() instead
         # of ironicclient.Client(). Client() might cause errors since
@@ -68,8 +104,11 @@ class TripleOAction(actions.Action):
         )
 
     def get_baremetal_introspection_client(self, context):
-        bmi_endpoint = keystone_utils.get_endpoint_for_project(
-            'ironic-inspector')
+        return _clients.get('ironic-inspector', context, functools.partial(
+            self._create_baremetal_introspection_client, context))
+
+    def _create_baremetal_introspection_client(self, context):
+        bmi_endpoint = _endpoints.get('ironic-inspector', context)
 
         return ironic_inspector_client.ClientV1(
             api_version='1.2',
@@ -79,7 +118,11 @@ class TripleOAction(actions.Action):
         )
 
     def get_image_client(self, context):
-        glance_endpoint = keystone_utils.get_endpoint_for_project('glance')
+        return _clients.get('glance', context, functools.partial(
+            self._create_image_client, context))
+
+    def _create_image_client(self, context):
+        glance_endpoint = _endpoints.get('glance', context)
         return glanceclient.Client(
             glance_endpoint.url,
             token=context.auth_token,
@@ -87,7 +130,11 @@ class TripleOAction(actions.Action):
         )
 
     def get_orchestration_client(self, context):
-        heat_endpoint = keystone_utils.get_endpoint_for_project('heat')
+        return _clients.get('heat', context, functools.partial(
+            self._create_orchestration_client, context))
+
+    def _create_orchestration_client(self, context):
+        heat_endpoint = _endpoints.get('heat', context)
 
         endpoint_url = keystone_utils.format_url(
             heat_endpoint.url,
@@ -101,8 +148,33 @@ class TripleOAction(actions.Action):
             username=context.user_name
         )
 
+    def get_orchestration_identity(self, context):
+        """Identify the Heat service behind the orchestration client
+
+        Returns the endpoint of the service along with its build
+        information, which is only fetched once per process.
+        """
+        endpoint = _endpoints.get('heat', context).url
+        build_info = _heat_build_info.get(endpoint)
+        if build_info is None:
+            heat = self.get_orchestration_client(context)
+            try:
+                build_info = heat.build_info.build_info()
+            except heat_exc.HTTPException as err:
+                # tried again next time
+                LOG.warning('Failed to get the build information of Heat: '
+                            '%s' % err)
+                build_info = {}
+            else:
+                _heat_build_info.set(endpoint, build_info)
+        return {'endpoint': endpoint, 'build_info': build_info}
+
     def get_workflow_client(self, context):
-        mistral_endpoint = keystone_utils.get_endpoint_for_project('mistral')
+        return _clients.get('mistral', context, functools.partial(
+            self._create_workflow_client, context))
+
+    def _create_workflow_client(self, context):
+        mistral_endpoint = _endpoints.get('mistral', context)
 
         mc = mistral_client.client(auth_token=context.auth_token,
                                    mistral_url=mistral_endpoint.url)
@@ -110,8 +182,12 @@ class TripleOAction(actions.Action):
         return mc
 
     def get_compute_client(self, context):
-        keystone_endpoint = keystone_utils.get_endpoint_for_project('keystone')
-        nova_endpoint = keystone_utils.get_endpoint_for_project('nova')
+        return _clients.get('nova', context, functools.partial(
+            self._create_compute_client, context))
+
+    def _create_compute_client(self, context):
+        keystone_endpoint = _endpoints.get('keystone', context)
+        nova_endpoint = _endpoints.get('nova', context)
 
         client = nova_client(
             2,
@@ -135,34 +211,90 @@ class TripleOAction(actions.Action):
     def _cache_key(self, plan_name, key_name):
         return "__cache_{}_{}".format(plan_name, key_name)
 
+    def _cache_decode(self, headers, body):
+        """Decodes a stored object with the codec it was encoded with"""
+        codec = cache_utils.get_codec(headers.get(
+            constants.CACHE_CODEC_KEY, constants.LEGACY_CACHE_CODEC))
+        return codec.decode(body)
+
+    def _cache_put(self, swift_client, cache_key, contents, headers):
+        """Encodes and stores an object
+
+        Returns the size of the serialized contents.
+        """
+        body, size = cache_utils.get_codec(
+            constants.DEFAULT_CACHE_CODEC).encode(contents)
+        headers[constants.CACHE_CODEC_KEY] = constants.DEFAULT_CACHE_CODEC
+        try:
+            swift_client.put_object(constants.TRIPLEO_CACHE_CONTAINER,
+                                    cache_key, body, headers=headers)
+        except swiftexceptions.ClientException as err:
+            if err.http_status != 404:
+                raise
+            # the cache container doesn't exist yet
+            swift_client.put_container(constants.TRIPLEO_CACHE_CONTAINER)
+            swift_client.put_object(constants.TRIPLEO_CACHE_CONTAINER,
+                                    cache_key, body, headers=headers)
+        return size
+
     def cache_get(self, context, plan_name, key):
         """Retrieves the stored objects
 
-        Returns None if there are any issues or no objects found
+        Returns None if there are any issues, no objects found or if the
+        stored objects were computed against an older plan generation.
+
+        """
+
+        return self.cache_lookup(context, plan_name, key)[0]
+
+    def cache_lookup(self, context, plan_name, key):
+        """Retrieves the stored objects and the current plan generation
+
+        Returns a (contents, generation) tuple, contents being None as with
+        cache_get. The generation is read before looking up the objects, so
+        the contents computed after a miss can be stored with cache_set
+        against the generation they were computed from. It is None when it
+        can't be read.
 
         """
 
         swift_client = self.get_object_client(context)
+        cache_key = self._cache_key(plan_name, key)
+        generation = None
         try:
+            generation = plan_utils.get_plan_generation(swift_client,
+                                                        plan_name)
+            cached = _local_cache.get(cache_key)
+            if cached is not None and cached[0] == generation:
+                return cached[1], generation
+
             headers, body = swift_client.get_object(
                 constants.TRIPLEO_CACHE_CONTAINER,
-                self._cache_key(plan_name, key)
+                cache_key
             )
-            result = json.loads(zlib.decompress(body).decode())
-            return result
+            if int(headers.get(constants.CACHE_GENERATION_KEY,
+                               0)) != generation:
+                # the plan changed since the object was stored
+                return None, generation
+            result, size = self._cache_decode(headers, body)
+            _local_cache.set(cache_key, (generation, result), size)
+            return result, generation
         except swiftexceptions.ClientException:
             # cache does not exist, ignore
-            pass
+            _local_cache.pop(cache_key)
         except ValueError:
-            # the stored json is invalid. Deleting
+            # the stored object is invalid. Deleting
             self.cache_delete(context, plan_name, key)
-        return
+        return None, generation
 
-    def cache_set(self, context, plan_name, key, contents):
+    def cache_set(self, context, plan_name, key, contents, generation=None):
         """Stores an object
 
         Allows the storage of jsonable objects except for None
-        Storing None equals to a cache delete.
+        Storing None equals to a cache delete. The object is stamped with
+        generation, the plan generation it was computed against as returned
+        by cache_lookup, or with the current generation of the plan when it
+        isn't given.
 
         """
 
@@ -171,23 +303,85 @@ class TripleOAction(actions.Action):
             self.cache_delete(context, plan_name, key)
             return
 
-        try:
-            swift_client.head_container(constants.TRIPLEO_CACHE_CONTAINER)
-        except swiftexceptions.ClientException:
-            swift_client.put_container(constants.TRIPLEO_CACHE_CONTAINER)
-
-        swift_client.put_object(
-            constants.TRIPLEO_CACHE_CONTAINER,
-            self._cache_key(plan_name, key),
-            zlib.compress(json.dumps(contents).encode()))
+        cache_key = self._cache_key(plan_name, key)
+        if generation is None:
+            generation = plan_utils.get_plan_generation(swift_client,
+                                                        plan_name)
+        headers = {constants.CACHE_GENERATION_KEY: str(generation)}
+        size = self._cache_put(swift_client, cache_key, contents, headers)
+        _local_cache.set(cache_key, (generation, contents), size)
 
     def cache_delete(self, context, plan_name, key):
         swift_client = self.get_object_client(context)
+        cache_key = self._cache_key(plan_name, key)
+        _local_cache.pop(cache_key)
         try:
             swift_client.delete_object(
                 constants.TRIPLEO_CACHE_CONTAINER,
-                self._cache_key(plan_name, key)
+                cache_key
             )
         except swiftexceptions.ClientException:
             # cache or container does not exist. Ignore
             pass
+
+    def _digest_cache_key(self, key_name, digest):
+        return "__digest_{}_{}".format(key_name, digest)
+
+    def digest_cache_get(self, context, key, digest):
+        """Retrieves an object stored under the digest of its inputs
+
+        Unlike the objects stored with cache_set, these objects don't belong
+        to a plan: they stay valid for as long as the same inputs produce the
+        same digest, whichever plan they come from. Returns None if there
+        is no such object.
+
+        """
+
+        cache_key = self._digest_cache_key(key, digest)
+        cached = _local_cache.get(cache_key)
+        if cached is not None:
+            return cached[1]
+
+        swift_client = self.get_object_client(context)
+        try:
+            headers, body = swift_client.get_object(
+                constants.TRIPLEO_CACHE_CONTAINER,
+                cache_key
+            )
+            result, size = self._cache_decode(headers, body)
+        except swiftexceptions.ClientException:
+            # cache does not exist, ignore
+            return
+        except ValueError:
+            # the stored object is invalid, it will be overwritten
+            return
+        _local_cache.set(cache_key, (digest, result), size)
+        return result
+
+    def digest_cache_set(self, context, key, digest, contents):
+        """Stores an object under the digest of its inputs
+
+        The stored object expires after DIGEST_CACHE_TTL seconds.
+
+        """
+
+        swift_client = self.get_object_client(context)
+        cache_key = self._digest_cache_key(key, digest)
+        headers = {'X-Delete-After': str(constants.DIGEST_CACHE_TTL)}
+        size = self._cache_put(swift_client, cache_key, contents, headers)
+        _local_cache.set(cache_key, (digest, contents), size)
+
+    def cache_invalidate(self, context, plan_name):
+        """Invalidates all the stored objects of a plan
+
+        This bumps the plan generation, the objects stored against the
+        previous generations are ignored by cache_get.
+
+        """
+
+        swift_client = self.get_object_client(context)
+        try:
+            plan_utils.bump_plan_generation(swift_client, plan_name)
+        except swiftexceptions.ClientException:
+            # plan container does not exist. Ignore
+            pass
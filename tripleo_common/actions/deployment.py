@@ -24,6 +24,7 @@ from swiftclient import exceptions as swiftexceptions
 from tripleo_common.actions import base
 from tripleo_common.actions import templates
 from tripleo_common import constants
+from tripleo_common import exception
 from tripleo_common.utils import overcloudrc
 from tripleo_common.utils import plan as plan_utils
 
@@ -154,16 +155,13 @@ class DeployStackAction(templates.ProcessTemplatesAction):
         parameters['StackAction'] = 'CREATE' if stack_is_new else 'UPDATE'
 
         try:
-            env = plan_utils.get_env(swift, self.container)
-        except swiftexceptions.ClientException as err:
+            plan_utils.update_env_key(swift, self.container,
+                                      'parameter_defaults', parameters)
+        except exception.PlanEnvironmentReadError as err:
             err_msg = ("Error retrieving environment for plan %s: %s" % (
                 self.container, err))
             LOG.exception(err_msg)
             return actions.Result(error=err_msg)
-
-        try:
-            plan_utils.update_in_env(swift, env, 'parameter_defaults',
-                                     parameters)
         except swiftexceptions.ClientException as err:
             err_msg = ("Error updating environment for plan %s: %s" % (
                 self.container, err))
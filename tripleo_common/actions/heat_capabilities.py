@@ -21,6 +21,7 @@ from swiftclient import exceptions as swiftexceptions
 
 from tripleo_common.actions import base
 from tripleo_common import constants
+from tripleo_common import exception
 from tripleo_common.utils import plan as plan_utils
 
 LOG = logging.getLogger(__name__)
@@ -166,37 +167,37 @@ class UpdateCapabilitiesAction(base.TripleOAction):
     def run(self, context):
         swift = self.get_object_client(context)
 
+        def _update_environments(env):
+            for k, v in self.environments.items():
+                found = False
+                if {'path': k} in env['environments']:
+                    found = True
+                if v:
+                    if not found:
+                        env['environments'].append({'path': k})
+                else:
+                    if found:
+                        env['environments'].remove({'path': k})
+
+            if self.purge_missing:
+                for e in env['environments']:
+                    if e.get('path') not in self.environments:
+                        env['environments'].remove(e)
+
         try:
-            env = plan_utils.get_env(swift, self.container)
-        except swiftexceptions.ClientException as err:
+            env = plan_utils.update_env(swift, self.container,
+                                        _update_environments)
+        except exception.PlanEnvironmentReadError as err:
             err_msg = ("Error retrieving environment for plan %s: %s" % (
                 self.container, err))
             LOG.exception(err_msg)
             return actions.Result(error=err_msg)
-
-        for k, v in self.environments.items():
-            found = False
-            if {'path': k} in env['environments']:
-                found = True
-            if v:
-                if not found:
-                    env['environments'].append({'path': k})
-            else:
-                if found:
-                    env['environments'].remove({'path': k})
-
-        if self.purge_missing:
-            for e in env['environments']:
-                if e.get('path') not in self.environments:
-                    env['environments'].remove(e)
-
-        self.cache_delete(context, self.container, "tripleo.parameters.get")
-
-        try:
-            plan_utils.put_env(swift, env)
         except swiftexceptions.ClientException as err:
             err_msg = "Error uploading to container: %s" % err
             LOG.exception(err_msg)
             return actions.Result(error=err_msg)
 
+        # once the environment is stored, so the previous one can't be
+        # cached again against the new generation
+        self.cache_invalidate(context, self.container)
         return env
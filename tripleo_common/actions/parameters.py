@@ -27,9 +27,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import logging
-import uuid
-
 from heatclient import exc as heat_exc
+import jsonpatch
 from mistral_lib import actions
 from swiftclient import exceptions as swiftexceptions
 
@@ -37,6 +36,7 @@ from tripleo_common.actions import base
 from tripleo_common.actions import templates
 from tripleo_common import constants
 from tripleo_common import exception
+from tripleo_common.utils import cache as cache_utils
 from tripleo_common.utils import nodes
 from tripleo_common.utils import parameters
 from tripleo_common.utils import passwords as password_utils
@@ -50,9 +50,11 @@ class GetParametersAction(templates.ProcessTemplatesAction):
 
     def run(self, context):
 
-        cached = self.cache_get(context,
-                                self.container,
-                                "tripleo.parameters.get")
+        # the generation is read before computing the result, so a result
+        # computed while the plan changes isn't stored as current
+        cached, generation = self.cache_lookup(context,
+                                               self.container,
+                                               "tripleo.parameters.get")
 
         if cached is not None:
             return cached
@@ -87,14 +89,29 @@ class GetParametersAction(templates.ProcessTemplatesAction):
             'show_nested': True
         }
 
+        # the validated tree only depends on the payload sent to Heat and on
+        # the Heat service validating it, so it is shared by all the plans
+        # producing the same payload
+        digest = cache_utils.digest({
+            'heat': self.get_orchestration_identity(context),
+            'fields': fields,
+        })
+        tree = self.digest_cache_get(context, "tripleo.parameters.validate",
+                                     digest)
+        if tree is None:
+            tree = heat.stacks.validate(**fields)
+            self.digest_cache_set(context, "tripleo.parameters.validate",
+                                  digest, tree)
+
         result = {
-            'heat_resource_tree': heat.stacks.validate(**fields),
+            'heat_resource_tree': tree,
             'environment_parameters': params,
         }
         self.cache_set(context,
                        self.container,
                        "tripleo.parameters.get",
-                       result)
+                       result,
+                       generation=generation)
         return result
 
 
@@ -109,25 +126,21 @@ class ResetParametersAction(base.TripleOAction):
         swift = self.get_object_client(context)
 
         try:
-            env = plan_utils.get_env(swift, self.container)
-        except swiftexceptions.ClientException as err:
+            env = plan_utils.update_env_key(swift, self.container,
+                                            'parameter_defaults',
+                                            delete_key=True)
+        except exception.PlanEnvironmentReadError as err:
             err_msg = ("Error retrieving environment for plan %s: %s" % (
                 self.container, err))
             LOG.exception(err_msg)
             return actions.Result(error=err_msg)
-
-        try:
-            plan_utils.update_in_env(swift, env, 'parameter_defaults',
-                                     delete_key=True)
         except swiftexceptions.ClientException as err:
             err_msg = ("Error updating environment for plan %s: %s" % (
                 self.container, err))
             LOG.exception(err_msg)
             return actions.Result(error=err_msg)
 
-        self.cache_delete(context,
-                          self.container,
-                          "tripleo.parameters.get")
+        self.cache_invalidate(context, self.container)
         return env
 
 
@@ -144,25 +157,21 @@ class UpdateParametersAction(base.TripleOAction):
         swift = self.get_object_client(context)
 
         try:
-            env = plan_utils.get_env(swift, self.container)
-        except swiftexceptions.ClientException as err:
+            env = plan_utils.update_env_key(swift, self.container,
+                                            'parameter_defaults',
+                                            self.parameters)
+        except exception.PlanEnvironmentReadError as err:
             err_msg = ("Error retrieving environment for plan %s: %s" % (
                 self.container, err))
             LOG.exception(err_msg)
             return actions.Result(error=err_msg)
-
-        try:
-            plan_utils.update_in_env(swift, env, 'parameter_defaults',
-                                     self.parameters)
         except swiftexceptions.ClientException as err:
             err_msg = ("Error updating environment for plan %s: %s" % (
                 self.container, err))
             LOG.exception(err_msg)
             return actions.Result(error=err_msg)
 
-        self.cache_delete(context,
-                          self.container,
-                          "tripleo.parameters.get")
+        self.cache_invalidate(context, self.container)
         return env
 
 
@@ -182,6 +191,49 @@ class UpdateRoleParametersAction(UpdateParametersAction):
         return super(UpdateRoleParametersAction, self).run(context)
 
 
+class PatchParametersAction(base.TripleOAction):
+    """Applies a JSON patch to the parameters of the plan environment
+
+    Unlike UpdateParametersAction, only the keys touched by the patch are
+    changed, and the patch is applied again on top of concurrent updates.
+    """
+
+    def __init__(self, patch, container=constants.DEFAULT_CONTAINER_NAME):
+        super(PatchParametersAction, self).__init__()
+        self.container = container
+        self.patch = patch
+
+    def run(self, context):
+        swift = self.get_object_client(context)
+
+        def _patch_parameters(env):
+            env['parameter_defaults'] = jsonpatch.apply_patch(
+                env.get('parameter_defaults', {}), self.patch)
+
+        try:
+            env = plan_utils.update_env(swift, self.container,
+                                        _patch_parameters)
+        except (jsonpatch.JsonPatchException,
+                jsonpatch.JsonPointerException) as err:
+            err_msg = ("Error applying patch to the parameters of plan %s: "
+                       "%s" % (self.container, err))
+            LOG.exception(err_msg)
+            return actions.Result(error=err_msg)
+        except exception.PlanEnvironmentReadError as err:
+            err_msg = ("Error retrieving environment for plan %s: %s" % (
+                self.container, err))
+            LOG.exception(err_msg)
+            return actions.Result(error=err_msg)
+        except swiftexceptions.ClientException as err:
+            err_msg = ("Error updating environment for plan %s: %s" % (
+                self.container, err))
+            LOG.exception(err_msg)
+            return actions.Result(error=err_msg)
+
+        self.cache_invalidate(context, self.container)
+        return env['parameter_defaults']
+
+
 class GeneratePasswordsAction(base.TripleOAction):
     """Generates passwords needed for Overcloud deployment
 
@@ -199,14 +251,6 @@ class GeneratePasswordsAction(base.TripleOAction):
         swift = self.get_object_client(context)
         mistral = self.get_workflow_client(context)
 
-        try:
-            env = plan_utils.get_env(swift, self.container)
-        except swiftexceptions.ClientException as err:
-            err_msg = ("Error retrieving environment for plan %s: %s" % (
-                self.container, err))
-            LOG.exception(err_msg)
-            return actions.Result(error=err_msg)
-
         try:
             stack_env = heat.stacks.environment(
                 stack_id=self.container)
@@ -215,26 +259,30 @@ class GeneratePasswordsAction(base.TripleOAction):
 
         passwords = password_utils.generate_passwords(mistral, stack_env)
 
-        # if passwords don't yet exist in plan environment
-        if 'passwords' not in env:
-            env['passwords'] = {}
+        def _add_passwords(env):
+            # if passwords don't yet exist in plan environment
+            if 'passwords' not in env:
+                env['passwords'] = {}
 
-        # ensure all generated passwords are present in plan env,
-        # but respect any values previously generated and stored
-        for name, password in passwords.items():
-            if name not in env['passwords']:
-                env['passwords'][name] = password
+            # ensure all generated passwords are present in plan env,
+            # but respect any values previously generated and stored
+            for name, password in passwords.items():
+                if name not in env['passwords']:
+                    env['passwords'][name] = password
 
         try:
-            plan_utils.put_env(swift, env)
+            env = plan_utils.update_env(swift, self.container, _add_passwords)
+        except exception.PlanEnvironmentReadError as err:
+            err_msg = ("Error retrieving environment for plan %s: %s" % (
+                self.container, err))
+            LOG.exception(err_msg)
+            return actions.Result(error=err_msg)
         except swiftexceptions.ClientException as err:
             err_msg = "Error uploading to container: %s" % err
             LOG.exception(err_msg)
             return actions.Result(error=err_msg)
 
-        self.cache_delete(context,
-                          self.container,
-                          "tripleo.parameters.get")
+        self.cache_invalidate(context, self.container)
         return env['passwords']
 
 
@@ -376,48 +424,13 @@ class GetFlattenedParametersAction(GetParametersAction):
     def __init__(self, container=constants.DEFAULT_CONTAINER_NAME):
         super(GetFlattenedParametersAction, self).__init__(container)
 
-    def _processParams(self, flattened, params):
-        for item in params:
-            if item not in flattened['parameters']:
-                param_obj = {}
-                for key, value in params.get(item).items():
-                    camel_case_key = key[0].lower() + key[1:]
-                    param_obj[camel_case_key] = value
-                param_obj['name'] = item
-                flattened['parameters'][item] = param_obj
-        return list(params)
-
-    def _process(self, flattened, name, data):
-        key = str(uuid.uuid4())
-        value = {}
-        value.update({
-            'name': name,
-            'id': key
-        })
-        if 'Type' in data:
-            value['type'] = data['Type']
-        if 'Description' in data:
-            value['description'] = data['Description']
-        if 'Parameters' in data:
-            value['parameters'] = self._processParams(flattened,
-                                                      data['Parameters'])
-        if 'ParameterGroups' in data:
-            value['parameter_groups'] = data['ParameterGroups']
-        if 'NestedParameters' in data:
-            nested = data['NestedParameters']
-            nested_ids = []
-            for nested_key in nested.keys():
-                nested_data = self._process(flattened, nested_key,
-                                            nested.get(nested_key))
-                # nested_data will always have one key (and only one)
-                nested_ids.append(list(nested_data)[0])
-
-            value['resources'] = nested_ids
-
-        flattened['resources'][key] = value
-        return {key: value}
-
     def run(self, context):
+        cached, generation = self.cache_lookup(
+            context, self.container, "tripleo.parameters.get_flatten")
+
+        if cached is not None:
+            return cached
+
         # process all plan files and create or update a stack
         processed_data = super(GetFlattenedParametersAction, self).run(context)
 
@@ -426,12 +439,19 @@ class GetFlattenedParametersAction(GetParametersAction):
         if isinstance(processed_data, actions.Result):
             return processed_data
 
+        # the parent result may be shared with the in-process cache, so it
+        # must not be modified in place
+        processed_data = dict(processed_data)
         if processed_data['heat_resource_tree']:
-            flattened = {'resources': {}, 'parameters': {}}
-            self._process(flattened, 'Root',
-                          processed_data['heat_resource_tree'])
-            processed_data['heat_resource_tree'] = flattened
+            processed_data['heat_resource_tree'] = (
+                parameters.flatten_resource_tree(
+                    processed_data['heat_resource_tree']))
 
+        self.cache_set(context,
+                       self.container,
+                       "tripleo.parameters.get_flatten",
+                       processed_data,
+                       generation=generation)
         return processed_data
 
 
@@ -502,9 +522,7 @@ class RotateFernetKeysAction(GetPasswordsAction):
             LOG.exception(err_msg)
             return actions.Result(error=err_msg)
 
-        self.cache_delete(context,
-                          self.container,
-                          "tripleo.parameters.get")
+        self.cache_invalidate(context, self.container)
 
         return keys_map
 
@@ -13,16 +13,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import logging
-import os
-import shutil
-import tempfile
+import tarfile
 import yaml
 
 from heatclient import exc as heatexceptions
 from keystoneauth1 import exceptions as keystoneauth_exc
 from mistral_lib import actions
 from mistralclient.api import base as mistralclient_base
-from oslo_concurrency import processutils
 import six
 from swiftclient import exceptions as swiftexceptions
 
@@ -69,6 +66,7 @@ class CreateContainerAction(base.TripleOAction):
                              " exists.") % self.container
             return actions.Result(error=result_string)
         oc.put_container(self.container, headers=default_container_headers)
+        plan_utils.invalidate_plan_list(oc)
 
 
 class MigratePlanAction(base.TripleOAction):
@@ -129,14 +127,8 @@ class ListPlansAction(base.TripleOAction):
     def run(self, context):
         # Plans consist of a container object marked with metadata to ensure it
         # isn't confused with another container
-        plan_list = []
         oc = self.get_object_client(context)
-
-        for item in oc.get_account()[1]:
-            container = oc.get_container(item['name'])[0]
-            if constants.TRIPLEO_META_USAGE_KEY in container.keys():
-                plan_list.append(item['name'])
-        return list(set(plan_list))
+        return plan_utils.list_plans(oc)
 
 
 class DeletePlanAction(base.TripleOAction):
@@ -169,6 +161,7 @@ class DeletePlanAction(base.TripleOAction):
         try:
             swift = self.get_object_client(context)
             swiftutils.delete_container(swift, self.container)
+            plan_utils.invalidate_plan_list(swift)
         except swiftexceptions.ClientException as ce:
             LOG.exception("Swift error deleting plan.")
             error_text = ce.msg
@@ -221,57 +214,42 @@ class ExportPlanAction(base.TripleOAction):
         self.delete_after = delete_after
         self.exports_container = exports_container
 
-    def _download_templates(self, swift, tmp_dir):
-        """Download templates to a temp folder."""
-        template_files = swift.get_container(self.plan)[1]
-
-        for tf in template_files:
-            filename = tf['name']
-            contents = swift.get_object(self.plan, filename)[1]
-            path = os.path.join(tmp_dir, filename)
-            dirname = os.path.dirname(path)
-
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
+    def _iter_templates(self, swift, context):
+        """Yield the name and contents of every file of the plan."""
+        template_files = swift.get_container(self.plan, full_listing=True)[1]
+        names = [tf['name'] for tf in template_files]
+        return swiftutils.iter_objects(swift, self.plan, names,
+                                       context.auth_token)
 
-            with open(path, 'w') as f:
-                f.write(contents)
-
-    def _create_and_upload_tarball(self, swift, tmp_dir):
-        """Create a tarball containing the tmp_dir and upload it to Swift."""
+    def _create_and_upload_tarball(self, swift, templates):
+        """Stream a tarball of the templates to Swift."""
         tarball_name = '%s.tar.gz' % self.plan
         headers = {'X-Delete-After': self.delete_after}
 
         # make sure the root container which holds all plan exports exists
         try:
-            swift.get_container(self.exports_container)
+            swift.head_container(self.exports_container)
         except swiftexceptions.ClientException:
             swift.put_container(self.exports_container)
 
-        with tempfile.NamedTemporaryFile() as tmp_tarball:
-            tarball.create_tarball(tmp_dir, tmp_tarball.name)
-
-            swift.put_object(self.exports_container, tarball_name, tmp_tarball,
-                             headers=headers)
+        # The tarball is compressed while the objects are still being
+        # downloaded and uploaded with chunked transfer encoding as it is
+        # produced.
+        swift.put_object(self.exports_container, tarball_name,
+                         tarball.stream_tarball(templates), headers=headers)
 
     def run(self, context):
         swift = self.get_object_client(context)
-        tmp_dir = tempfile.mkdtemp()
 
         try:
-            self._download_templates(swift, tmp_dir)
-            self._create_and_upload_tarball(swift, tmp_dir)
+            templates = self._iter_templates(swift, context)
+            self._create_and_upload_tarball(swift, templates)
         except swiftexceptions.ClientException as err:
             msg = "Error attempting an operation on container: %s" % err
             return actions.Result(error=msg)
-        except (OSError, IOError) as err:
-            msg = "Error while writing file: %s" % err
-            return actions.Result(error=msg)
-        except processutils.ProcessExecutionError as err:
+        except tarfile.TarError as err:
             msg = "Error while creating a tarball: %s" % err
             return actions.Result(error=msg)
         except Exception as err:
             msg = "Error exporting plan: %s" % err
             return actions.Result(error=msg)
-        finally:
-            shutil.rmtree(tmp_dir)
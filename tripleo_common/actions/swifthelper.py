@@ -20,6 +20,8 @@ from six.moves import urllib
 from swiftclient import exceptions as swiftexceptions
 from swiftclient.utils import generate_temp_url
 from tripleo_common.actions import base
+from tripleo_common import constants
+from tripleo_common.utils import swift as swiftutils
 
 
 class SwiftInformationAction(base.TripleOAction):
@@ -73,3 +75,28 @@ class SwiftTempUrlAction(base.TripleOAction):
         path = "%s/%s/%s" % (parsed.path, self.container, self.obj)
         temp_path = generate_temp_url(path, self.valid, key, self.method)
         return "%s://%s%s" % (parsed.scheme, parsed.netloc, temp_path)
+
+
+class SwiftEmptyContainerAction(base.TripleOAction):
+    """Deletes all the objects of a container
+
+    Unlike deleting a plan, this works with any container, such as the ones
+    the logs are uploaded to.
+    """
+
+    def __init__(self, container,
+                 concurrency=constants.DEFAULT_SWIFT_WORKERS):
+        super(SwiftEmptyContainerAction, self).__init__()
+        self.container = container
+        self.concurrency = concurrency
+
+    def run(self, context):
+        try:
+            swift_client = self.get_object_client(context)
+            objects = swift_client.get_container(self.container,
+                                                 full_listing=True)[1]
+            swiftutils.delete_objects(swift_client, self.container,
+                                      [o['name'] for o in objects],
+                                      workers=self.concurrency)
+        except swiftexceptions.ClientException as err:
+            return actions.Result(error=str(err))
@@ -12,15 +12,16 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import hashlib
 import jinja2
 import json
 import logging
 import os
-import requests
 import six
-import tempfile as tf
+import threading
 import yaml
 
+from concurrent import futures
 from heatclient.common import template_utils
 from mistral_lib import actions
 from swiftclient import exceptions as swiftexceptions
@@ -28,17 +29,44 @@ from swiftclient import exceptions as swiftexceptions
 from tripleo_common.actions import base
 from tripleo_common import constants
 from tripleo_common.utils import plan as plan_utils
+from tripleo_common.utils import swift as swiftutils
 from tripleo_common.utils import tarball
 
 LOG = logging.getLogger(__name__)
 
 
-def _create_temp_file(data):
-    handle, env_temp_file = tf.mkstemp()
-    with open(env_temp_file, 'w') as temp_file:
-        temp_file.write(json.dumps(data))
-        os.close(handle)
-    return env_temp_file
+def _md5(contents):
+    if isinstance(contents, six.text_type):
+        contents = contents.encode('utf-8')
+    return hashlib.md5(contents).hexdigest()
+
+
+def _to_text(contents):
+    if isinstance(contents, six.binary_type):
+        contents = contents.decode('utf-8')
+    return contents
+
+
+def _get_render_manifest(swift, container):
+    try:
+        manifest = swift.get_object(
+            container, constants.OVERCLOUD_J2_RENDER_MANIFEST)[1]
+        return json.loads(_to_text(manifest))
+    except (swiftexceptions.ClientException, ValueError):
+        LOG.info("No valid %s file found in container %s" % (
+            constants.OVERCLOUD_J2_RENDER_MANIFEST, container))
+        return {}
+
+
+def _get_sync_manifest(swift, container):
+    try:
+        manifest = swift.get_object(
+            container, constants.TEMPLATES_SYNC_MANIFEST)[1]
+        return json.loads(_to_text(manifest))
+    except (swiftexceptions.ClientException, ValueError):
+        LOG.info("No valid %s file found in container %s" % (
+            constants.TEMPLATES_SYNC_MANIFEST, container))
+        return []
 
 
 class J2SwiftLoader(jinja2.BaseLoader):
@@ -47,11 +75,18 @@ class J2SwiftLoader(jinja2.BaseLoader):
     This attempts to fetch a template include file from the given container.
     An optional search path or list of search paths can be provided. By default
     only the absolute path relative to the container root is searched.
+    Files found in the optional ``objects`` mapping, such as a prefetched
+    snapshot of the container, are not requested from swift.
+    The MD5 checksum of every loaded file is recorded in ``loaded``.
+    Templates may be rendered concurrently, so the swift client must be
+    thread safe, like the ones of TripleOAction.get_object_client.
     """
 
-    def __init__(self, swift, container, searchpath=None):
+    def __init__(self, swift, container, searchpath=None, objects=None):
         self.swift = swift
         self.container = container
+        self.objects = objects
+        self.loaded = {}
         if searchpath is not None:
             if isinstance(searchpath, six.string_types):
                 self.searchpath = [searchpath]
@@ -67,9 +102,16 @@ class J2SwiftLoader(jinja2.BaseLoader):
         pieces = jinja2.loaders.split_template_path(template)
         for searchpath in self.searchpath:
             template_path = os.path.join(searchpath, *pieces)
+            if self.objects is not None:
+                source = self.objects.get(template_path)
+                if source is not None:
+                    self.loaded[template_path] = _md5(source)
+                    # the snapshot doesn't change, always up to date
+                    return _to_text(source), None, lambda: True
             try:
                 source = self.swift.get_object(
                     self.container, template_path)[1]
+                self.loaded[template_path] = _md5(source)
                 return source, None, False
             except swiftexceptions.ClientException:
                 pass
@@ -77,20 +119,87 @@ class J2SwiftLoader(jinja2.BaseLoader):
 
 
 class UploadTemplatesAction(base.TripleOAction):
-    """Upload default heat templates for TripleO."""
+    """Upload default heat templates for TripleO.
+
+    In sync mode only the files which are new or whose MD5 checksum differs
+    from the ETag of the object already in the container are uploaded, and
+    the list of the uploaded templates is recorded in the plan. With
+    delete_removed, the templates recorded by the previous sync which are no
+    longer part of the templates are deleted too. Objects which were not
+    uploaded by a sync, such as the environment files added to the plan by
+    users or the files generated in the plan, are never deleted. The plan
+    cache is invalidated whenever objects of the plan are changed.
+    """
     def __init__(self, container=constants.DEFAULT_CONTAINER_NAME,
-                 templates_path=constants.DEFAULT_TEMPLATES_PATH):
+                 templates_path=constants.DEFAULT_TEMPLATES_PATH,
+                 compresslevel=constants.DEFAULT_TARBALL_COMPRESSLEVEL,
+                 sync=False, delete_removed=False):
         super(UploadTemplatesAction, self).__init__()
         self.container = container
         self.templates_path = templates_path
+        self.compresslevel = compresslevel
+        self.sync = sync
+        self.delete_removed = delete_removed
+
+    def _sync(self, swift):
+        """Upload the changed files, returns whether the plan was changed"""
+        objects = swift.get_container(self.container, full_listing=True)[1]
+        etags = dict((obj['name'], obj.get('hash')) for obj in objects)
+
+        local_files = list(tarball.list_directory(self.templates_path))
+        changed = []
+        for name in local_files:
+            with open(os.path.join(self.templates_path, name), 'rb') as f:
+                if _md5(f.read()) != etags.get(name):
+                    changed.append(name)
+
+        LOG.debug('Uploading %d of %d files to container %s' % (
+            len(changed), len(local_files), self.container))
+        if changed:
+            tarball.directory_extract_to_swift_container(
+                swift, self.templates_path, self.container,
+                self.compresslevel, names=changed)
+
+        removed = []
+        if self.delete_removed:
+            # only the templates uploaded by a previous sync are candidates,
+            # the other objects were added to the plan by other means
+            synced = _get_sync_manifest(swift, self.container)
+            # rendered templates are not part of the templates but of the plan
+            generated = set(_get_render_manifest(swift, self.container))
+            generated.update([constants.PLAN_ENVIRONMENT,
+                              constants.OVERCLOUD_J2_RENDER_MANIFEST])
+            generated.update(constants.PLAN_ENVIRONMENT_SECTIONS.values())
+            keep = generated.union(local_files)
+            removed = [name for name in synced
+                       if name in etags and name not in keep]
+            if removed:
+                swiftutils.delete_objects(swift, self.container, removed)
+
+        manifest = json.dumps(sorted(local_files))
+        if _md5(manifest) != etags.get(constants.TEMPLATES_SYNC_MANIFEST):
+            swift.put_object(self.container,
+                             constants.TEMPLATES_SYNC_MANIFEST, manifest)
+
+        return bool(changed or removed)
 
     def run(self, context):
-        with tf.NamedTemporaryFile() as tmp_tarball:
-            tarball.create_tarball(self.templates_path, tmp_tarball.name)
-            tarball.tarball_extract_to_swift_container(
-                self.get_object_client(context),
-                tmp_tarball.name,
-                self.container)
+        swift = self.get_object_client(context)
+        if self.sync:
+            changed = self._sync(swift)
+        else:
+            tarball.directory_extract_to_swift_container(
+                swift,
+                self.templates_path,
+                self.container,
+                self.compresslevel)
+            changed = True
+
+        if changed:
+            # the templates are inputs of everything derived from the plan,
+            # such as the parameters, even when nothing needs to be rendered
+            # again
+            self.cache_invalidate(context, self.container)
 
 
 class ProcessTemplatesAction(base.TripleOAction):
@@ -100,26 +209,64 @@ class ProcessTemplatesAction(base.TripleOAction):
     plan into a format that can be passed to Heat.
     """
 
-    def __init__(self, container=constants.DEFAULT_CONTAINER_NAME):
+    def __init__(self, container=constants.DEFAULT_CONTAINER_NAME,
+                 render_workers=constants.DEFAULT_J2_RENDER_WORKERS):
         super(ProcessTemplatesAction, self).__init__()
         self.container = container
+        self.render_workers = render_workers
+        # prefetched plan files, see run()
+        self.plan_files = None
+        self._j2_environments = {}
+        self._j2_templates = {}
+        self._j2_lock = threading.Lock()
+
+    def _get_plan_file(self, swift, name):
+        """Get a plan file, from the prefetched plan files when possible"""
+        contents = None
+        if self.plan_files is not None:
+            contents = self.plan_files.get(name)
+        if contents is None:
+            contents = swift.get_object(self.container, name)[1]
+        return _to_text(contents)
+
+    def _get_j2_template(self, swift, j2_template, template_base):
+        """Get the compiled template, shared by all the renders of a run
+
+        Templates are compiled once per search path and the environment
+        caches the included templates, which are loaded from the
+        prefetched plan files when available.
+        """
+        with self._j2_lock:
+            template = self._j2_templates.get((template_base, j2_template))
+            if template is None:
+                j2_env = self._j2_environments.get(template_base)
+                if j2_env is None:
+                    # Search for templates relative to the current template
+                    # path first
+                    j2_loader = J2SwiftLoader(swift, self.container,
+                                              template_base,
+                                              objects=self.plan_files)
+                    j2_env = jinja2.Environment(loader=j2_loader)
+                    self._j2_environments[template_base] = j2_env
+                template = j2_env.from_string(j2_template)
+                self._j2_templates[(template_base, j2_template)] = template
+            return template
 
     def _j2_render_and_put(self,
                            j2_template,
                            j2_data,
                            outfile_name=None,
-                           context=None):
-        swift = self.get_object_client(context)
+                           context=None,
+                           swift=None):
+        if swift is None:
+            swift = self.get_object_client(context)
         yaml_f = outfile_name or j2_template.replace('.j2.yaml', '.yaml')
-
-        # Search for templates relative to the current template path first
         template_base = os.path.dirname(yaml_f)
-        j2_loader = J2SwiftLoader(swift, self.container, template_base)
 
         try:
             # Render the j2 template
-            template = jinja2.Environment(loader=j2_loader).from_string(
-                j2_template)
+            template = self._get_j2_template(swift, j2_template,
+                                             template_base)
             r_template = template.render(**j2_data)
         except jinja2.exceptions.TemplateError as ex:
             error_msg = ("Error rendering template %s : %s"
@@ -129,9 +276,6 @@ class ProcessTemplatesAction(base.TripleOAction):
         try:
             # write the template back to the plan container
             LOG.info("Writing rendered template %s" % yaml_f)
-            self.cache_delete(context,
-                              self.container,
-                              "tripleo.parameters.get")
             swift.put_object(
                 self.container, yaml_f, r_template)
         except swiftexceptions.ClientException as ex:
@@ -140,6 +284,69 @@ class ProcessTemplatesAction(base.TripleOAction):
             LOG.error(error_msg)
             raise Exception(error_msg)
 
+        etag = _md5(r_template)
+        if self.plan_files is not None:
+            self.plan_files.add(yaml_f, etag, r_template.encode('utf-8'))
+
+        # what the render manifest records about this output. The includes
+        # are the ones loaded by the shared environment so far, a superset
+        # of what this template included.
+        loaded = self._j2_environments[template_base].loader.loaded
+        return {'etag': etag, 'includes': dict(loaded)}
+
+    def _j2_render_and_put_all(self, jobs, context=None):
+        """Render and store templates concurrently
+
+        Every job is a (j2_template, j2_data, outfile_name) tuple. Returns
+        the results of _j2_render_and_put and the error messages, both in
+        the order of the jobs. A failed job doesn't stop the others.
+        """
+        # the client is resolved here, as the workers don't have the request
+        # context of this thread, and shared as it is thread safe
+        swift = self.get_object_client(context)
+
+        def _render(job):
+            j2_template, j2_data, outfile_name = job
+            return self._j2_render_and_put(j2_template,
+                                           j2_data,
+                                           outfile_name,
+                                           context=context,
+                                           swift=swift)
+
+        with futures.ThreadPoolExecutor(self.render_workers) as executor:
+            running = [executor.submit(_render, job) for job in jobs]
+
+        results = []
+        errors = []
+        for job in running:
+            try:
+                results.append(job.result())
+            except Exception as err:
+                results.append(None)
+                errors.append(six.text_type(err))
+        return results, errors
+
+    @staticmethod
+    def _render_inputs(template_etag, *data):
+        """Digest of everything a rendered template depends on"""
+        digest = hashlib.sha1(template_etag.encode('utf-8'))
+        for item in data:
+            digest.update(json.dumps(item, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _is_rendered(entry, inputs, etags, out_f):
+        """Check if the manifest entry of a rendered template is current
+
+        The output must have been rendered from the same inputs, and neither
+        the output itself nor the files it included may have changed since.
+        """
+        if not entry or inputs is None or entry.get('inputs') != inputs:
+            return False
+        files = dict(entry.get('includes', {}))
+        files[out_f] = entry.get('etag')
+        return all(etags.get(name) == etag for name, etag in files.items())
+
     def _get_j2_excludes_file(self, context):
         swift = self.get_object_client(context)
         try:
@@ -159,10 +366,12 @@ class ProcessTemplatesAction(base.TripleOAction):
 
     def _process_custom_roles(self, context):
         swift = self.get_object_client(context)
+        self._j2_environments = {}
+        self._j2_templates = {}
 
         try:
-            j2_role_file = swift.get_object(
-                self.container, constants.OVERCLOUD_J2_ROLES_NAME)[1]
+            j2_role_file = self._get_plan_file(
+                swift, constants.OVERCLOUD_J2_ROLES_NAME)
             role_data = yaml.safe_load(j2_role_file)
         except swiftexceptions.ClientException:
             LOG.info("No %s file found, skipping jinja templating"
@@ -170,8 +379,8 @@ class ProcessTemplatesAction(base.TripleOAction):
             return
 
         try:
-            j2_network_file = swift.get_object(
-                self.container, constants.OVERCLOUD_J2_NETWORKS_NAME)[1]
+            j2_network_file = self._get_plan_file(
+                swift, constants.OVERCLOUD_J2_NETWORKS_NAME)
             network_data = yaml.safe_load(j2_network_file)
         except swiftexceptions.ClientException:
             # Until t-h-t contains network_data.yaml we tolerate a missing file
@@ -197,15 +406,28 @@ class ProcessTemplatesAction(base.TripleOAction):
             r_map[r.get('name')] = r
         excl_templates = j2_excl_data.get('name')
 
+        # The manifest records the inputs of every rendered file, the files
+        # whose inputs didn't change since the last run are not rendered
+        # again.
+        etags = dict((f.get('name'), f.get('hash'))
+                     for f in container_files[1])
+        manifest = _get_render_manifest(swift, self.container)
+        new_manifest = {}
+        # the (j2_template, j2_data, outfile_name) of the files to render
+        # and the inputs to record in the manifest
+        jobs = []
+        jobs_inputs = []
+
         for f in [f.get('name') for f in container_files[1]]:
             # We do two templating passes here:
             # 1. *.role.j2.yaml - we template just the role name
             #    and create multiple files (one per role)
             # 2. *.j2.yaml - we template with all roles_data,
             #    and create one file common to all roles
+            template_etag = etags.get(f)
             if f.endswith('.role.j2.yaml'):
                 LOG.info("jinja2 rendering role template %s" % f)
-                j2_template = swift.get_object(self.container, f)[1]
+                j2_template = None
                 LOG.info("jinja2 rendering roles %s" % ","
                          .join(role_names))
                 for role in role_names:
@@ -215,38 +437,73 @@ class ProcessTemplatesAction(base.TripleOAction):
                          os.path.basename(f).replace('.role.j2.yaml',
                                                      '.yaml')])
                     out_f_path = os.path.join(os.path.dirname(f), out_f)
-                    if not (out_f_path in excl_templates):
-                        if '{{role.name}}' in j2_template:
-                            j2_data = {'role': r_map[role],
-                                       'networks': network_data}
-                            self._j2_render_and_put(j2_template,
-                                                    j2_data,
-                                                    out_f_path,
-                                                    context=context)
-                        else:
-                            # Backwards compatibility with templates
-                            # that specify {{role}} vs {{role.name}}
-                            j2_data = {'role': role, 'networks': network_data}
-                            LOG.debug("role legacy path for role %s" % role)
-                            if r_map[role].get('disable_constraints', False):
-                                j2_data['disable_constraints'] = True
-                            self._j2_render_and_put(j2_template,
-                                                    j2_data,
-                                                    out_f_path,
-                                                    context=context)
-                    else:
+                    if out_f_path in excl_templates:
                         LOG.info("Skipping rendering of %s, defined in %s" %
                                  (out_f_path, j2_excl_data))
+                        continue
+
+                    inputs = None
+                    if template_etag:
+                        inputs = self._render_inputs(
+                            template_etag, r_map[role], network_data)
+                    entry = manifest.get(out_f_path)
+                    if self._is_rendered(entry, inputs, etags, out_f_path):
+                        LOG.info("Skipping rendering of %s, it is up to "
+                                 "date" % out_f_path)
+                        new_manifest[out_f_path] = entry
+                        continue
+
+                    if j2_template is None:
+                        j2_template = self._get_plan_file(swift, f)
+                    if '{{role.name}}' in j2_template:
+                        j2_data = {'role': r_map[role],
+                                   'networks': network_data}
+                    else:
+                        # Backwards compatibility with templates
+                        # that specify {{role}} vs {{role.name}}
+                        j2_data = {'role': role, 'networks': network_data}
+                        LOG.debug("role legacy path for role %s" % role)
+                        if r_map[role].get('disable_constraints', False):
+                            j2_data['disable_constraints'] = True
+                    jobs.append((j2_template, j2_data, out_f_path))
+                    jobs_inputs.append(inputs)
 
             elif f.endswith('.j2.yaml'):
+                out_f = f.replace('.j2.yaml', '.yaml')
+                inputs = None
+                if template_etag:
+                    inputs = self._render_inputs(
+                        template_etag, role_data, network_data)
+                entry = manifest.get(out_f)
+                if self._is_rendered(entry, inputs, etags, out_f):
+                    LOG.info("Skipping rendering of %s, it is up to "
+                             "date" % out_f)
+                    new_manifest[out_f] = entry
+                    continue
+
                 LOG.info("jinja2 rendering %s" % f)
-                j2_template = swift.get_object(self.container, f)[1]
+                j2_template = self._get_plan_file(swift, f)
                 j2_data = {'roles': role_data, 'networks': network_data}
-                out_f = f.replace('.j2.yaml', '.yaml')
-                self._j2_render_and_put(j2_template,
-                                        j2_data,
-                                        out_f,
-                                        context=context)
+                jobs.append((j2_template, j2_data, out_f))
+                jobs_inputs.append(inputs)
+
+        results, errors = self._j2_render_and_put_all(jobs, context=context)
+        for job, inputs, entry in zip(jobs, jobs_inputs, results):
+            if entry is not None and inputs is not None:
+                entry['inputs'] = inputs
+                new_manifest[job[2]] = entry
+
+        if new_manifest != manifest:
+            swift.put_object(self.container,
+                             constants.OVERCLOUD_J2_RENDER_MANIFEST,
+                             json.dumps(new_manifest, sort_keys=True))
+
+        if any(entry is not None for entry in results):
+            # the rendered templates are part of the plan
+            self.cache_invalidate(context, self.container)
+
+        if errors:
+            raise Exception("\n".join(errors))
 
     def run(self, context):
         error_text = None
@@ -261,6 +518,19 @@ class ProcessTemplatesAction(base.TripleOAction):
             LOG.exception(err_msg)
             return actions.Result(error=error_text)
 
+        try:
+            # fetch all the plan files at once, so neither the jinja
+            # rendering nor the template and environment processing below
+            # need a request per file
+            self.plan_files = swiftutils.PlanFileFetcher(
+                swift, self.container, context.auth_token)
+            self.plan_files.prefetch()
+        except swiftexceptions.ClientException as err:
+            err_msg = ("Error retrieving files for plan %s: %s" % (
+                self.container, err))
+            LOG.exception(err_msg)
+            return actions.Result(error=err_msg)
+
         try:
             # if the jinja overcloud template exists, process it and write it
             # back to the swift container before continuing processing.  The
@@ -276,7 +546,6 @@ class ProcessTemplatesAction(base.TripleOAction):
         template_name = plan_env.get('template')
         environments = plan_env.get('environments')
         env_paths = []
-        temp_files = []
 
         template_object = os.path.join(swift.url, self.container,
                                        template_name)
@@ -284,14 +553,16 @@ class ProcessTemplatesAction(base.TripleOAction):
         LOG.debug('Template: %s' % template_name)
         LOG.debug('Environments: %s' % environments)
         try:
-            for env in environments:
+            # the inline environments are served from memory by the plan
+            # file fetcher, like the files of the plan
+            for index, env in enumerate(environments):
                 if env.get('path'):
                     env_paths.append(os.path.join(swift.url, self.container,
                                                   env['path']))
                 elif env.get('data'):
-                    env_temp_file = _create_temp_file(env['data'])
-                    temp_files.append(env_temp_file)
-                    env_paths.append(env_temp_file)
+                    env_paths.append(self.plan_files.add_virtual(
+                        constants.VIRTUAL_ENVIRONMENT_NAME % index,
+                        json.dumps(env['data'])))
 
             # create a dict to hold all user set params and merge
             # them in the appropriate order
@@ -304,37 +575,28 @@ class ProcessTemplatesAction(base.TripleOAction):
             params = plan_env.get('parameter_defaults', {})
             merged_params.update(params)
             if merged_params:
-                env_temp_file = _create_temp_file(
-                    {'parameter_defaults': merged_params})
-                temp_files.append(env_temp_file)
-                env_paths.append(env_temp_file)
+                env_paths.append(self.plan_files.add_virtual(
+                    constants.VIRTUAL_ENVIRONMENT_NAME % 'parameters',
+                    json.dumps({'parameter_defaults': merged_params})))
 
             def _env_path_is_object(env_path):
                 retval = env_path.startswith(swift.url)
                 LOG.debug('_env_path_is_object %s: %s' % (env_path, retval))
                 return retval
 
-            def _object_request(method, url, token=context.auth_token):
-                return requests.request(
-                    method, url, headers={'X-Auth-Token': token}).content
-
             template_files, template = template_utils.get_template_contents(
                 template_object=template_object,
-                object_request=_object_request)
+                object_request=self.plan_files.object_request)
 
             env_files, env = (
                 template_utils.process_multiple_environments_and_files(
                     env_paths=env_paths,
                     env_path_is_object=_env_path_is_object,
-                    object_request=_object_request))
+                    object_request=self.plan_files.object_request))
 
         except Exception as err:
             error_text = six.text_type(err)
             LOG.exception("Error occurred while processing plan files.")
-        finally:
-            # cleanup any local temp files
-            for f in temp_files:
-                os.remove(f)
 
         if error_text:
             return actions.Result(error=error_text)
@@ -29,6 +29,12 @@ OVERCLOUD_J2_NETWORKS_NAME = "network_data.yaml"
 #: The name of custom roles excl file used when rendering the jinja template.
 OVERCLOUD_J2_EXCLUDES = "j2_excludes.yaml"
 
+#: The name of the file recording the inputs of the rendered jinja templates.
+OVERCLOUD_J2_RENDER_MANIFEST = "j2_render_manifest.json"
+
+#: The name of the file listing the template files uploaded by the last sync.
+TEMPLATES_SYNC_MANIFEST = "templates_sync_manifest.json"
+
 #: The name of the type for resource groups.
 RESOURCE_GROUP_TYPE = 'OS::Heat::ResourceGroup'
 
@@ -52,6 +58,14 @@ DEFAULT_VALIDATIONS_PATH = \
 # Swift via SwiftPlanStorageBackend to identify them from other containers
 TRIPLEO_META_USAGE_KEY = 'x-container-meta-usage-tripleo'
 
+# PLAN_GENERATION_KEY is the plan container metadata holding the generation of
+# the plan. It is increased every time the plan is changed.
+PLAN_GENERATION_KEY = 'x-container-meta-tripleo-plan-generation'
+
+# CACHE_GENERATION_KEY is the cache object metadata holding the generation of
+# the plan the cached data was computed against.
+CACHE_GENERATION_KEY = 'x-object-meta-tripleo-plan-generation'
+
 #: List of names of parameters that contain passwords
 PASSWORD_PARAMETER_NAMES = (
     'AdminPassword',
@@ -121,9 +135,92 @@ DEFAULT_VOLUME_API_VERSION = '3'
 # import/export
 PLAN_ENVIRONMENT = 'plan-environment.yaml'
 
+# The sections of the plan environment stored in their own objects, so they
+# can be changed without rewriting the whole plan environment
+PLAN_ENVIRONMENT_SECTIONS = {
+    'parameter_defaults': 'plan-environment-parameters.yaml',
+    'passwords': 'plan-environment-passwords.yaml',
+}
+
+# The key of the plan environment listing the sections stored separately
+PLAN_ENVIRONMENT_SECTIONS_KEY = 'separate_sections'
+
 DEFAULT_DEPLOY_KERNEL_NAME = 'bm-deploy-kernel'
 
 DEFAULT_DEPLOY_RAMDISK_NAME = 'bm-deploy-ramdisk'
 
+# The name of the in-memory objects holding the inline environments of a plan
+# while its templates are processed
+VIRTUAL_ENVIRONMENT_NAME = '.tripleo-environment-%s.yaml'
+
 # The name for the swift container to host the cache for tripleo
 TRIPLEO_CACHE_CONTAINER = "__cache__"
+
+# CACHE_CODEC_KEY is the cache object metadata holding the name of the codec
+# the object was encoded with. Objects without it were encoded with
+# LEGACY_CACHE_CODEC.
+CACHE_CODEC_KEY = 'x-object-meta-tripleo-cache-codec'
+
+# The codec used to encode the objects stored in TRIPLEO_CACHE_CONTAINER
+DEFAULT_CACHE_CODEC = 'msgpack+zlib'
+
+LEGACY_CACHE_CODEC = 'json+zlib'
+
+# The zlib compression level of the objects stored in TRIPLEO_CACHE_CONTAINER
+CACHE_COMPRESSLEVEL = 1
+
+# The maximum size, in bytes of serialized data, of the in-process cache kept
+# in front of TRIPLEO_CACHE_CONTAINER
+LOCAL_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+# The number of seconds the objects stored in TRIPLEO_CACHE_CONTAINER under
+# the digest of their inputs are kept
+DIGEST_CACHE_TTL = 24 * 60 * 60
+
+# The maximum size, in bytes, of the plan files kept in process between the
+# prefetches of the plan containers
+PLAN_FILES_CACHE_MAX_SIZE = 128 * 1024 * 1024
+
+# The maximum number of service clients kept for reuse between actions
+CLIENT_REGISTRY_MAX_SIZE = 256
+
+# The maximum number of idle connections kept for reuse by the clients which
+# can't be shared between threads, such as the swift clients
+CLIENT_POOL_MAX_IDLE = 8
+
+# The number of seconds the endpoints found in the service catalog are reused
+ENDPOINT_CACHE_TTL = 300
+
+# The maximum number of parsed plan environments cached in process
+ENV_CACHE_MAX_SIZE = 32
+
+# The object of the plan container locking the plan environment while it is
+# updated
+PLAN_ENVIRONMENT_LOCK = 'plan-environment.lock'
+
+# The number of seconds after which a lock of the plan environment which
+# wasn't released expires
+ENV_LOCK_TTL = 30
+
+# The number of times taking the lock of the plan environment is tried again
+# while another update holds it, and the number of seconds between the tries
+ENV_UPDATE_RETRIES = 60
+ENV_LOCK_RETRY_DELAY = 0.5
+
+# The number of seconds the list of the plans of an account is cached in
+# process
+PLAN_LIST_CACHE_TTL = 10
+
+# The gzip compression level of the tarballs uploaded to and exported from
+# Swift. Lower levels trade a larger upload for less CPU time.
+DEFAULT_TARBALL_COMPRESSLEVEL = 6
+
+# The maximum number of concurrent requests issued to Swift by a single action
+DEFAULT_SWIFT_WORKERS = 8
+
+# The default number of jinja2 templates rendered and stored concurrently when
+# processing a plan
+DEFAULT_J2_RENDER_WORKERS = 8
+
+# The default number of nodes registered or updated concurrently in Ironic
+DEFAULT_NODE_REGISTRATION_WORKERS = 8
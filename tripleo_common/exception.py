@@ -74,6 +74,17 @@ class InvalidNode(ValueError):
         super(InvalidNode, self).__init__(message)
 
 
+class NodeRegistrationError(Exception):
+    """Registering or updating some of the nodes failed"""
+
+    def __init__(self, errors):
+        # the (index in the nodes list, exception) of each failed node
+        self.errors = errors
+        message = '\n'.join('node #%d: %s' % (index, err)
+                            for index, err in errors)
+        super(NodeRegistrationError, self).__init__(message)
+
+
 class Timeout(Exception):
     """An operation timed out"""
 
@@ -108,6 +119,15 @@ class PlanOperationError(Exception):
     """Error while performing a deployment plan operation"""
 
 
+class PlanEnvironmentReadError(Exception):
+    """The environment of a plan couldn't be read"""
+
+    def __init__(self, error):
+        # the swift error the environment couldn't be read with
+        self.error = error
+        super(PlanEnvironmentReadError, self).__init__(six.text_type(error))
+
+
 class DeriveParamsError(Exception):
     """Error while performing a derive parameters operation"""
 
@@ -15,7 +15,9 @@
 import zlib
 
 import mock
+import msgpack
 
+from heatclient import exc as heat_exc
 from ironicclient.v1 import client as ironicclient
 from mistral.utils.openstack import keystone as keystone_utils
 
@@ -31,6 +33,10 @@ class TestActionsBase(tests_base.TestCase):
     def setUp(self):
         super(TestActionsBase, self).setUp()
         self.action = base.TripleOAction()
+        self.addCleanup(base._local_cache.clear)
+        self.addCleanup(base._clients.clear)
+        self.addCleanup(base._endpoints.invalidate)
+        self.addCleanup(base._heat_build_info.clear)
 
     @mock.patch.object(ironicclient, 'Client')
     def test__get_baremetal_client(self, mock_client, mock_endpoint):
@@ -44,6 +50,53 @@ class TestActionsBase(tests_base.TestCase):
         mock_endpoint.assert_called_once_with('ironic')
         mock_cxt.assert_not_called()
 
+    @mock.patch.object(ironicclient, 'Client')
+    def test__get_baremetal_client_reused(self, mock_client, mock_endpoint):
+        mock_cxt = mock.MagicMock(expires_at=None)
+        mock_endpoint.return_value = mock.Mock(
+            url='http://ironic/v1', region='ironic-region')
+
+        self.assertIs(self.action.get_baremetal_client(mock_cxt),
+                      base.TripleOAction().get_baremetal_client(mock_cxt))
+        mock_client.assert_called_once()
+
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_get_object_client(self, mock_conn, mock_endpoint):
+        mock_endpoint.return_value = mock.Mock(
+            url='http://swift/v1/AUTH_%(tenant_id)s')
+        mock_cxt = mock.MagicMock(project_id='project', auth_token='token',
+                                  expires_at=None)
+
+        swift = self.action.get_object_client(mock_cxt)
+        self.assertIs(swift,
+                      base.TripleOAction().get_object_client(mock_cxt))
+        self.assertEqual('http://swift/v1/AUTH_project', swift.url)
+        self.assertEqual('token', swift.token)
+        mock_conn.assert_not_called()
+
+        swift.get_object('container', 'a')
+        swift.get_object('container', 'b')
+        # the connection is returned to the pool after each request
+        mock_conn.assert_called_once_with(
+            preauthurl='http://swift/v1/AUTH_project', preauthtoken='token',
+            retries=10, starting_backoff=3, max_backoff=120)
+        self.assertEqual(2, mock_conn.return_value.get_object.call_count)
+
+    @mock.patch("tripleo_common.actions.base.nova_client")
+    def test_get_compute_client_endpoints(self, mock_nova, mock_endpoint):
+        mock_endpoint.return_value = mock.Mock(
+            url='http://endpoint/v2', region='regionOne')
+        mock_cxt = mock.MagicMock(project_id='project', expires_at=None)
+
+        self.action.get_compute_client(mock_cxt)
+        self.action.get_compute_client(mock.MagicMock(project_id='project',
+                                                      expires_at=None))
+
+        self.assertEqual(2, mock_nova.call_count)
+        mock_endpoint.assert_has_calls([mock.call('keystone'),
+                                        mock.call('nova')])
+        self.assertEqual(2, mock_endpoint.call_count)
+
     def test_cache_key(self, mock_endpoint):
         container = "TestContainer"
         key = "testkey"
@@ -58,26 +111,49 @@ class TestActionsBase(tests_base.TestCase):
     def test_cache_set(self, mock_conn, mock_endpoint):
         mock_ctx = mock.Mock()
         mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
         mock_conn.return_value = mock_swift
 
         cache_container = "__cache__"
         container = "TestContainer"
         key = "testkey"
         cache_key = "__cache_TestContainer_testkey"
-        compressed_json = zlib.compress("{\"foo\": 1}".encode())
+        compressed = zlib.compress(msgpack.packb({"foo": 1}), 1)
 
         self.action.cache_set(mock_ctx, container, key, {"foo": 1})
         mock_swift.put_object.assert_called_once_with(
             cache_container,
             cache_key,
-            compressed_json
+            compressed,
+            headers={'x-object-meta-tripleo-plan-generation': '5',
+                     'x-object-meta-tripleo-cache-codec': 'msgpack+zlib'}
         )
+        mock_swift.head_container.assert_called_once_with(container)
         mock_swift.delete_object.assert_not_called()
 
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_cache_set_no_container(self, mock_conn, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
+        mock_conn.return_value = mock_swift
+        mock_swift.put_object.side_effect = [
+            ClientException("Foo", http_status=404), 'etag']
+
+        self.action.cache_set(mock_ctx, "TestContainer", "testkey",
+                              {"foo": 1})
+
+        mock_swift.put_container.assert_called_once_with("__cache__")
+        self.assertEqual(2, mock_swift.put_object.call_count)
+
     @mock.patch("tripleo_common.actions.base.swift_client.Connection")
     def test_cache_set_none(self, mock_conn, mock_endpoint):
         mock_ctx = mock.Mock()
         mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
         mock_conn.return_value = mock_swift
 
         cache_container = "__cache__"
@@ -96,20 +172,204 @@ class TestActionsBase(tests_base.TestCase):
     def test_cache_get_filled(self, mock_conn, mock_endpoint):
         mock_ctx = mock.Mock()
         mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
         mock_conn.return_value = mock_swift
 
         container = "TestContainer"
         key = "testkey"
         compressed_json = zlib.compress("{\"foo\": 1}".encode())
         # test if cache has something in it
-        mock_swift.get_object.return_value = ([], compressed_json)
+        mock_swift.get_object.return_value = (
+            {'x-object-meta-tripleo-plan-generation': '5'}, compressed_json)
         result = self.action.cache_get(mock_ctx, container, key)
         self.assertEqual(result, {"foo": 1})
 
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_cache_get_codec(self, mock_conn, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
+        mock_conn.return_value = mock_swift
+
+        mock_swift.get_object.return_value = (
+            {'x-object-meta-tripleo-plan-generation': '5',
+             'x-object-meta-tripleo-cache-codec': 'msgpack+zlib'},
+            zlib.compress(msgpack.packb({"foo": [1, "bar"]})))
+        result = self.action.cache_get(mock_ctx, "TestContainer", "testkey")
+        self.assertEqual({"foo": [1, "bar"]}, result)
+
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_cache_get_invalid(self, mock_conn, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
+        mock_conn.return_value = mock_swift
+
+        mock_swift.get_object.return_value = (
+            {'x-object-meta-tripleo-plan-generation': '5',
+             'x-object-meta-tripleo-cache-codec': 'unknown'},
+            zlib.compress(msgpack.packb({"foo": 1})))
+        self.assertIsNone(
+            self.action.cache_get(mock_ctx, "TestContainer", "testkey"))
+        mock_swift.delete_object.assert_called_once_with(
+            "__cache__", "__cache_TestContainer_testkey")
+
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_cache_lookup_then_set(self, mock_conn, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
+        mock_swift.get_object.side_effect = ClientException(
+            "Foo", http_status=404)
+        mock_conn.return_value = mock_swift
+
+        self.assertEqual((None, 5), self.action.cache_lookup(
+            mock_ctx, "TestContainer", "testkey"))
+        # the plan changes while the value is computed
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '6'}
+        self.action.cache_set(mock_ctx, "TestContainer", "testkey",
+                              {"foo": 1}, generation=5)
+
+        mock_swift.head_container.assert_called_once_with("TestContainer")
+        mock_swift.put_object.assert_called_once_with(
+            "__cache__", "__cache_TestContainer_testkey", mock.ANY,
+            headers={'x-object-meta-tripleo-plan-generation': '5',
+                     'x-object-meta-tripleo-cache-codec': 'msgpack+zlib'})
+        self.assertIsNone(
+            self.action.cache_get(mock_ctx, "TestContainer", "testkey"))
+
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_cache_get_stale(self, mock_conn, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '6'}
+        mock_conn.return_value = mock_swift
+
+        compressed_json = zlib.compress("{\"foo\": 1}".encode())
+        mock_swift.get_object.return_value = (
+            {'x-object-meta-tripleo-plan-generation': '5'}, compressed_json)
+        result = self.action.cache_get(mock_ctx, "TestContainer", "testkey")
+        self.assertIsNone(result)
+        mock_swift.delete_object.assert_not_called()
+
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_cache_get_local(self, mock_conn, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
+        mock_conn.return_value = mock_swift
+
+        container = "TestContainer"
+        key = "testkey"
+        compressed_json = zlib.compress("{\"foo\": 1}".encode())
+        mock_swift.get_object.return_value = (
+            {'x-object-meta-tripleo-plan-generation': '5'}, compressed_json)
+
+        self.assertEqual(self.action.cache_get(mock_ctx, container, key),
+                         {"foo": 1})
+        self.assertEqual(self.action.cache_get(mock_ctx, container, key),
+                         {"foo": 1})
+        mock_swift.get_object.assert_called_once_with(
+            "__cache__", "__cache_TestContainer_testkey")
+
+        # the plan changed, the stored object is stale
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '6'}
+        self.assertIsNone(self.action.cache_get(mock_ctx, container, key))
+        self.assertEqual(2, mock_swift.get_object.call_count)
+
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_digest_cache_set(self, mock_conn, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_swift = mock.Mock()
+        mock_conn.return_value = mock_swift
+
+        self.action.digest_cache_set(mock_ctx, "testkey", "abc", {"foo": 1})
+        mock_swift.put_object.assert_called_once_with(
+            "__cache__", "__digest_testkey_abc",
+            zlib.compress(msgpack.packb({"foo": 1}), 1),
+            headers={'X-Delete-After': '86400',
+                     'x-object-meta-tripleo-cache-codec': 'msgpack+zlib'})
+
+        # served from the in-process cache
+        self.assertEqual({"foo": 1}, self.action.digest_cache_get(
+            mock_ctx, "testkey", "abc"))
+        mock_swift.get_object.assert_not_called()
+
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_digest_cache_get(self, mock_conn, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_swift = mock.Mock()
+        mock_conn.return_value = mock_swift
+        mock_swift.get_object.return_value = (
+            {}, zlib.compress("{\"foo\": 1}".encode()))
+
+        self.assertEqual({"foo": 1}, self.action.digest_cache_get(
+            mock_ctx, "testkey", "abc"))
+        self.assertEqual({"foo": 1}, self.action.digest_cache_get(
+            mock_ctx, "testkey", "abc"))
+        mock_swift.get_object.assert_called_once_with(
+            "__cache__", "__digest_testkey_abc")
+        # the digest cache doesn't depend on any plan
+        mock_swift.head_container.assert_not_called()
+
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_digest_cache_get_missing(self, mock_conn, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_swift = mock.Mock()
+        mock_conn.return_value = mock_swift
+        mock_swift.get_object.side_effect = ClientException(
+            'Not Found', http_status=404)
+
+        self.assertIsNone(self.action.digest_cache_get(
+            mock_ctx, "testkey", "abc"))
+
+    @mock.patch("tripleo_common.actions.base.heatclient.Client")
+    def test_get_orchestration_identity(self, mock_heat, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_endpoint.return_value = mock.Mock(
+            url='http://heat/v1/%(tenant_id)s')
+        mock_heat.return_value.build_info.build_info.return_value = {
+            'engine': {'revision': '1'}}
+
+        expected = {'endpoint': 'http://heat/v1/%(tenant_id)s',
+                    'build_info': {'engine': {'revision': '1'}}}
+        self.assertEqual(expected,
+                         self.action.get_orchestration_identity(mock_ctx))
+        self.assertEqual(expected,
+                         self.action.get_orchestration_identity(mock_ctx))
+        # fetched once per process
+        mock_heat.return_value.build_info.build_info.assert_called_once_with()
+
+    @mock.patch("tripleo_common.actions.base.heatclient.Client")
+    def test_get_orchestration_identity_error(self, mock_heat, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_endpoint.return_value = mock.Mock(url='http://heat/v1')
+        build_info = mock_heat.return_value.build_info.build_info
+        build_info.side_effect = [heat_exc.HTTPInternalServerError(),
+                                  {'engine': {'revision': '1'}}]
+
+        self.assertEqual({'endpoint': 'http://heat/v1', 'build_info': {}},
+                         self.action.get_orchestration_identity(mock_ctx))
+        # the failure isn't remembered
+        self.assertEqual({'endpoint': 'http://heat/v1',
+                          'build_info': {'engine': {'revision': '1'}}},
+                         self.action.get_orchestration_identity(mock_ctx))
+        self.assertEqual(2, build_info.call_count)
+
     @mock.patch("tripleo_common.actions.base.swift_client.Connection")
     def test_cache_empty(self, mock_conn, mock_endpoint):
         mock_ctx = mock.Mock()
         mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
         mock_conn.return_value = mock_swift
 
         cache_container = "__cache__"
@@ -134,6 +394,8 @@ class TestActionsBase(tests_base.TestCase):
     def test_cache_delete(self, mock_conn, mock_endpoint):
         mock_ctx = mock.Mock()
         mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
         mock_conn.return_value = mock_swift
 
         cache_container = "__cache__"
@@ -148,3 +410,19 @@ class TestActionsBase(tests_base.TestCase):
             cache_container,
             cache_key
         )
+
+    @mock.patch("time.time")
+    @mock.patch("tripleo_common.actions.base.swift_client.Connection")
+    def test_cache_invalidate(self, mock_conn, mock_time, mock_endpoint):
+        mock_ctx = mock.Mock()
+        mock_swift = mock.Mock()
+        mock_swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '5'}
+        mock_conn.return_value = mock_swift
+        mock_time.return_value = 0
+
+        self.action.cache_invalidate(mock_ctx, "TestContainer")
+        mock_swift.post_container.assert_called_once_with(
+            "TestContainer",
+            {'x-container-meta-tripleo-plan-generation': '6'})
+        mock_swift.delete_object.assert_not_called()
@@ -260,16 +260,20 @@ class DeployStackActionTest(base.TestCase):
         mock_env_updated = yaml.safe_dump({
             'name': 'overcloud',
             'temp_environment': 'temp_environment',
-            'parameter_defaults': expected_defaults,
+            'separate_sections': ['parameter_defaults'],
             'template': 'template',
             'environments': [{u'path': u'environments/test.yaml'}]
         }, default_flow_style=False)
 
-        swift.put_object.assert_called_once_with(
-            'overcloud',
-            constants.PLAN_ENVIRONMENT,
-            mock_env_updated
-        )
+        self.assertEqual([
+            mock.call('overcloud', 'plan-environment.lock', '',
+                      headers=mock.ANY),
+            mock.call('overcloud', 'plan-environment-parameters.yaml',
+                      yaml.safe_dump(expected_defaults,
+                                     default_flow_style=False)),
+            mock.call('overcloud', constants.PLAN_ENVIRONMENT,
+                      mock_env_updated)
+        ], swift.put_object.call_args_list)
 
         heat.stacks.create.assert_called_once_with(
             environment={},
@@ -278,8 +282,10 @@ class DeployStackActionTest(base.TestCase):
             template={'heat_template_version': '2016-04-30'},
             timeout_mins=1,
         )
-        swift.delete_object.assert_called_once_with(
-            "overcloud-swift-rings", "swift-rings.tar.gz")
+        self.assertEqual([
+            mock.call('overcloud', constants.PLAN_ENVIRONMENT_LOCK),
+            mock.call("overcloud-swift-rings", "swift-rings.tar.gz"),
+        ], swift.delete_object.call_args_list)
         swift.copy_object.assert_called_once_with(
             "overcloud-swift-rings", "swift-rings.tar.gz",
             "overcloud-swift-rings/swift-rings.tar.gz-%d" % 1473366264)
@@ -335,18 +341,24 @@ class DeployStackActionTest(base.TestCase):
         mock_env_updated = yaml.safe_dump({
             'name': constants.DEFAULT_CONTAINER_NAME,
             'temp_environment': 'temp_environment',
-            'parameter_defaults': {'StackAction': 'CREATE',
-                                   'UpdateIdentifier': '',
-                                   'random_existing_data': 'a_value'},
+            'separate_sections': ['parameter_defaults'],
             'template': 'template',
             'environments': [{u'path': u'environments/test.yaml'}]
         }, default_flow_style=False)
 
-        swift.put_object.assert_called_once_with(
-            constants.DEFAULT_CONTAINER_NAME,
-            constants.PLAN_ENVIRONMENT,
-            mock_env_updated
-        )
+        self.assertEqual([
+            mock.call(constants.DEFAULT_CONTAINER_NAME,
+                      constants.PLAN_ENVIRONMENT_LOCK, '', headers=mock.ANY),
+            mock.call(constants.DEFAULT_CONTAINER_NAME,
+                      'plan-environment-parameters.yaml',
+                      yaml.safe_dump({'StackAction': 'CREATE',
+                                      'UpdateIdentifier': '',
+                                      'random_existing_data': 'a_value'},
+                                     default_flow_style=False)),
+            mock.call(constants.DEFAULT_CONTAINER_NAME,
+                      constants.PLAN_ENVIRONMENT,
+                      mock_env_updated)
+        ], swift.put_object.call_args_list)
 
         heat.stacks.create.assert_called_once_with(
             environment={},
@@ -355,8 +367,10 @@ class DeployStackActionTest(base.TestCase):
             template={'heat_template_version': '2016-04-30'},
             timeout_mins=1,
         )
-        swift.delete_object.assert_called_once_with(
-            "overcloud-swift-rings", "swift-rings.tar.gz")
+        self.assertEqual([
+            mock.call('overcloud', constants.PLAN_ENVIRONMENT_LOCK),
+            mock.call("overcloud-swift-rings", "swift-rings.tar.gz"),
+        ], swift.delete_object.call_args_list)
         swift.copy_object.assert_called_once_with(
             "overcloud-swift-rings", "swift-rings.tar.gz",
             "overcloud-swift-rings/swift-rings.tar.gz-%d" % 1473366264)
@@ -232,7 +232,7 @@ class UpdateCapabilitiesActionTest(base.TestCase):
         self.container_name = 'test-container'
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_delete')
+                'cache_invalidate')
     @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
     def test_run(self, get_object_client_mock, mock_cache):
 
@@ -248,6 +248,9 @@ class UpdateCapabilitiesActionTest(base.TestCase):
         """
         swift.get_object.return_value = ({}, mocked_env)
         get_object_client_mock.return_value = swift
+        # the cache is invalidated once the environment is stored
+        mock_cache.side_effect = lambda *args: self.assertTrue(
+            swift.put_object.called)
 
         environments = {
             '/path/to/ceph-storage-env.yaml': False,
@@ -265,14 +268,10 @@ class UpdateCapabilitiesActionTest(base.TestCase):
             ]},
             action.run(mock_ctx))
 
-        mock_cache.assert_called_once_with(
-            mock_ctx,
-            self.container_name,
-            "tripleo.parameters.get"
-        )
+        mock_cache.assert_called_once_with(mock_ctx, self.container_name)
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_delete')
+                'cache_invalidate')
     @mock.patch(
         'tripleo_common.actions.base.TripleOAction.get_object_client')
     def test_run_purge_missing(self, get_object_client_mock, mock_cache):
@@ -305,11 +304,7 @@ class UpdateCapabilitiesActionTest(base.TestCase):
                 {'path': '/path/to/poc-custom-env.yaml'}
             ]},
             action.run(mock_ctx))
-        mock_cache.assert_called_once_with(
-            mock_ctx,
-            self.container_name,
-            "tripleo.parameters.get"
-        )
+        mock_cache.assert_called_once_with(mock_ctx, self.container_name)
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
     def test_run_env_missing(self, get_obj_client_mock):
@@ -107,20 +107,27 @@ template: template
         action.run(mock_ctx)
 
         # verify parameters are as expected
+        updated_mock_params = """DeployIdentifier: 1473366264
+StackAction: UPDATE
+UpdateIdentifier: 1473366264
+random_data: a_value
+"""
         updated_mock_env = """environments:
 - path: environments/test.yaml
 name: container
-parameter_defaults:
-  DeployIdentifier: 1473366264
-  StackAction: UPDATE
-  UpdateIdentifier: 1473366264
-  random_data: a_value
+separate_sections:
+- parameter_defaults
 temp_environment: temp_environment
 template: template
 """
-        mock_swift.put_object.assert_called_once_with(
-            self.container, constants.PLAN_ENVIRONMENT, updated_mock_env
-        )
+        self.assertEqual([
+            mock.call(self.container, 'plan-environment.lock', '',
+                      headers=mock.ANY),
+            mock.call(self.container, 'plan-environment-parameters.yaml',
+                      updated_mock_params),
+            mock.call(self.container, constants.PLAN_ENVIRONMENT,
+                      updated_mock_env)
+        ], mock_swift.put_object.call_args_list)
 
         heat.stacks.update.assert_called_once_with(
             'stack_id',
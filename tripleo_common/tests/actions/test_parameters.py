@@ -12,16 +12,25 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import hashlib
 import mock
+import os
+import shutil
+import tempfile
 import yaml
 
+from mistral_lib import actions
 from swiftclient import exceptions as swiftexceptions
 
+from tripleo_common.actions import base as base_actions
 from tripleo_common.actions import parameters
+from tripleo_common.actions import templates
 from tripleo_common import constants
 from tripleo_common import exception
 from tripleo_common.tests import base
+from tripleo_common.utils import cache as cache_utils
 from tripleo_common.utils import passwords as password_utils
+from tripleo_common.utils import plan as plan_utils
 
 _EXISTING_PASSWORDS = {
     'MistralPassword': 'VFJeqBKbatYhQm9jja67hufft',
@@ -145,10 +154,24 @@ _EXISTING_PASSWORDS = {
 
 class GetParametersActionTest(base.TestCase):
 
+    def setUp(self):
+        super(GetParametersActionTest, self).setUp()
+        self.heat_identity = {'endpoint': 'http://heat',
+                              'build_info': {'engine': {'revision': '1'}}}
+        patcher = mock.patch('tripleo_common.actions.base.TripleOAction.'
+                             'get_orchestration_identity',
+                             return_value=self.heat_identity)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'digest_cache_set')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'digest_cache_get', return_value=None)
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
                 'cache_set')
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_get')
+                'cache_lookup')
     @mock.patch('heatclient.common.template_utils.'
                 'process_multiple_environments_and_files')
     @mock.patch('heatclient.common.template_utils.get_template_contents')
@@ -159,8 +182,10 @@ class GetParametersActionTest(base.TestCase):
                  mock_get_orchestration_client,
                  mock_get_template_contents,
                  mock_process_multiple_environments_and_files,
-                 mock_cache_get,
-                 mock_cache_set):
+                 mock_cache_lookup,
+                 mock_cache_set,
+                 mock_digest_cache_get,
+                 mock_digest_cache_set):
 
         mock_ctx = mock.MagicMock()
         swift = mock.MagicMock(url="http://test.com")
@@ -185,7 +210,7 @@ class GetParametersActionTest(base.TestCase):
         mock_heat.stacks.validate.return_value = {}
         mock_get_orchestration_client.return_value = mock_heat
 
-        mock_cache_get.return_value = None
+        mock_cache_lookup.return_value = (None, 5)
         # Test
         action = parameters.GetParametersAction()
         action.run(mock_ctx)
@@ -195,23 +220,169 @@ class GetParametersActionTest(base.TestCase):
             show_nested=True,
             template={'heat_template_version': '2016-04-30'},
         )
-        mock_cache_get.assert_called_once_with(
+        mock_cache_lookup.assert_called_once_with(
             mock_ctx,
             "overcloud",
             "tripleo.parameters.get"
         )
+        # stored against the generation read before computing it
         mock_cache_set.assert_called_once_with(
             mock_ctx,
             "overcloud",
             "tripleo.parameters.get",
-            {'heat_resource_tree': {}, 'environment_parameters': None}
+            {'heat_resource_tree': {}, 'environment_parameters': None},
+            generation=5
         )
+        digest = cache_utils.digest({
+            'heat': self.heat_identity,
+            'fields': {
+                'template': {'heat_template_version': '2016-04-30'},
+                'files': {},
+                'environment': {},
+                'show_nested': True,
+            },
+        })
+        mock_digest_cache_get.assert_called_once_with(
+            mock_ctx, "tripleo.parameters.validate", digest)
+        mock_digest_cache_set.assert_called_once_with(
+            mock_ctx, "tripleo.parameters.validate", digest, {})
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'digest_cache_set')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'digest_cache_get')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'cache_set')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'cache_lookup', return_value=(None, 5))
+    @mock.patch('heatclient.common.template_utils.'
+                'process_multiple_environments_and_files')
+    @mock.patch('heatclient.common.template_utils.get_template_contents')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'get_orchestration_client')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_run_validated_tree_cached(
+            self, mock_get_object_client, mock_get_orchestration_client,
+            mock_get_template_contents,
+            mock_process_multiple_environments_and_files, mock_cache_lookup,
+            mock_cache_set, mock_digest_cache_get, mock_digest_cache_set):
+
+        mock_ctx = mock.MagicMock()
+        swift = mock.MagicMock(url="http://test.com")
+        mock_env = yaml.safe_dump({
+            'temp_environment': 'temp_environment',
+            'template': 'template',
+            'environments': [{u'path': u'environments/test.yaml'}]
+        }, default_flow_style=False)
+        swift.get_object.side_effect = (
+            ({}, mock_env),
+            swiftexceptions.ClientException('atest2'),
+            ({}, mock_env)
+        )
+        mock_get_object_client.return_value = swift
+
+        mock_get_template_contents.return_value = ({}, {
+            'heat_template_version': '2016-04-30'
+        })
+        mock_process_multiple_environments_and_files.return_value = ({}, {})
+
+        mock_heat = mock.MagicMock()
+        mock_get_orchestration_client.return_value = mock_heat
+        mock_digest_cache_get.return_value = {'resources': {}}
+
+        # Test
+        action = parameters.GetParametersAction()
+        result = action.run(mock_ctx)
+
+        mock_heat.stacks.validate.assert_not_called()
+        mock_digest_cache_set.assert_not_called()
+        self.assertEqual({'resources': {}}, result['heat_resource_tree'])
+
+    @mock.patch('tripleo_common.utils.tarball.'
+                'directory_extract_to_swift_container')
+    @mock.patch('tripleo_common.actions.templates.ProcessTemplatesAction.run')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'get_orchestration_client')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_run_after_template_upload(self, mock_get_object_client,
+                                       mock_get_orchestration_client,
+                                       mock_process_templates,
+                                       mock_extract_dir):
+        self.addCleanup(base_actions._local_cache.clear)
+        self.addCleanup(plan_utils._env_cache.clear)
+        templates_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, templates_path)
+        with open(os.path.join(templates_path, 'overcloud.yaml'), 'w') as f:
+            f.write('changed')
+
+        # a minimal swift, storing the objects and the container metadata
+        objects = {
+            ('overcloud', 'overcloud.yaml'): b'previous',
+            ('overcloud', constants.PLAN_ENVIRONMENT): yaml.safe_dump({
+                'template': 'overcloud.yaml',
+                'parameter_defaults': {'Foo': 'bar'}}).encode('utf-8'),
+        }
+        metadata = {}
+
+        def get_object(container, name, headers=None):
+            try:
+                contents = objects[(container, name)]
+            except KeyError:
+                raise swiftexceptions.ClientException('not found',
+                                                      http_status=404)
+            return {'etag': hashlib.md5(contents).hexdigest()}, contents
+
+        def put_object(container, name, contents, headers=None):
+            if not isinstance(contents, bytes):
+                contents = contents.encode('utf-8')
+            objects[(container, name)] = contents
+            metadata[(container, name)] = dict(headers or {})
+            return hashlib.md5(contents).hexdigest()
+
+        def get_container(container, full_listing=False):
+            return {}, [{'name': name,
+                         'hash': hashlib.md5(contents).hexdigest()}
+                        for (c, name), contents in objects.items()
+                        if c == container]
+
+        swift = mock.MagicMock(url="http://test.com")
+        swift.get_object.side_effect = get_object
+        swift.put_object.side_effect = put_object
+        swift.get_container.side_effect = get_container
+        swift.head_container.side_effect = lambda c: dict(
+            metadata.get(c, {}))
+        swift.post_container.side_effect = (
+            lambda c, headers: metadata.setdefault(c, {}).update(headers))
+        mock_get_object_client.return_value = swift
+        mock_get_orchestration_client.return_value.stacks.validate.\
+            return_value = {'resources': {}}
+        mock_process_templates.return_value = {
+            'template': {}, 'files': {}, 'environment': {}}
+
+        mock_ctx = mock.MagicMock()
+        action = parameters.GetParametersAction()
+        action.run(mock_ctx)
+        action.run(mock_ctx)
+        # the second run is served from the cache
+        self.assertEqual(1, mock_process_templates.call_count)
+
+        # a template which isn't rendered with jinja2 changes
+        templates.UploadTemplatesAction(
+            container='overcloud', templates_path=templates_path,
+            sync=True).run(mock_ctx)
+        mock_extract_dir.assert_called_once_with(
+            swift, templates_path, 'overcloud',
+            constants.DEFAULT_TARBALL_COMPRESSLEVEL,
+            names=['overcloud.yaml'])
+
+        action.run(mock_ctx)
+        self.assertEqual(2, mock_process_templates.call_count)
 
 
 class ResetParametersActionTest(base.TestCase):
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_delete')
+                'cache_invalidate')
     @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
     def test_run(self, mock_get_object_client, mock_cache):
 
@@ -238,22 +409,19 @@ class ResetParametersActionTest(base.TestCase):
             'environments': [{u'path': u'environments/test.yaml'}]
         }, default_flow_style=False)
 
-        swift.put_object.assert_called_once_with(
+        swift.put_object.assert_called_with(
             constants.DEFAULT_CONTAINER_NAME,
             constants.PLAN_ENVIRONMENT,
             mock_env_reset
         )
-        mock_cache.assert_called_once_with(
-            mock_ctx,
-            "overcloud",
-            "tripleo.parameters.get"
-        )
+        self.assertEqual(2, swift.put_object.call_count)
+        mock_cache.assert_called_once_with(mock_ctx, "overcloud")
 
 
 class UpdateParametersActionTest(base.TestCase):
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_delete')
+                'cache_invalidate')
     @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
     def test_run(self, mock_get_object_client, mock_cache):
 
@@ -277,27 +445,50 @@ class UpdateParametersActionTest(base.TestCase):
         mock_env_updated = yaml.safe_dump({
             'name': constants.DEFAULT_CONTAINER_NAME,
             'temp_environment': 'temp_environment',
-            'parameter_defaults': {'SomeTestParameter': 42},
+            'separate_sections': ['parameter_defaults'],
             'template': 'template',
             'environments': [{u'path': u'environments/test.yaml'}]
         }, default_flow_style=False)
 
-        swift.put_object.assert_called_once_with(
-            constants.DEFAULT_CONTAINER_NAME,
-            constants.PLAN_ENVIRONMENT,
-            mock_env_updated
-        )
-        mock_cache.assert_called_once_with(
-            mock_ctx,
-            "overcloud",
-            "tripleo.parameters.get"
-        )
+        self.assertEqual([
+            mock.call(constants.DEFAULT_CONTAINER_NAME,
+                      constants.PLAN_ENVIRONMENT_LOCK, '', headers=mock.ANY),
+            mock.call(constants.DEFAULT_CONTAINER_NAME,
+                      'plan-environment-parameters.yaml',
+                      yaml.safe_dump({'SomeTestParameter': 42},
+                                     default_flow_style=False)),
+            mock.call(constants.DEFAULT_CONTAINER_NAME,
+                      constants.PLAN_ENVIRONMENT,
+                      mock_env_updated)
+        ], swift.put_object.call_args_list)
+        mock_cache.assert_called_once_with(mock_ctx, "overcloud")
+        # the environment is only read by the update
+        swift.get_object.assert_called_once_with(
+            constants.DEFAULT_CONTAINER_NAME, constants.PLAN_ENVIRONMENT)
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'cache_invalidate')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_run_missing_plan(self, mock_get_object_client, mock_cache):
+        swift = mock.MagicMock(url="http://test.com")
+        swift.put_object.side_effect = swiftexceptions.ClientException(
+            'Container Not Found', http_status=404)
+        mock_get_object_client.return_value = swift
+
+        action = parameters.UpdateParametersAction({'Foo': 'bar'})
+        result = action.run(mock.MagicMock())
+
+        self.assertEqual(actions.Result(
+            error="Error retrieving environment for plan overcloud: "
+                  "Container Not Found: 404"), result)
+        swift.get_object.assert_not_called()
+        mock_cache.assert_not_called()
 
 
 class UpdateRoleParametersActionTest(base.TestCase):
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_delete')
+                'cache_invalidate')
     @mock.patch('tripleo_common.utils.parameters.set_count_and_flavor_params')
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
                 'get_baremetal_client')
@@ -326,25 +517,77 @@ class UpdateRoleParametersActionTest(base.TestCase):
 
         mock_env_updated = yaml.safe_dump({
             'name': 'overcast',
-            'parameter_defaults': params,
+            'separate_sections': ['parameter_defaults'],
         }, default_flow_style=False)
 
-        swift.put_object.assert_called_once_with(
-            'overcast',
-            constants.PLAN_ENVIRONMENT,
-            mock_env_updated
-        )
-        mock_cache.assert_called_once_with(
-            mock_ctx,
-            "overcast",
-            "tripleo.parameters.get"
-        )
+        self.assertEqual([
+            mock.call('overcast', constants.PLAN_ENVIRONMENT_LOCK, '',
+                      headers=mock.ANY),
+            mock.call('overcast', 'plan-environment-parameters.yaml',
+                      yaml.safe_dump(params, default_flow_style=False)),
+            mock.call('overcast', constants.PLAN_ENVIRONMENT,
+                      mock_env_updated)
+        ], swift.put_object.call_args_list)
+        mock_cache.assert_called_once_with(mock_ctx, "overcast")
+
+
+class PatchParametersActionTest(base.TestCase):
+
+    def setUp(self):
+        super(PatchParametersActionTest, self).setUp()
+        self.swift = mock.MagicMock()
+        self.swift.get_object.return_value = ({}, """
+name: overcloud
+parameter_defaults:
+  Foo: bar
+  Baz: [1, 2]
+""")
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'cache_invalidate')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_run(self, get_obj_client_mock, mock_cache):
+        mock_ctx = mock.MagicMock()
+        get_obj_client_mock.return_value = self.swift
+
+        action = parameters.PatchParametersAction([
+            {'op': 'replace', 'path': '/Foo', 'value': 'qux'},
+            {'op': 'add', 'path': '/Baz/-', 'value': 3},
+        ])
+
+        expected = {'Foo': 'qux', 'Baz': [1, 2, 3]}
+        self.assertEqual(expected, action.run(mock_ctx))
+        self.swift.put_object.assert_any_call(
+            constants.DEFAULT_CONTAINER_NAME,
+            'plan-environment-parameters.yaml',
+            yaml.safe_dump(expected, default_flow_style=False))
+        mock_cache.assert_called_once_with(mock_ctx, "overcloud")
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_run_invalid_patch(self, get_obj_client_mock):
+        mock_ctx = mock.MagicMock()
+        get_obj_client_mock.return_value = self.swift
+
+        action = parameters.PatchParametersAction([
+            {'op': 'remove', 'path': '/Missing'},
+        ])
+
+        result = action.run(mock_ctx)
+        self.assertIsInstance(result, actions.Result)
+        self.assertIn('Error applying patch to the parameters of plan '
+                      'overcloud', result.error)
+        # only the lock was written, and it was released
+        self.swift.put_object.assert_called_once_with(
+            constants.DEFAULT_CONTAINER_NAME, constants.PLAN_ENVIRONMENT_LOCK,
+            '', headers=mock.ANY)
+        self.swift.delete_object.assert_called_once_with(
+            constants.DEFAULT_CONTAINER_NAME, constants.PLAN_ENVIRONMENT_LOCK)
 
 
 class GeneratePasswordsActionTest(base.TestCase):
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_delete')
+                'cache_invalidate')
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
                 'get_orchestration_client')
     @mock.patch('tripleo_common.utils.passwords.'
@@ -382,14 +625,12 @@ class GeneratePasswordsActionTest(base.TestCase):
         for password_param_name in constants.PASSWORD_PARAMETER_NAMES:
             self.assertTrue(password_param_name in result,
                             "%s is not in %s" % (password_param_name, result))
-        mock_cache.assert_called_once_with(
-            mock_ctx,
-            "overcloud",
-            "tripleo.parameters.get"
-        )
+        mock_cache.assert_called_once_with(mock_ctx, "overcloud")
+        # the environment is only read by the update
+        self.assertEqual(1, swift.get_object.call_count)
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_delete')
+                'cache_invalidate')
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
                 'get_orchestration_client')
     @mock.patch('tripleo_common.utils.passwords.'
@@ -439,14 +680,10 @@ class GeneratePasswordsActionTest(base.TestCase):
 
         # ensure old passwords used and no new generation
         self.assertEqual(_EXISTING_PASSWORDS, result)
-        mock_cache.assert_called_once_with(
-            mock_ctx,
-            "overcloud",
-            "tripleo.parameters.get"
-        )
+        mock_cache.assert_called_once_with(mock_ctx, "overcloud")
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_delete')
+                'cache_invalidate')
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
                 'get_orchestration_client')
     @mock.patch('tripleo_common.utils.passwords.'
@@ -502,11 +739,32 @@ class GeneratePasswordsActionTest(base.TestCase):
         existing_passwords["AdminPassword"] = "ExistingPasswordInHeat"
         # ensure old passwords used and no new generation
         self.assertEqual(existing_passwords, result)
-        mock_cache.assert_called_once_with(
-            mock_ctx,
-            "overcloud",
-            "tripleo.parameters.get"
-        )
+        mock_cache.assert_called_once_with(mock_ctx, "overcloud")
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'cache_invalidate')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'get_orchestration_client')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'get_workflow_client')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_run_missing_plan(self, mock_get_object_client,
+                              mock_get_workflow_client,
+                              mock_get_orchestration_client, mock_cache):
+        mock_ctx = mock.MagicMock()
+
+        swift = mock.MagicMock(url="http://test.com")
+        swift.get_object.side_effect = swiftexceptions.ClientException(
+            'atest2')
+        mock_get_object_client.return_value = swift
+
+        action = parameters.GeneratePasswordsAction()
+        result = action.run(mock_ctx)
+
+        self.assertEqual(actions.Result(
+            error="Error retrieving environment for plan overcloud: atest2"),
+            result)
+        mock_cache.assert_not_called()
 
 
 class GetPasswordsActionTest(base.TestCase):
@@ -701,10 +959,24 @@ class GenerateFencingParametersActionTestCase(base.TestCase):
 
 class GetFlattenedParametersActionTest(base.TestCase):
 
+    def setUp(self):
+        super(GetFlattenedParametersActionTest, self).setUp()
+        self.heat_identity = {'endpoint': 'http://heat',
+                              'build_info': {'engine': {'revision': '1'}}}
+        patcher = mock.patch('tripleo_common.actions.base.TripleOAction.'
+                             'get_orchestration_identity',
+                             return_value=self.heat_identity)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'digest_cache_set')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'digest_cache_get', return_value=None)
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
                 'cache_set')
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_get')
+                'cache_lookup')
     @mock.patch('heatclient.common.template_utils.'
                 'process_multiple_environments_and_files')
     @mock.patch('heatclient.common.template_utils.get_template_contents')
@@ -715,11 +987,13 @@ class GetFlattenedParametersActionTest(base.TestCase):
                                  mock_get_orchestration_client,
                                  mock_get_template_contents,
                                  mock_process_multiple_environments_and_files,
-                                 mock_cache_get,
-                                 mock_cache_set):
+                                 mock_cache_lookup,
+                                 mock_cache_set,
+                                 mock_digest_cache_get,
+                                 mock_digest_cache_set):
 
         mock_ctx = mock.MagicMock()
-        mock_cache_get.return_value = None
+        mock_cache_lookup.return_value = (None, 5)
         swift = mock.MagicMock(url="http://test.com")
         mock_env = yaml.safe_dump({
             'temp_environment': 'temp_environment',
@@ -759,11 +1033,14 @@ class GetFlattenedParametersActionTest(base.TestCase):
         )
         self.assertEqual(result, expected_value)
 
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'digest_cache_set')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'digest_cache_get', return_value=None)
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
                 'cache_set')
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_get')
-    @mock.patch('uuid.uuid4', side_effect=['1', '2'])
+                'cache_lookup')
     @mock.patch('heatclient.common.template_utils.'
                 'process_multiple_environments_and_files')
     @mock.patch('heatclient.common.template_utils.get_template_contents')
@@ -774,12 +1051,13 @@ class GetFlattenedParametersActionTest(base.TestCase):
                                  mock_get_orchestration_client,
                                  mock_get_template_contents,
                                  mock_process_multiple_environments_and_files,
-                                 mock_uuid,
-                                 mock_cache_get,
-                                 mock_cache_set):
+                                 mock_cache_lookup,
+                                 mock_cache_set,
+                                 mock_digest_cache_get,
+                                 mock_digest_cache_set):
 
         mock_ctx = mock.MagicMock()
-        mock_cache_get.return_value = None
+        mock_cache_lookup.return_value = (None, 5)
         swift = mock.MagicMock(url="http://test.com")
         mock_env = yaml.safe_dump({
             'temp_environment': 'temp_environment',
@@ -816,21 +1094,23 @@ class GetFlattenedParametersActionTest(base.TestCase):
             }
         }
 
+        root_id = 'daf8e1e3-b6aa-5d1e-a111-a9e06fe86b86'
+        nested_id = '76eeaabc-1ee4-507e-9106-9b9cd089e45e'
         expected_value = {
             'heat_resource_tree': {
                 'resources': {
-                    '1': {
-                        'id': '1',
+                    root_id: {
+                        'id': root_id,
                         'name': 'Root',
                         'resources': [
-                            '2'
+                            nested_id
                         ],
                         'parameters': [
                             'ControllerCount'
                         ]
                     },
-                    '2': {
-                        'id': '2',
+                    nested_id: {
+                        'id': nested_id,
                         'name': 'CephStorageHostsDeployment',
                         'type': 'OS::Heat::StructuredDeployments'
                     }
@@ -850,6 +1130,25 @@ class GetFlattenedParametersActionTest(base.TestCase):
         action = parameters.GetFlattenedParametersAction()
         result = action.run(mock_ctx)
         self.assertEqual(result, expected_value)
+        mock_cache_set.assert_called_with(
+            mock_ctx, "overcloud", "tripleo.parameters.get_flatten",
+            expected_value, generation=5)
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'cache_lookup')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'get_orchestration_client')
+    def test_run_cached(self, mock_get_orchestration_client,
+                        mock_cache_lookup):
+        mock_ctx = mock.MagicMock()
+        cached = {'heat_resource_tree': {}, 'environment_parameters': None}
+        mock_cache_lookup.return_value = (cached, 5)
+
+        action = parameters.GetFlattenedParametersAction()
+        self.assertEqual(cached, action.run(mock_ctx))
+        mock_cache_lookup.assert_called_once_with(
+            mock_ctx, "overcloud", "tripleo.parameters.get_flatten")
+        mock_get_orchestration_client.assert_not_called()
 
 
 class GetProfileOfFlavorActionTest(base.TestCase):
@@ -12,16 +12,18 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import io
 import mock
+import tarfile
 
 from heatclient import exc as heatexceptions
 from mistral_lib import actions
-from oslo_concurrency import processutils
 from swiftclient import exceptions as swiftexceptions
 
 from tripleo_common.actions import plan
 from tripleo_common import exception
 from tripleo_common.tests import base
+from tripleo_common.utils import plan as plan_utils
 
 
 ENV_YAML_CONTENTS = """
@@ -139,22 +141,30 @@ class ListPlansActionTest(base.TestCase):
         self.container = 'overcloud'
         self.ctx = mock.MagicMock()
 
+    @mock.patch('tripleo_common.utils.swift.head_containers')
     @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
-    def test_run(self, get_obj_client_mock):
+    def test_run(self, get_obj_client_mock, mock_head_containers):
 
         # setup swift
-        swift = mock.MagicMock()
+        swift = mock.MagicMock(url='http://swift/v1/AUTH_test')
         swift.get_account.return_value = ({}, [
             {
                 'count': 1,
                 'bytes': 55,
                 'name': 'overcloud'
             },
+            {
+                'count': 3,
+                'bytes': 120,
+                'name': 'overcloud-swift-rings'
+            },
         ])
-        swift.get_container.return_value = ({
-            'x-container-meta-usage-tripleo': 'plan',
-        }, [])
+        mock_head_containers.return_value = {
+            'overcloud': {'x-container-meta-usage-tripleo': 'plan'},
+            'overcloud-swift-rings': {},
+        }
         get_obj_client_mock.return_value = swift
+        self.addCleanup(plan_utils._plan_list_cache.clear)
 
         # Test
         action = plan.ListPlansAction()
@@ -162,8 +172,10 @@ class ListPlansActionTest(base.TestCase):
 
         # verify
         self.assertEqual([self.container], action.run(self.ctx))
-        swift.get_account.assert_called()
-        swift.get_container.assert_called_with(self.container)
+        swift.get_account.assert_called_once_with(full_listing=True)
+        mock_head_containers.assert_called_once_with(
+            swift, ['overcloud', 'overcloud-swift-rings'])
+        swift.get_container.assert_not_called()
 
 
 class DeletePlanActionTest(base.TestCase):
@@ -192,17 +204,17 @@ class DeletePlanActionTest(base.TestCase):
         self.assertRaises(exception.StackInUseError, action.run, self.ctx)
         heat.stacks.get.assert_called_with(self.container_name)
 
+    @mock.patch('tripleo_common.utils.swift.delete_objects')
     @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
     @mock.patch(
         'tripleo_common.actions.base.TripleOAction.get_orchestration_client')
-    def test_run(self, get_orchestration_client, get_obj_client_mock):
+    def test_run(self, get_orchestration_client, get_obj_client_mock,
+                 mock_delete_objects):
 
         # setup swift
         swift = mock.MagicMock()
-        swift.get_account.return_value = ({}, [
-            {'name': self.container_name},
-            {'name': 'test'},
-        ])
+        swift.head_container.return_value = {
+            'x-container-meta-usage-tripleo': 'plan'}
         swift.get_container.return_value = (
             {'x-container-meta-usage-tripleo': 'plan'}, [
                 {'name': 'some-name.yaml'},
@@ -223,14 +235,12 @@ class DeletePlanActionTest(base.TestCase):
         action = plan.DeletePlanAction(self.container_name)
         action.run(self.ctx)
 
-        mock_calls = [
-            mock.call('overcloud', 'some-name.yaml'),
-            mock.call('overcloud', 'some-other-name.yaml'),
-            mock.call('overcloud', 'yet-some-other-name.yaml'),
-            mock.call('overcloud', 'finally-another-name.yaml')
-        ]
-        swift.delete_object.assert_has_calls(
-            mock_calls, any_order=True)
+        mock_delete_objects.assert_called_once_with(swift, 'overcloud', [
+            'some-name.yaml',
+            'some-other-name.yaml',
+            'yet-some-other-name.yaml',
+            'finally-another-name.yaml'
+        ])
 
         swift.delete_container.assert_called_with(self.container_name)
 
@@ -301,27 +311,35 @@ class ExportPlanActionTest(base.TestCase):
 
         self.ctx = mock.MagicMock()
 
-    @mock.patch('tripleo_common.utils.tarball.create_tarball')
-    @mock.patch('tempfile.mkdtemp')
-    def test_run_success(self, mock_mkdtemp, mock_create_tarball):
-        get_object_mock_calls = [
-            mock.call(self.plan, tf) for tf in self.template_files
-        ]
-        get_container_mock_calls = [
-            mock.call(self.plan),
-            mock.call('plan-exports')
-        ]
-        mock_mkdtemp.return_value = '/tmp/test123'
+    @mock.patch('tripleo_common.utils.swift.iter_objects')
+    def test_run_success(self, mock_iter_objects):
+        mock_iter_objects.return_value = iter([
+            (tf, RESOURCES_YAML_CONTENTS) for tf in self.template_files
+        ])
+        self.swift.head_container.side_effect = (
+            swiftexceptions.ClientException('plan-exports'))
 
         action = plan.ExportPlanAction(self.plan, self.delete_after,
                                        self.exports_container)
         action.run(self.ctx)
 
-        self.swift.get_container.assert_has_calls(get_container_mock_calls)
-        self.swift.get_object.assert_has_calls(
-            get_object_mock_calls, any_order=True)
-        self.swift.put_object.assert_called_once()
-        mock_create_tarball.assert_called_once()
+        self.swift.get_container.assert_called_once_with(
+            self.plan, full_listing=True)
+        mock_iter_objects.assert_called_once_with(
+            self.swift, self.plan, list(self.template_files),
+            self.ctx.auth_token)
+        self.swift.put_container.assert_called_once_with('plan-exports')
+        self.swift.put_object.assert_called_once_with(
+            'plan-exports', 'overcloud.tar.gz', mock.ANY,
+            headers={'X-Delete-After': self.delete_after})
+
+        # the tarball is streamed to swift
+        contents = b''.join(self.swift.put_object.call_args[0][2])
+        with tarfile.open(fileobj=io.BytesIO(contents)) as tar:
+            self.assertEqual(list(self.template_files), tar.getnames())
+            self.assertEqual(
+                RESOURCES_YAML_CONTENTS.encode('utf-8'),
+                tar.extractfile('some-name.yaml').read())
 
     def test_run_container_does_not_exist(self):
         self.swift.get_container.side_effect = swiftexceptions.ClientException(
@@ -334,9 +352,9 @@ class ExportPlanActionTest(base.TestCase):
         error = "Error attempting an operation on container: %s" % self.plan
         self.assertIn(error, result.error)
 
-    @mock.patch('tripleo_common.utils.tarball.create_tarball')
-    def test_run_error_creating_tarball(self, mock_create_tarball):
-        mock_create_tarball.side_effect = processutils.ProcessExecutionError
+    @mock.patch('tripleo_common.utils.tarball.stream_tarball')
+    def test_run_error_creating_tarball(self, mock_stream_tarball):
+        mock_stream_tarball.side_effect = tarfile.TarError
 
         action = plan.ExportPlanAction(self.plan, self.delete_after,
                                        self.exports_container)
@@ -42,7 +42,7 @@ class ScaleDownActionTest(base.TestCase):
         self.image = collections.namedtuple('image', ['id'])
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
-                'cache_delete')
+                'cache_invalidate')
     @mock.patch('tripleo_common.actions.base.TripleOAction.'
                 'get_orchestration_client')
     @mock.patch('heatclient.common.template_utils.'
@@ -120,8 +120,4 @@ class ScaleDownActionTest(base.TestCase):
             files={},
             timeout_mins=240)
 
-        mock_cache.assert_called_once_with(
-            mock_ctx,
-            "stack",
-            "tripleo.parameters.get"
-        )
+        mock_cache.assert_called_once_with(mock_ctx, "stack")
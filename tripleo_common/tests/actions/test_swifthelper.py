@@ -94,3 +94,21 @@ class SwiftTempUrlActionTest(base.TestCase):
     def test_get_tempurl_no_key(self):
         # temp-url-key not yet set
         self._test_get_tempurl(None)
+
+
+class SwiftEmptyContainerActionTest(base.TestCase):
+
+    @mock.patch('tripleo_common.utils.swift.delete_objects')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_run(self, mock_get_object_client, mock_delete_objects):
+        swift = mock_get_object_client.return_value
+        swift.get_container.return_value = ({}, [{'name': 'log1.tar.gz'},
+                                                 {'name': 'log2.tar.gz'}])
+        action = swifthelper.SwiftEmptyContainerAction('logs', concurrency=2)
+
+        self.assertIsNone(action.run(mock.MagicMock()))
+
+        swift.get_container.assert_called_once_with('logs',
+                                                    full_listing=True)
+        mock_delete_objects.assert_called_once_with(
+            swift, 'logs', ['log1.tar.gz', 'log2.tar.gz'], workers=2)
@@ -12,8 +12,14 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import hashlib
 import jinja2
+import json
 import mock
+import os
+import shutil
+import tempfile
+import threading
 import yaml
 
 from swiftclient import exceptions as swiftexceptions
@@ -132,23 +138,153 @@ EXPECTED_JINJA_RESULT_ROLE_NETWORKS = r"""
 
 class UploadTemplatesActionTest(base.TestCase):
 
-    @mock.patch('tempfile.NamedTemporaryFile')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'cache_invalidate')
     @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
     @mock.patch('tripleo_common.utils.tarball.'
-                'tarball_extract_to_swift_container')
-    @mock.patch('tripleo_common.utils.tarball.create_tarball')
-    def test_run(self, mock_create_tar, mock_extract_tar, mock_get_swift,
-                 tempfile):
+                'directory_extract_to_swift_container')
+    def test_run(self, mock_extract_dir, mock_get_swift, mock_cache):
         mock_ctx = mock.MagicMock()
-        tempfile.return_value.__enter__.return_value.name = "test"
 
-        action = templates.UploadTemplatesAction(container='tar-container')
+        action = templates.UploadTemplatesAction(container='tar-container',
+                                                 compresslevel=1)
         action.run(mock_ctx)
 
-        mock_create_tar.assert_called_once_with(
-            constants.DEFAULT_TEMPLATES_PATH, 'test')
-        mock_extract_tar.assert_called_once_with(
-            mock_get_swift.return_value, 'test', 'tar-container')
+        mock_extract_dir.assert_called_once_with(
+            mock_get_swift.return_value, constants.DEFAULT_TEMPLATES_PATH,
+            'tar-container', 1)
+        mock_cache.assert_called_once_with(mock_ctx, 'tar-container')
+
+    def _setup_templates(self):
+        templates_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, templates_path)
+        for name, contents in (('overcloud.j2.yaml', 'unchanged'),
+                               ('puppet/role.role.j2.yaml', 'changed'),
+                               ('environments/new.yaml', 'new')):
+            path = os.path.join(templates_path, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+
+        swift = mock.MagicMock()
+        swift.get_container.return_value = ({}, [
+            {'name': 'overcloud.j2.yaml',
+             'hash': hashlib.md5(b'unchanged').hexdigest()},
+            {'name': 'puppet/role.role.j2.yaml',
+             'hash': hashlib.md5(b'previous').hexdigest()},
+            {'name': 'environments/removed.yaml', 'hash': 'abc'},
+            {'name': 'overcloud.yaml', 'hash': 'def'},
+            {'name': constants.PLAN_ENVIRONMENT, 'hash': 'ghi'},
+            {'name': constants.OVERCLOUD_J2_RENDER_MANIFEST, 'hash': 'jkl'},
+            {'name': constants.TEMPLATES_SYNC_MANIFEST, 'hash': 'mno'},
+            {'name': 'user-environment.yaml', 'hash': 'pqr'},
+        ])
+        manifests = {
+            constants.OVERCLOUD_J2_RENDER_MANIFEST: {'overcloud.yaml': {}},
+            constants.TEMPLATES_SYNC_MANIFEST: [
+                'environments/removed.yaml', 'overcloud.j2.yaml',
+                'overcloud.yaml', 'puppet/role.role.j2.yaml'],
+        }
+        swift.get_object.side_effect = lambda container, name: (
+            {}, json.dumps(manifests[name]))
+        return templates_path, swift
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'cache_invalidate')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    @mock.patch('tripleo_common.utils.tarball.'
+                'directory_extract_to_swift_container')
+    def test_run_sync(self, mock_extract_dir, mock_get_swift, mock_cache):
+        templates_path, swift = self._setup_templates()
+        mock_get_swift.return_value = swift
+        mock_ctx = mock.MagicMock()
+
+        action = templates.UploadTemplatesAction(
+            container='overcloud', templates_path=templates_path, sync=True)
+        action.run(mock_ctx)
+
+        swift.get_container.assert_called_once_with('overcloud',
+                                                    full_listing=True)
+        mock_extract_dir.assert_called_once_with(
+            swift, templates_path, 'overcloud',
+            constants.DEFAULT_TARBALL_COMPRESSLEVEL,
+            names=['environments/new.yaml', 'puppet/role.role.j2.yaml'])
+        swift.delete_object.assert_not_called()
+        swift.put_object.assert_called_once_with(
+            'overcloud', constants.TEMPLATES_SYNC_MANIFEST,
+            json.dumps(['environments/new.yaml', 'overcloud.j2.yaml',
+                        'puppet/role.role.j2.yaml']))
+        mock_cache.assert_called_once_with(mock_ctx, 'overcloud')
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.'
+                'cache_invalidate')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    @mock.patch('tripleo_common.utils.tarball.'
+                'directory_extract_to_swift_container')
+    def test_run_sync_unchanged(self, mock_extract_dir, mock_get_swift,
+                                mock_cache):
+        templates_path, swift = self._setup_templates()
+        swift.get_container.return_value = ({}, [
+            {'name': 'overcloud.j2.yaml',
+             'hash': hashlib.md5(b'unchanged').hexdigest()},
+            {'name': 'puppet/role.role.j2.yaml',
+             'hash': hashlib.md5(b'changed').hexdigest()},
+            {'name': 'environments/new.yaml',
+             'hash': hashlib.md5(b'new').hexdigest()},
+            {'name': constants.TEMPLATES_SYNC_MANIFEST,
+             'hash': hashlib.md5(json.dumps([
+                 'environments/new.yaml', 'overcloud.j2.yaml',
+                 'puppet/role.role.j2.yaml']).encode('utf-8')).hexdigest()},
+        ])
+        mock_get_swift.return_value = swift
+
+        action = templates.UploadTemplatesAction(
+            container='overcloud', templates_path=templates_path, sync=True,
+            delete_removed=True)
+        action.run(mock.MagicMock())
+
+        mock_extract_dir.assert_not_called()
+        swift.put_object.assert_not_called()
+        mock_cache.assert_not_called()
+
+    @mock.patch('tripleo_common.utils.swift.delete_objects')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    @mock.patch('tripleo_common.utils.tarball.'
+                'directory_extract_to_swift_container')
+    def test_run_sync_delete_removed(self, mock_extract_dir, mock_get_swift,
+                                     mock_delete_objects):
+        templates_path, swift = self._setup_templates()
+        mock_get_swift.return_value = swift
+
+        action = templates.UploadTemplatesAction(
+            container='overcloud', templates_path=templates_path, sync=True,
+            delete_removed=True)
+        action.run(mock.MagicMock())
+
+        mock_extract_dir.assert_called_once()
+        # user-environment.yaml wasn't uploaded by a sync, it is kept
+        mock_delete_objects.assert_called_once_with(
+            swift, 'overcloud', ['environments/removed.yaml'])
+
+    @mock.patch('tripleo_common.utils.swift.delete_objects')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    @mock.patch('tripleo_common.utils.tarball.'
+                'directory_extract_to_swift_container')
+    def test_run_sync_delete_removed_first_sync(
+            self, mock_extract_dir, mock_get_swift, mock_delete_objects):
+        templates_path, swift = self._setup_templates()
+        swift.get_object.side_effect = swiftexceptions.ClientException(
+            'not found', http_status=404)
+        mock_get_swift.return_value = swift
+
+        action = templates.UploadTemplatesAction(
+            container='overcloud', templates_path=templates_path, sync=True,
+            delete_removed=True)
+        action.run(mock.MagicMock())
+
+        # nothing is known to have been uploaded by a sync
+        mock_delete_objects.assert_not_called()
 
 
 class J2SwiftLoaderTest(base.TestCase):
@@ -191,6 +327,24 @@ class J2SwiftLoaderTest(base.TestCase):
             I am foo
             ''')
 
+    def test_include_from_objects(self):
+        swift = self._setup_swift()
+        j2_loader = templates.J2SwiftLoader(
+            swift, None, 'bar', objects={'bar/foo.yaml': b'I am a snapshot'})
+        template = jinja2.Environment(loader=j2_loader).from_string(
+            r'''
+            Included this:
+            {% include 'foo.yaml' %}
+            ''')
+        self.assertEqual(
+            template.render(),
+            '''
+            Included this:
+            I am a snapshot
+            ''')
+        swift.get_object.assert_not_called()
+        self.assertEqual(['bar/foo.yaml'], list(j2_loader.loaded))
+
     def test_include_not_found(self):
         j2_loader = templates.J2SwiftLoader(self._setup_swift(), None)
         template = jinja2.Environment(loader=j2_loader).from_string(
@@ -256,6 +410,46 @@ class ProcessTemplatesActionTest(base.TestCase):
             }
         })
 
+    @mock.patch('tempfile.mkstemp')
+    @mock.patch('heatclient.common.template_utils.get_template_contents')
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_run_inline_environments(self, mock_get_object_client,
+                                     mock_get_template_contents,
+                                     mock_mkstemp):
+
+        mock_ctx = mock.MagicMock()
+        swift = mock.MagicMock(url="http://test.com")
+        mock_env = yaml.safe_dump({
+            'template': 'template',
+            'environments': [
+                {'data': {'parameter_defaults': {'Foo': 'inline',
+                                                 'Bar': 'inline'}}},
+            ],
+            'parameter_defaults': {'Foo': 'bar'},
+            'passwords': {'AdminPassword': 'secret'},
+        }, default_flow_style=False)
+        swift.get_object.side_effect = (
+            ({}, mock_env),
+            swiftexceptions.ClientException('atest2')
+        )
+        mock_get_object_client.return_value = swift
+
+        mock_get_template_contents.return_value = ({}, {
+            'heat_template_version': '2016-04-30'
+        })
+
+        # Test
+        action = templates.ProcessTemplatesAction()
+        result = action.run(mock_ctx)
+
+        # the plan parameters override the inline environments
+        self.assertEqual({'parameter_defaults': {
+            'Foo': 'bar',
+            'Bar': 'inline',
+            'AdminPassword': 'secret',
+        }}, result['environment'])
+        mock_mkstemp.assert_not_called()
+
     def _custom_roles_mock_objclient(self, snippet_name, snippet_content,
                                      role_data=None):
 
@@ -270,6 +464,7 @@ class ProcessTemplatesActionTest(base.TestCase):
                 return ['', role_data or ROLE_DATA_YAML]
             elif args[1] == constants.OVERCLOUD_J2_NETWORKS_NAME:
                 return ['', NETWORK_DATA_YAML]
+            raise swiftexceptions.ClientException('not found')
 
         def return_container_files(*args):
             return ('headers', [
@@ -314,6 +509,110 @@ class ProcessTemplatesActionTest(base.TestCase):
         ]
         swift.put_object.assert_has_calls(
             put_object_mock_calls, any_order=True)
+        # the plan generation is bumped once for all the rendered files
+        self.assertEqual(1, swift.post_container.call_count)
+
+    def _render_manifest_objclient(self, objects, listing):
+
+        def return_object(*args):
+            if args[1] in objects:
+                return ['', objects[args[1]]]
+            raise swiftexceptions.ClientException('not found')
+
+        def put_object(container, name, contents):
+            objects[name] = contents
+            listing[name] = templates._md5(contents)
+
+        swift = mock.MagicMock()
+        swift.get_object = mock.MagicMock(side_effect=return_object)
+        swift.put_object = mock.MagicMock(side_effect=put_object)
+        swift.get_container = mock.MagicMock(
+            side_effect=lambda *args: ('headers', [
+                {'name': name, 'hash': etag}
+                for name, etag in sorted(listing.items())]))
+        return swift
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_process_custom_roles_render_manifest(self, get_obj_client_mock):
+        objects = {
+            constants.OVERCLOUD_J2_NAME: JINJA_SNIPPET,
+            'foo.role.j2.yaml': JINJA_SNIPPET_CONFIG,
+            constants.OVERCLOUD_J2_ROLES_NAME: ROLE_DATA_YAML,
+            constants.OVERCLOUD_J2_NETWORKS_NAME: NETWORK_DATA_YAML,
+        }
+        listing = dict((name, templates._md5(contents))
+                       for name, contents in objects.items())
+        swift = self._render_manifest_objclient(objects, listing)
+        get_obj_client_mock.return_value = swift
+        action = templates.ProcessTemplatesAction()
+        mock_ctx = mock.MagicMock()
+
+        action._process_custom_roles(mock_ctx)
+        self.assertIn(constants.OVERCLOUD_J2_RENDER_MANIFEST, objects)
+        self.assertIn('overcloud.yaml', objects)
+        self.assertIn('customrole-foo.yaml', objects)
+        self.assertEqual(1, swift.post_container.call_count)
+
+        # nothing changed, nothing is rendered
+        swift.put_object.reset_mock()
+        swift.post_container.reset_mock()
+        action._process_custom_roles(mock_ctx)
+        swift.put_object.assert_not_called()
+        swift.post_container.assert_not_called()
+
+        # a new role only renders the files depending on roles_data
+        objects[constants.OVERCLOUD_J2_ROLES_NAME] = (
+            ROLE_DATA_YAML + "- name: Another\n")
+        listing[constants.OVERCLOUD_J2_ROLES_NAME] = 'changed'
+        action._process_custom_roles(mock_ctx)
+        self.assertEqual(
+            ['another-foo.yaml', constants.OVERCLOUD_J2_RENDER_MANIFEST,
+             'overcloud.yaml'],
+            sorted(c[0][1] for c in swift.put_object.call_args_list))
+        self.assertEqual(1, swift.post_container.call_count)
+
+        # a modified output is rendered again
+        swift.put_object.reset_mock()
+        listing['customrole-foo.yaml'] = 'modified'
+        action._process_custom_roles(mock_ctx)
+        swift.put_object.assert_called_once_with(
+            'overcloud', 'customrole-foo.yaml', mock.ANY)
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_process_custom_roles_plan_files(self, get_obj_client_mock):
+        swift = self._custom_roles_mock_objclient(
+            'foo.role.j2.yaml', r"{% include 'bar.yaml' %}",
+            ROLE_DATA_YAML + "- name: Another\n")
+        get_obj_client_mock.return_value = swift
+        plan_files = mock.Mock()
+        plan_files.get.side_effect = lambda name: {
+            'bar.yaml': b'{{role}}',
+            'foo.role.j2.yaml': b"{% include 'bar.yaml' %}",
+        }.get(name)
+
+        action = templates.ProcessTemplatesAction()
+        action.plan_files = plan_files
+        mock_ctx = mock.MagicMock()
+        with mock.patch.object(jinja2.Environment, 'from_string',
+                               side_effect=jinja2.Environment.from_string,
+                               autospec=True) as mock_from_string:
+            action._process_custom_roles(mock_ctx)
+
+        # both roles are rendered from a single compiled template
+        self.assertEqual(
+            1, len([c for c in mock_from_string.call_args_list
+                    if c[0][1] == "{% include 'bar.yaml' %}"]))
+        for name in ('foo.role.j2.yaml', 'bar.yaml'):
+            self.assertNotIn(mock.call('overcloud', name),
+                             swift.get_object.call_args_list)
+        swift.put_object.assert_has_calls([
+            mock.call('overcloud', 'customrole-foo.yaml', 'CustomRole'),
+            mock.call('overcloud', 'another-foo.yaml', 'Another'),
+        ], any_order=True)
+        plan_files.add.assert_has_calls([
+            mock.call('customrole-foo.yaml', mock.ANY, b'CustomRole'),
+            mock.call('another-foo.yaml', mock.ANY, b'Another'),
+        ], any_order=True)
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
     def _process_custom_roles_disable_constraints(
@@ -330,19 +629,15 @@ class ProcessTemplatesActionTest(base.TestCase):
 
         expected = EXPECTED_JINJA_RESULT.replace(
             'CustomRole', 'RoleWithDisableConstraints')
-        put_object_mock_call = mock.call(
-            constants.DEFAULT_CONTAINER_NAME,
-            'overcloud.yaml',
-            expected)
-        self.assertEqual(swift.put_object.call_args_list[0],
-                         put_object_mock_call)
-
-        put_object_mock_call = mock.call(
-            constants.DEFAULT_CONTAINER_NAME,
-            "rolewithdisableconstraints-disable-constraints.yaml",
-            EXPECTED_JINJA_RESULT_DISABLE_CONSTRAINTS)
-        self.assertEqual(put_object_mock_call,
-                         swift.put_object.call_args_list[1])
+        # templates are rendered concurrently, in no particular order
+        swift.put_object.assert_has_calls([
+            mock.call(constants.DEFAULT_CONTAINER_NAME,
+                      'overcloud.yaml',
+                      expected),
+            mock.call(constants.DEFAULT_CONTAINER_NAME,
+                      "rolewithdisableconstraints-disable-constraints.yaml",
+                      EXPECTED_JINJA_RESULT_DISABLE_CONSTRAINTS),
+        ], any_order=True)
 
     def test_process_custom_roles_disable_constraints_old(self):
         self._process_custom_roles_disable_constraints(
@@ -366,19 +661,61 @@ class ProcessTemplatesActionTest(base.TestCase):
 
         expected = EXPECTED_JINJA_RESULT.replace(
             'CustomRole', 'RoleWithNetworks')
-        put_object_mock_call = mock.call(
-            constants.DEFAULT_CONTAINER_NAME,
-            'overcloud.yaml',
-            expected)
-        self.assertEqual(swift.put_object.call_args_list[0],
-                         put_object_mock_call)
-
-        put_object_mock_call = mock.call(
-            constants.DEFAULT_CONTAINER_NAME,
-            "rolewithnetworks-role-networks.yaml",
-            EXPECTED_JINJA_RESULT_ROLE_NETWORKS)
-        self.assertEqual(put_object_mock_call,
-                         swift.put_object.call_args_list[1])
+        # templates are rendered concurrently, in no particular order
+        swift.put_object.assert_has_calls([
+            mock.call(constants.DEFAULT_CONTAINER_NAME,
+                      'overcloud.yaml',
+                      expected),
+            mock.call(constants.DEFAULT_CONTAINER_NAME,
+                      "rolewithnetworks-role-networks.yaml",
+                      EXPECTED_JINJA_RESULT_ROLE_NETWORKS),
+        ], any_order=True)
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_custom_roles_render_errors(self, get_obj_client_mock):
+        swift = self._custom_roles_mock_objclient(
+            'broken.role.j2.yaml', r"{% include 'missing.yaml' %}",
+            ROLE_DATA_YAML + "- name: Another\n")
+        get_obj_client_mock.return_value = swift
+
+        action = templates.ProcessTemplatesAction(render_workers=2)
+        mock_ctx = mock.MagicMock()
+        err = self.assertRaises(Exception, action._process_custom_roles,
+                                mock_ctx)
+
+        # errors are reported in the order of the roles
+        self.assertEqual(
+            "Error rendering template customrole-broken.yaml : missing.yaml\n"
+            "Error rendering template another-broken.yaml : missing.yaml",
+            str(err))
+        # the successfully rendered files are stored
+        swift.put_object.assert_any_call(
+            constants.DEFAULT_CONTAINER_NAME, 'overcloud.yaml', mock.ANY)
+        self.assertEqual(1, swift.post_container.call_count)
+
+    @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
+    def test_j2_render_and_put_all_client_resolved_once(
+            self, get_obj_client_mock):
+        swift = mock.MagicMock()
+        threads = []
+
+        def _get_object_client(context):
+            threads.append(threading.current_thread())
+            return swift
+
+        get_obj_client_mock.side_effect = _get_object_client
+        action = templates.ProcessTemplatesAction(render_workers=3)
+        jobs = [(JINJA_SNIPPET_CONFIG, {'role': 'Role%d' % i},
+                 'role%d-config.yaml' % i) for i in range(3)]
+
+        results, errors = action._j2_render_and_put_all(jobs, mock.Mock())
+
+        self.assertEqual([], errors)
+        # the workers don't have the request context of the caller
+        self.assertEqual([threading.current_thread()], threads)
+        self.assertEqual(
+            ['role0-config.yaml', 'role1-config.yaml', 'role2-config.yaml'],
+            sorted(c[0][1] for c in swift.put_object.call_args_list))
 
     @mock.patch('tripleo_common.actions.base.TripleOAction.get_object_client')
     def test_j2_render_and_put(self, get_obj_client_mock):
@@ -17,7 +17,14 @@
 
 from oslotest import base
 
+from tripleo_common.utils import plan as plan_utils
+
 
 class TestCase(base.BaseTestCase):
 
     """Test case base class for all unit tests."""
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        # don't leak parsed plan environments between tests
+        self.addCleanup(plan_utils._env_cache.clear)
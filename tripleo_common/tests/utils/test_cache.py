@@ -0,0 +1,125 @@
+# Copyright 2017 Red Hat, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import json
+import zlib
+
+import mock
+
+from tripleo_common.tests import base
+from tripleo_common.utils import cache
+
+
+class LRUCacheTest(base.TestCase):
+
+    def test_get_set(self):
+        lru = cache.LRUCache(10)
+        self.assertIsNone(lru.get('foo'))
+        lru.set('foo', 'bar')
+        self.assertEqual('bar', lru.get('foo'))
+        self.assertEqual(1, len(lru))
+
+    def test_size_eviction(self):
+        lru = cache.LRUCache(10)
+        lru.set('a', 1, 4)
+        lru.set('b', 2, 4)
+        # mark 'a' as recently used, 'b' is evicted first
+        lru.get('a')
+        lru.set('c', 3, 4)
+
+        self.assertEqual(1, lru.get('a'))
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(3, lru.get('c'))
+        self.assertEqual(8, lru.size)
+
+    def test_too_large(self):
+        lru = cache.LRUCache(10)
+        lru.set('a', 1, 11)
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(0, lru.size)
+
+    def test_replace(self):
+        lru = cache.LRUCache(10)
+        lru.set('a', 1, 4)
+        lru.set('a', 2, 6)
+        self.assertEqual(2, lru.get('a'))
+        self.assertEqual(6, lru.size)
+
+    def test_pop_and_clear(self):
+        lru = cache.LRUCache(10)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(1, lru.pop('a'))
+        self.assertIsNone(lru.pop('a'))
+        lru.clear()
+        self.assertEqual(0, len(lru))
+        self.assertEqual(0, lru.size)
+
+    @mock.patch('time.time')
+    def test_ttl(self, mock_time):
+        lru = cache.LRUCache(10, ttl=5)
+        mock_time.return_value = 100
+        lru.set('a', 1)
+        mock_time.return_value = 104
+        self.assertEqual(1, lru.get('a'))
+        mock_time.return_value = 106
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(0, lru.size)
+
+    @mock.patch('time.time')
+    def test_on_evict(self, mock_time):
+        on_evict = mock.Mock()
+        lru = cache.LRUCache(2, ttl=5, on_evict=on_evict)
+        mock_time.return_value = 100
+        lru.set('a', 1)
+        lru.set('a', 2)
+        lru.set('b', 3)
+        lru.set('c', 4)
+        mock_time.return_value = 106
+        lru.get('c')
+        # popped entries are returned instead
+        lru.pop('b')
+
+        self.assertEqual([mock.call('a', 1), mock.call('a', 2),
+                          mock.call('c', 4)], on_evict.call_args_list)
+
+
+class DigestTest(base.TestCase):
+
+    def test_digest(self):
+        self.assertEqual(cache.digest({'a': 1, 'b': [1, 2]}),
+                         cache.digest({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(cache.digest({'a': 1, 'b': [1, 2]}),
+                            cache.digest({'a': 1, 'b': [2, 1]}))
+
+
+class CodecTest(base.TestCase):
+
+    def test_round_trip(self):
+        contents = {'a': [1, 2.5, None, True], 'b': {'c': u'd\u00e9'}}
+        for name in ('json+zlib', 'msgpack+zlib'):
+            codec = cache.get_codec(name)
+            body, size = codec.encode(contents)
+            self.assertEqual((contents, size), codec.decode(body))
+
+    def test_legacy(self):
+        # objects stored before the codecs were introduced
+        body = zlib.compress(json.dumps({'foo': 1}).encode())
+        self.assertEqual(({'foo': 1}, 10),
+                         cache.get_codec('json+zlib').decode(body))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, cache.get_codec, 'unknown')
+        self.assertRaises(ValueError, cache.get_codec('msgpack+zlib').decode,
+                          b'garbage')
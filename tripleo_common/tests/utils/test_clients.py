@@ -0,0 +1,239 @@
+# Copyright 2017 Red Hat, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import datetime
+import functools
+import threading
+import time
+
+import mock
+
+from tripleo_common.tests import base
+from tripleo_common.utils import clients
+
+
+class ClientRegistryTest(base.TestCase):
+
+    def setUp(self):
+        super(ClientRegistryTest, self).setUp()
+        self.registry = clients.ClientRegistry(10)
+        self.context = mock.Mock(project_id='project', auth_token='token',
+                                 expires_at=None)
+
+    def test_get_reuses_client(self):
+        factory = mock.Mock(side_effect=lambda: object())
+
+        client = self.registry.get('heat', self.context, factory)
+
+        self.assertIs(client,
+                      self.registry.get('heat', self.context, factory))
+        factory.assert_called_once_with()
+
+    def test_get_per_token(self):
+        factory = mock.Mock(side_effect=lambda: object())
+        other = mock.Mock(project_id='project', auth_token='other',
+                          expires_at=None)
+
+        self.assertIsNot(self.registry.get('heat', self.context, factory),
+                         self.registry.get('heat', other, factory))
+        self.assertIsNot(self.registry.get('heat', self.context, factory),
+                         self.registry.get('nova', self.context, factory))
+
+    def test_get_shared_by_threads(self):
+        factory = mock.Mock(side_effect=lambda: object())
+        client = self.registry.get('swift', self.context, factory)
+        result = []
+
+        thread = threading.Thread(target=lambda: result.append(
+            self.registry.get('swift', self.context, factory)))
+        thread.start()
+        thread.join()
+
+        self.assertIs(client, result[0])
+        factory.assert_called_once_with()
+
+    def test_get_expired_token(self):
+        factory = mock.Mock(side_effect=lambda: object())
+        self.context.expires_at = (
+            datetime.datetime.utcnow() -
+            datetime.timedelta(minutes=1)).isoformat() + 'Z'
+
+        client = self.registry.get('heat', self.context, factory)
+
+        self.assertIsNot(client,
+                         self.registry.get('heat', self.context, factory))
+        self.assertEqual(2, factory.call_count)
+
+    def test_get_valid_token(self):
+        factory = mock.Mock(side_effect=lambda: object())
+        self.context.expires_at = (
+            datetime.datetime.utcnow() +
+            datetime.timedelta(hours=1)).isoformat() + 'Z'
+
+        client = self.registry.get('heat', self.context, factory)
+
+        self.assertIs(client,
+                      self.registry.get('heat', self.context, factory))
+
+    def test_get_expired_token_closed(self):
+        factory = mock.Mock(side_effect=lambda: clients.PooledClient(
+            mock.Mock()))
+        self.context.expires_at = (
+            datetime.datetime.utcnow() -
+            datetime.timedelta(minutes=1)).isoformat() + 'Z'
+
+        client = self.registry.get('swift', self.context, factory)
+        self.registry.get('swift', self.context, factory)
+
+        client._pool.close.assert_called_once_with()
+
+    def test_evicted_closed(self):
+        registry = clients.ClientRegistry(1)
+        factory = mock.Mock(side_effect=lambda: clients.PooledClient(
+            mock.Mock()))
+        other = mock.Mock(project_id='project', auth_token='other',
+                          expires_at=None)
+
+        client = registry.get('swift', self.context, factory)
+        registry.get('heat', self.context, mock.Mock())
+        other_client = registry.get('swift', other, factory)
+
+        client._pool.close.assert_called_once_with()
+        other_client._pool.close.assert_not_called()
+
+
+class ConnectionPoolTest(base.TestCase):
+
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        self.factory = mock.Mock(side_effect=lambda: mock.Mock())
+        self.pool = clients.ConnectionPool(self.factory, 1)
+
+    def test_connection_reused(self):
+        with self.pool.connection() as conn:
+            pass
+        with self.pool.connection() as other:
+            self.assertIs(conn, other)
+        self.factory.assert_called_once_with()
+        conn.close.assert_not_called()
+
+    def test_connection_exclusive(self):
+        with self.pool.connection() as conn:
+            with self.pool.connection() as other:
+                self.assertIsNot(conn, other)
+        # only max_idle connections are kept
+        other.close.assert_not_called()
+        conn.close.assert_called_once_with()
+
+    def test_connection_returned_on_error(self):
+        def _fail():
+            with self.pool.connection() as conn:
+                raise ValueError(conn)
+
+        err = self.assertRaises(ValueError, _fail)
+        with self.pool.connection() as conn:
+            self.assertIs(err.args[0], conn)
+
+    def test_close(self):
+        with self.pool.connection() as conn:
+            pass
+
+        self.pool.close()
+        conn.close.assert_called_once_with()
+
+        # the pool still works, without keeping the connections
+        with self.pool.connection() as other:
+            self.assertIsNot(conn, other)
+        other.close.assert_called_once_with()
+        self.assertEqual(2, self.factory.call_count)
+
+
+class PooledClientTest(base.TestCase):
+
+    def test_call(self):
+        conn = mock.Mock()
+        pool = clients.ConnectionPool(mock.Mock(return_value=conn), 1)
+        client = clients.PooledClient(pool, url='http://swift', token='t')
+
+        self.assertIs(conn.get_object.return_value,
+                      client.get_object('container', 'name'))
+        conn.get_object.assert_called_once_with('container', 'name')
+        self.assertEqual('http://swift', client.url)
+        self.assertEqual('t', client.token)
+
+    def test_concurrent_calls(self):
+        in_use = set()
+        overlaps = []
+
+        def _get_object(conn, *args):
+            if conn in in_use:
+                overlaps.append(conn)
+            in_use.add(conn)
+            time.sleep(0.01)
+            in_use.discard(conn)
+
+        def _factory():
+            conn = mock.Mock()
+            conn.get_object.side_effect = functools.partial(_get_object,
+                                                            conn)
+            return conn
+
+        client = clients.PooledClient(clients.ConnectionPool(_factory, 2))
+        threads = [threading.Thread(target=client.get_object, args=('c',))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], overlaps)
+
+
+class EndpointResolverTest(base.TestCase):
+
+    def setUp(self):
+        super(EndpointResolverTest, self).setUp()
+        self.lookup = mock.Mock(side_effect=lambda service: mock.Mock(
+            url='http://%s' % service))
+        self.resolver = clients.EndpointResolver(self.lookup, 60)
+        self.context = mock.Mock(project_id='project')
+
+    def test_get(self):
+        endpoint = self.resolver.get('heat', self.context)
+
+        self.assertEqual('http://heat', endpoint.url)
+        self.assertIs(endpoint, self.resolver.get('heat', self.context))
+        self.lookup.assert_called_once_with('heat')
+
+    @mock.patch('time.time')
+    def test_get_expired(self, mock_time):
+        mock_time.return_value = 100
+        self.resolver.get('heat', self.context)
+        mock_time.return_value = 161
+        self.resolver.get('heat', self.context)
+
+        self.assertEqual(2, self.lookup.call_count)
+
+    def test_invalidate(self):
+        self.resolver.get('heat', self.context)
+        self.resolver.get('nova', self.context)
+
+        self.resolver.invalidate('heat')
+        self.resolver.get('heat', self.context)
+        self.resolver.get('nova', self.context)
+        self.assertEqual(3, self.lookup.call_count)
+
+        self.resolver.invalidate()
+        self.resolver.get('nova', self.context)
+        self.assertEqual(4, self.lookup.call_count)
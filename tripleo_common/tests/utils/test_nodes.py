@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import collections
+import re
 
 import mock
 from testtools import matchers
@@ -46,6 +47,14 @@ class DriverInfoTest(base.TestCase):
         self.assertEqual('foo_3', self.driver_info.convert_key('pm_3'))
         self.assertTrue(mock_log.called)
 
+    @mock.patch.object(nodes.LOG, 'warning', autospec=True)
+    def test_convert_key_deprecated_and_supported(self, mock_log):
+        driver_info = nodes.DriverInfo(
+            'foo', mapping={'pm_1': 'foo_1'},
+            deprecated_mapping={'pm_1': 'foo_old'})
+        self.assertEqual('foo_1', driver_info.convert_key('pm_1'))
+        self.assertFalse(mock_log.called)
+
     @mock.patch.object(nodes.LOG, 'warning', autospec=True)
     def test_convert_key_pm_unsupported(self, mock_log):
         self.assertIsNone(self.driver_info.convert_key('pm_42'))
@@ -210,6 +219,31 @@ class FindNodeHandlerTest(base.TestCase):
             handler = nodes._find_node_handler({'pm_type': driver})
             self.assertEqual(prefix, handler._prefix)
 
+    def test_same_as_registry_order(self):
+        drivers = ['fake', 'fake_pxe', 'fake_agent', 'pxe_ssh', 'ipmi',
+                   'pxe_ipmitool', 'agent_ipmitool', 'pxe_drac', 'pxe_ilo',
+                   'pxe_ucs', 'agent_irmc', 'redfish', 'redfish_foo',
+                   'pxe_iboot', 'pxe_wol', 'pxe_amt']
+        for driver in drivers:
+            expected = next(
+                handler for driver_tpl, handler in nodes.DRIVER_INFO.items()
+                if re.match(driver_tpl, driver) is not None)
+            self.assertIs(expected, nodes._find_driver_handler(driver))
+
+    @mock.patch.object(nodes, '_DRIVER_HANDLERS', {})
+    def test_memoized(self):
+        handler = nodes._find_driver_handler('pxe_ipmitool')
+        self.assertEqual({'pxe_ipmitool': handler}, nodes._DRIVER_HANDLERS)
+        with mock.patch.object(nodes, '_DRIVER_RE') as mock_re:
+            self.assertIs(handler, nodes._find_driver_handler('pxe_ipmitool'))
+            mock_re.match.assert_not_called()
+
+    @mock.patch.object(nodes, '_DRIVER_HANDLERS', {})
+    def test_unknown_driver_not_memoized(self):
+        self.assertRaises(exception.InvalidNode,
+                          nodes._find_driver_handler, 'foobar')
+        self.assertEqual({}, nodes._DRIVER_HANDLERS)
+
     def test_no_driver(self):
         self.assertRaises(exception.InvalidNode,
                           nodes._find_node_handler, {})
@@ -656,6 +690,129 @@ class NodesTest(base.TestCase):
         ironic.node.update.side_effect = side_effect
         nodes._update_or_register_ironic_node(node, node_map, client=ironic)
 
+    def _ironic_node(self, **fields):
+        ironic_node = mock.Mock(
+            uuid='uuid1',
+            properties={'cpus': '1', 'memory_mb': 2048, 'local_gb': '30',
+                        'cpu_arch': 'amd64', 'capabilities': 'num_nics:6'},
+            driver_info={'ssh_address': 'foo.bar', 'ssh_username': 'test',
+                         'ssh_key_contents': '******',
+                         'ssh_virt_type': 'virsh'})
+        # name is an argument of the Mock constructor
+        ironic_node.name = 'node1'
+        for field, value in fields.items():
+            setattr(ironic_node, field, value)
+        return ironic_node
+
+    def test_register_update_changed_fields(self):
+        node = self._get_node()
+        node['capabilities'] = 'num_nics:6,boot_option:local'
+        ironic_node = self._ironic_node(name='old-name')
+        ironic_node.properties['capabilities'] = 'boot_option:local,num_nics:6'
+        ironic = mock.MagicMock()
+        node_map = {'mac': {'aaa': 'uuid1'}, 'nodes': {'uuid1': ironic_node}}
+
+        nodes._update_or_register_ironic_node(node, node_map, client=ironic)
+
+        # the masked password is always sent
+        update_patch = ironic.node.update.call_args[0][1]
+        self.assertThat(update_patch, matchers.MatchesSetwise(
+            matchers.Equals({'path': '/name', 'value': 'node1',
+                             'op': 'add'}),
+            matchers.Equals({'path': '/driver_info/ssh_key_contents',
+                             'value': 'random', 'op': 'add'})))
+
+    def test_register_update_masked_only(self):
+        node = self._get_node()
+        ironic_node = self._ironic_node()
+        ironic = mock.MagicMock()
+        node_map = {'mac': {'aaa': 'uuid1'}, 'nodes': {'uuid1': ironic_node}}
+
+        nodes._update_or_register_ironic_node(node, node_map, client=ironic)
+
+        # Ironic hides the password, only it is sent
+        ironic.node.update.assert_called_once_with('uuid1', [
+            {'path': '/driver_info/ssh_key_contents', 'value': 'random',
+             'op': 'add'}])
+
+    def test_register_update_up_to_date(self):
+        node = self._get_node()
+        node.pop('pm_password')
+        ironic_node = self._ironic_node()
+        ironic = mock.MagicMock()
+        node_map = {'mac': {'aaa': 'uuid1'}, 'nodes': {'uuid1': ironic_node}}
+
+        self.assertIs(ironic_node, nodes._update_or_register_ironic_node(
+            node, node_map, client=ironic))
+        ironic.node.update.assert_not_called()
+
+    def test_register_nodes(self):
+        node_list = [self._get_node(), self._get_node(), self._get_node()]
+        node_list[0]['mac'] = ['aaa', 'bbb']
+        node_list[1]['pm_type'] = 'unknown'
+        node_list[2].update({'mac': ['ccc'], 'pm_addr': 'other',
+                             'name': 'node2'})
+        ironic = mock.MagicMock()
+        created = [mock.Mock(uuid='uuid0'), mock.Mock(uuid='uuid2')]
+        ironic.node.create.side_effect = lambda **kwargs: created[
+            kwargs['name'] == 'node2']
+        node_map = {'mac': {}, 'pm_addr': {}, 'uuids': set()}
+
+        results = nodes.register_nodes(node_list, ironic, node_map)
+
+        self.assertEqual((created[0], None), results[0])
+        self.assertIsNone(results[1][0])
+        self.assertIsInstance(results[1][1], exception.InvalidNode)
+        self.assertEqual((created[1], None), results[2])
+        ironic.port.create.assert_has_calls([
+            mock.call(address='aaa', node_uuid='uuid0'),
+            mock.call(address='bbb', node_uuid='uuid0'),
+            mock.call(address='ccc', node_uuid='uuid2'),
+        ], any_order=True)
+        ironic.node.validate.assert_has_calls([
+            mock.call('uuid0'), mock.call('uuid2')], any_order=True)
+        self.assertEqual({'mac': {'aaa': 'uuid0', 'bbb': 'uuid0',
+                                  'ccc': 'uuid2'},
+                          'pm_addr': {},
+                          'uuids': {'uuid0', 'uuid2'},
+                          'nodes': {'uuid0': created[0],
+                                    'uuid2': created[1]}}, node_map)
+
+    def test_register_nodes_duplicate(self):
+        node_list = [self._get_node(), self._get_node()]
+        node_list[1]['name'] = 'renamed'
+        ironic = mock.MagicMock()
+        ironic.node.create.return_value = mock.Mock(uuid='uuid0')
+        ironic.node.update.return_value = mock.Mock(uuid='uuid0')
+        node_map = {'mac': {}, 'pm_addr': {}, 'uuids': set()}
+
+        results = nodes.register_nodes(node_list, ironic, node_map)
+
+        # the second node is an update of the first one
+        ironic.node.create.assert_called_once_with(
+            driver='pxe_ssh', name='node1', driver_info=mock.ANY,
+            properties=mock.ANY)
+        ironic.node.update.assert_called_once_with('uuid0', mock.ANY)
+        self.assertIn({'path': '/name', 'value': 'renamed', 'op': 'add'},
+                      ironic.node.update.call_args[0][1])
+        self.assertEqual([(ironic.node.create.return_value, None),
+                          (ironic.node.update.return_value, None)], results)
+        ironic.node.validate.assert_called_once_with('uuid0')
+
+    def test_register_all_nodes_errors(self):
+        node_list = [self._get_node(), self._get_node()]
+        node_list[1].update({'mac': ['bbb'], 'pm_addr': 'other'})
+        ironic = mock.MagicMock()
+        ironic.node.create.side_effect = [mock.Mock(uuid='uuid0'),
+                                          ValueError('boom')]
+
+        err = self.assertRaises(exception.NodeRegistrationError,
+                                nodes.register_all_nodes, node_list,
+                                client=ironic, remove=True)
+        self.assertEqual(1, len(err.errors))
+        self.assertIn('node #', str(err))
+        ironic.node.delete.assert_not_called()
+
     def test_clean_up_extra_nodes_ironic(self):
         node = collections.namedtuple('node', ['uuid'])
         client = mock.MagicMock()
@@ -664,6 +821,16 @@ class NodesTest(base.TestCase):
         nodes._clean_up_extra_nodes(seen, client, remove=True)
         client.node.delete.assert_called_once_with('foobar')
 
+    def test_clean_up_extra_nodes_node_map(self):
+        node = collections.namedtuple('node', ['uuid'])
+        client = mock.MagicMock()
+        node_map = {'mac': {}, 'pm_addr': {}, 'uuids': {'foobar', 'abcd'}}
+        seen = [node('abcd')]
+        nodes._clean_up_extra_nodes(seen, client, remove=True,
+                                    node_map=node_map)
+        client.node.list.assert_not_called()
+        client.node.delete.assert_called_once_with('foobar')
+
     def test__get_node_id_fake_pxe(self):
         node = self._get_node()
         node['pm_type'] = 'fake_pxe'
@@ -693,28 +860,37 @@ class TestPopulateNodeMapping(base.TestCase):
         client = mock.MagicMock()
         ironic_node = collections.namedtuple('node', ['uuid', 'driver',
                                              'driver_info'])
-        ironic_port = collections.namedtuple('port', ['address'])
+        ironic_port = collections.namedtuple('port', ['address',
+                                                      'node_uuid'])
         node1 = ironic_node('abcdef', 'pxe_ssh', None)
         node2 = ironic_node('fedcba', 'pxe_ipmitool',
                             {'ipmi_address': '10.0.1.2'})
         node3 = ironic_node('xyz', 'ipmi', {'ipmi_address': '10.0.1.3'})
-        client.node.list_ports.side_effect = ([ironic_port('aaa')], [], [])
+        client.port.list.return_value = [ironic_port('aaa', 'abcdef'),
+                                         ironic_port('bbb', 'fedcba'),
+                                         ironic_port('ccc', 'unlisted')]
         client.node.list.return_value = [node1, node2, node3]
-        expected = {'mac': {'aaa': 'abcdef'},
+        expected = {'mac': {'aaa': 'abcdef', 'bbb': 'fedcba'},
                     'pm_addr': {'10.0.1.2': 'fedcba', '10.0.1.3': 'xyz'},
-                    'uuids': {'abcdef', 'fedcba', 'xyz'}}
+                    'uuids': {'abcdef', 'fedcba', 'xyz'},
+                    'nodes': {'abcdef': node1, 'fedcba': node2,
+                              'xyz': node3}}
         self.assertEqual(expected, nodes._populate_node_mapping(client))
+        client.node.list.assert_called_once_with(detail=True, limit=0)
+        client.port.list.assert_called_once_with(detail=True, limit=0)
+        client.node.list_ports.assert_not_called()
 
     def test_populate_node_mapping_ironic_fake_pxe(self):
         client = mock.MagicMock()
         ironic_node = collections.namedtuple('node', ['uuid', 'driver',
                                              'driver_info'])
-        ironic_port = collections.namedtuple('port', ['address'])
+        ironic_port = collections.namedtuple('port', ['address',
+                                                      'node_uuid'])
         node = ironic_node('abcdef', 'fake_pxe', None)
-        client.node.list_ports.return_value = [ironic_port('aaa')]
+        client.port.list.return_value = [ironic_port('aaa', 'abcdef')]
         client.node.list.return_value = [node]
         expected = {'mac': {'aaa': 'abcdef'}, 'pm_addr': {},
-                    'uuids': {'abcdef'}}
+                    'uuids': {'abcdef'}, 'nodes': {'abcdef': node}}
         self.assertEqual(expected, nodes._populate_node_mapping(client))
 
 
@@ -842,6 +1018,51 @@ class TestValidateNodes(base.TestCase):
                                'MAC 11:22:33:44:55:66 is not unique',
                                nodes.validate_nodes, nodes_json)
 
+    def test_duplicate_mac_case_insensitive(self):
+        nodes_json = [
+            {'pm_type': 'ipmi',
+             'pm_addr': '1.1.1.1',
+             'pm_user': 'root',
+             'pm_password': 'p@$$w0rd',
+             'mac': ['aa:bb:cc:dd:ee:ff']},
+            {'pm_type': 'ipmi',
+             'pm_addr': '1.2.1.1',
+             'pm_user': 'user',
+             'pm_password': 'p@$$w0rd',
+             'mac': ['AA:BB:CC:DD:EE:FF']},
+        ]
+        self.assertRaisesRegex(exception.InvalidNode,
+                               'node #1: MAC AA:BB:CC:DD:EE:FF is not unique, '
+                               'it is used by node #0',
+                               nodes.validate_nodes, nodes_json)
+
+    def test_all_failures_reported(self):
+        nodes_json = [
+            {'pm_type': 'pxe_foobar',
+             'pm_addr': '1.1.1.1'},
+            {'pm_type': 'ipmi',
+             'pm_addr': '1.2.1.1',
+             'pm_user': 'user',
+             'pm_password': 'p@$$w0rd',
+             'mac': ['42'],
+             'pm_foobar': '42'},
+            {'pm_type': 'pxe_foobar',
+             'pm_addr': '1.3.1.1'},
+        ]
+        try:
+            nodes.validate_nodes(nodes_json)
+        except exception.InvalidNode as exc:
+            lines = str(exc).split('\n')
+        else:
+            self.fail('InvalidNode not raised')
+        self.assertIn('node #0: ', lines[0])
+        self.assertIn('unknown pm_type', lines[0])
+        self.assertEqual(['node #1: MAC address 42 is invalid',
+                          'node #1: Unknown field pm_foobar'], lines[1:3])
+        self.assertIn('node #2: ', lines[3])
+        self.assertIn('unknown pm_type', lines[3])
+        self.assertEqual(4, len(lines))
+
     def test_duplicate_names(self):
         nodes_json = [
             {'pm_type': 'pxe_ipmitool',
@@ -187,3 +187,57 @@ class ParametersTest(base.TestCase):
         self.assertRaises(exception.DeriveParamsError,
                           parameters.get_profile_of_flavor,
                           'no_profile', compute_client)
+
+    def test_flatten_resource_tree(self):
+        tree = {
+            'Description': 'root',
+            'Parameters': {
+                'ControllerCount': {'Default': 1, 'Type': 'Number'},
+            },
+            'NestedParameters': {
+                'Controller': {
+                    'Type': 'OS::Heat::ResourceGroup',
+                    'Parameters': {
+                        'ControllerCount': {'Default': 2},
+                        'Hostname': {'NoEcho': 'false', 'CustomKey': 'x'},
+                    },
+                    'NestedParameters': {
+                        '0': {'Type': 'OS::TripleO::Controller'},
+                    },
+                },
+                'Compute': {'Type': 'OS::Heat::ResourceGroup'},
+            },
+        }
+
+        flattened = parameters.flatten_resource_tree(tree)
+
+        resources = flattened['resources']
+        self.assertEqual(4, len(resources))
+        root = [r for r in resources.values() if r['name'] == 'Root'][0]
+        self.assertEqual('root', root['description'])
+        self.assertEqual(['ControllerCount'], root['parameters'])
+        self.assertEqual(['Controller', 'Compute'],
+                         [resources[key]['name']
+                          for key in root['resources']])
+        controller = resources[root['resources'][0]]
+        self.assertEqual('OS::TripleO::Controller',
+                         resources[controller['resources'][0]]['type'])
+
+        # the parameters are those of the first resource defining them
+        self.assertEqual({
+            'ControllerCount': {'default': 1, 'type': 'Number',
+                                'name': 'ControllerCount'},
+            'Hostname': {'noEcho': 'false', 'customKey': 'x',
+                         'name': 'Hostname'},
+        }, flattened['parameters'])
+
+        # the IDs only depend on the path of the resources
+        self.assertEqual(flattened, parameters.flatten_resource_tree(tree))
+
+    def test_flatten_resource_tree_deep(self):
+        tree = {}
+        for level in range(5000):
+            tree = {'NestedParameters': {'level%d' % level: tree}}
+
+        flattened = parameters.flatten_resource_tree(tree)
+        self.assertEqual(5001, len(flattened['resources']))
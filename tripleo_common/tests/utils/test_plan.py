@@ -17,6 +17,7 @@ import mock
 
 from swiftclient import exceptions as swiftexceptions
 
+from tripleo_common import exception
 from tripleo_common.tests import base
 from tripleo_common.utils import plan as plan_utils
 
@@ -90,3 +91,320 @@ class PlanTest(base.TestCase):
 
         self.swift.get_object.assert_called()
         self.swift.put_object.assert_called()
+
+    def test_get_plan_generation(self):
+        self.swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '42'}
+        self.assertEqual(
+            42, plan_utils.get_plan_generation(self.swift, self.container))
+        self.swift.head_container.assert_called_once_with(self.container)
+
+    def test_get_plan_generation_missing(self):
+        self.swift.head_container.return_value = {}
+        self.assertEqual(
+            0, plan_utils.get_plan_generation(self.swift, self.container))
+
+    @mock.patch('time.time')
+    def test_bump_plan_generation(self, mock_time):
+        self.swift.head_container.return_value = {
+            'x-container-meta-tripleo-plan-generation': '42'}
+
+        mock_time.return_value = 0
+        self.assertEqual(
+            43, plan_utils.bump_plan_generation(self.swift, self.container))
+        self.swift.post_container.assert_called_with(
+            self.container,
+            {'x-container-meta-tripleo-plan-generation': '43'})
+
+        mock_time.return_value = 100
+        self.assertEqual(
+            100000000,
+            plan_utils.bump_plan_generation(self.swift, self.container))
+
+    @mock.patch('tripleo_common.utils.swift.head_containers')
+    def test_list_plans(self, mock_head_containers):
+        self.addCleanup(plan_utils._plan_list_cache.clear)
+        self.swift.url = 'http://swift/v1/AUTH_test'
+        self.swift.get_account.return_value = ({}, [
+            {'name': 'overcloud'}, {'name': 'logs'}, {'name': 'other'}])
+        mock_head_containers.return_value = {
+            'overcloud': {'x-container-meta-usage-tripleo': 'plan'},
+            'logs': {'x-container-meta-usage-tripleo-logs': 'x'},
+        }
+
+        self.assertEqual(['overcloud'], plan_utils.list_plans(self.swift))
+        self.assertEqual(['overcloud'], plan_utils.list_plans(self.swift))
+        self.swift.get_account.assert_called_once_with(full_listing=True)
+        mock_head_containers.assert_called_once_with(
+            self.swift, ['overcloud', 'logs', 'other'])
+
+        plan_utils.invalidate_plan_list(self.swift)
+        plan_utils.list_plans(self.swift)
+        self.assertEqual(2, self.swift.get_account.call_count)
+
+    def test_get_env_cached(self):
+        self.swift.url = 'http://swift/v1/AUTH_test'
+        self.swift.get_object.return_value = ({'etag': 'abc'}, YAML_CONTENTS)
+
+        env = plan_utils.get_env(self.swift, self.container)
+        env['template'] = 'changed.yaml'
+
+        self.swift.get_object.side_effect = swiftexceptions.ClientException(
+            'Not Modified', http_status=304)
+        self.assertEqual('overcloud.yaml', plan_utils.get_env(
+            self.swift, self.container)['template'])
+        self.swift.get_object.assert_called_with(
+            self.container, 'plan-environment.yaml',
+            headers={'If-None-Match': 'abc'})
+
+    def test_put_env_cached(self):
+        self.swift.url = 'http://swift/v1/AUTH_test'
+        self.swift.put_object.return_value = 'def'
+        env = {'name': self.container, 'template': 'overcloud.yaml'}
+
+        plan_utils.put_env(self.swift, env)
+        self.swift.put_object.assert_called_once_with(
+            self.container, 'plan-environment.yaml',
+            'name: overcloud\ntemplate: overcloud.yaml\n')
+
+        self.swift.get_object.side_effect = swiftexceptions.ClientException(
+            'Not Modified', http_status=304)
+        self.assertEqual(env, plan_utils.get_env(self.swift, self.container))
+        self.swift.get_object.assert_called_once_with(
+            self.container, 'plan-environment.yaml',
+            headers={'If-None-Match': 'def'})
+
+    def _lock_call(self):
+        return mock.call(self.container, 'plan-environment.lock', '',
+                         headers={'If-None-Match': '*',
+                                  'X-Delete-After': '30'})
+
+    def test_update_env(self):
+        self.swift.url = 'http://swift/v1/AUTH_test'
+        self.swift.get_object.return_value = ({'etag': 'abc'}, YAML_CONTENTS)
+        self.swift.put_object.return_value = 'def'
+
+        env = plan_utils.update_env(
+            self.swift, self.container,
+            lambda env: env.update({'template': 'updated.yaml'}))
+
+        self.assertEqual('updated.yaml', env['template'])
+        # the lock is taken first, and the inline sections are moved to
+        # their own objects
+        self.assertEqual(4, self.swift.put_object.call_count)
+        self.assertEqual(self._lock_call(),
+                         self.swift.put_object.call_args_list[0])
+        self.swift.put_object.assert_called_with(
+            self.container, 'plan-environment.yaml', mock.ANY)
+        self.swift.delete_object.assert_called_once_with(
+            self.container, 'plan-environment.lock')
+        self.swift.head_object.assert_not_called()
+
+    @mock.patch('time.sleep')
+    def test_update_env_locked(self, mock_sleep):
+        self.swift.url = 'http://swift/v1/AUTH_test'
+        self.swift.get_object.return_value = ({'etag': 'abc'}, YAML_CONTENTS)
+        self.swift.put_object.side_effect = [
+            swiftexceptions.ClientException('Precondition Failed',
+                                            http_status=412),
+            'lock', 'a', 'b', 'c']
+        mutate = mock.Mock(
+            side_effect=lambda env: env.update({'version': 2.0}))
+
+        env = plan_utils.update_env(self.swift, self.container, mutate)
+
+        # the environment is read once the other update released the lock
+        mutate.assert_called_once_with(env)
+        self.assertEqual(1, self.swift.get_object.call_count)
+        self.assertEqual(2.0, env['version'])
+        self.assertEqual([self._lock_call(), self._lock_call()],
+                         self.swift.put_object.call_args_list[:2])
+        mock_sleep.assert_called_once_with(0.5)
+        self.swift.delete_object.assert_called_once_with(
+            self.container, 'plan-environment.lock')
+
+    @mock.patch('time.sleep')
+    def test_update_env_lock_timeout(self, mock_sleep):
+        self.swift.put_object.side_effect = swiftexceptions.ClientException(
+            'Precondition Failed', http_status=412)
+        mutate = mock.Mock()
+
+        err = self.assertRaises(swiftexceptions.ClientException,
+                                plan_utils.update_env, self.swift,
+                                self.container, mutate, retries=2)
+        self.assertEqual(409, err.http_status)
+        self.assertEqual(3, self.swift.put_object.call_count)
+        self.assertEqual(2, mock_sleep.call_count)
+        mutate.assert_not_called()
+        self.swift.get_object.assert_not_called()
+        self.swift.delete_object.assert_not_called()
+
+    def test_update_env_error_unlocks(self):
+        self.swift.get_object.side_effect = swiftexceptions.ClientException(
+            'Not Found', http_status=404)
+
+        self.assertRaises(exception.PlanEnvironmentReadError,
+                          plan_utils.update_env, self.swift, self.container,
+                          mock.Mock())
+        self.swift.delete_object.assert_called_once_with(
+            self.container, 'plan-environment.lock')
+
+    def test_update_env_missing_plan(self):
+        self.swift.put_object.side_effect = swiftexceptions.ClientException(
+            'Not Found', http_status=404)
+
+        err = self.assertRaises(exception.PlanEnvironmentReadError,
+                                plan_utils.update_env, self.swift,
+                                self.container, mock.Mock())
+        self.assertEqual(404, err.error.http_status)
+        self.swift.get_object.assert_not_called()
+        self.swift.delete_object.assert_not_called()
+
+    def test_update_env_key(self):
+        self.swift.url = 'http://swift/v1/AUTH_test'
+
+        env = plan_utils.update_env_key(self.swift, self.container,
+                                        'parameter_defaults', {'Foo': 'bar'})
+
+        self.assertEqual({'BlockStorageCount': 42,
+                          'OvercloudControlFlavor': 'yummy',
+                          'Foo': 'bar'}, env['parameter_defaults'])
+        self.swift.get_object.assert_called_once_with(
+            self.container, 'plan-environment.yaml')
+
+    def test_update_in_env_uncached(self):
+        self.swift.url = 'http://swift/v1/AUTH_test'
+        env = {'name': self.container, 'template': 'stale.yaml'}
+        self.swift.get_object.return_value = ({'etag': 'abc'}, YAML_CONTENTS)
+
+        updated_env = plan_utils.update_in_env(
+            self.swift, env, 'parameter_defaults', {'Foo': 'bar'})
+
+        # the change is applied to the latest version of the environment,
+        # under the lock, even though it wasn't read before
+        self.assertIs(env, updated_env)
+        self.assertEqual('overcloud.yaml', env['template'])
+        self.assertEqual('bar', env['parameter_defaults']['Foo'])
+        self.assertEqual(42, env['parameter_defaults']['BlockStorageCount'])
+        self.assertEqual(self._lock_call(),
+                         self.swift.put_object.call_args_list[0])
+        self.swift.put_object.assert_called_with(
+            self.container, 'plan-environment.yaml', mock.ANY)
+
+    def _get_object(self, objects):
+        def get_object(container, name, headers=None):
+            if name not in objects:
+                raise swiftexceptions.ClientException('Not Found',
+                                                      http_status=404)
+            return objects[name]
+        return get_object
+
+    def test_get_env_separate_sections(self):
+        self.swift.get_object.side_effect = self._get_object({
+            'plan-environment.yaml': (
+                {}, 'name: overcloud\nseparate_sections:\n'
+                    '- parameter_defaults\ntemplate: overcloud.yaml\n'),
+            'plan-environment-parameters.yaml': ({}, 'Foo: bar\n'),
+        })
+
+        env = plan_utils.get_env(self.swift, self.container)
+
+        self.assertEqual({'name': 'overcloud',
+                          'template': 'overcloud.yaml',
+                          'parameter_defaults': {'Foo': 'bar'}}, env)
+
+    def test_get_env_missing_section(self):
+        self.swift.get_object.side_effect = self._get_object({
+            'plan-environment.yaml': (
+                {}, 'name: overcloud\nseparate_sections:\n'
+                    '- parameter_defaults\n- passwords\n'
+                    'template: overcloud.yaml\n'),
+            'plan-environment-parameters.yaml': ({}, 'Foo: bar\n'),
+        })
+
+        env = plan_utils.get_env(self.swift, self.container)
+
+        self.assertEqual({'name': 'overcloud',
+                          'template': 'overcloud.yaml',
+                          'parameter_defaults': {'Foo': 'bar'}}, env)
+
+    def test_get_env_missing_section_inline(self):
+        self.swift.get_object.side_effect = self._get_object({
+            'plan-environment.yaml': (
+                {}, 'name: overcloud\nseparate_sections:\n'
+                    '- parameter_defaults\n- passwords\n'
+                    'passwords:\n  AdminPassword: aaaa\n'
+                    'template: overcloud.yaml\n'),
+            'plan-environment-parameters.yaml': ({}, 'Foo: bar\n'),
+        })
+
+        env, versions = plan_utils._get_env(self.swift, self.container)
+
+        self.assertEqual({'name': 'overcloud',
+                          'template': 'overcloud.yaml',
+                          'parameter_defaults': {'Foo': 'bar'},
+                          'passwords': {'AdminPassword': 'aaaa'}}, env)
+        self.assertNotIn('plan-environment-passwords.yaml', versions)
+
+    def test_get_env_section_error(self):
+        def get_object(container, name, headers=None):
+            if name == 'plan-environment.yaml':
+                return {}, ('name: overcloud\nseparate_sections:\n'
+                            '- parameter_defaults\n')
+            raise swiftexceptions.ClientException('Error', http_status=500)
+        self.swift.get_object.side_effect = get_object
+
+        self.assertRaises(swiftexceptions.ClientException,
+                          plan_utils.get_env, self.swift, self.container)
+
+    def test_put_env_separate_sections(self):
+        self.swift.url = 'http://swift/v1/AUTH_test'
+        self.swift.put_object.side_effect = ['a', 'b', 'c']
+        env = {'name': self.container, 'template': 'overcloud.yaml',
+               'parameter_defaults': {'Foo': 'bar'},
+               'passwords': {'AdminPassword': 'aaaa'}}
+
+        plan_utils.put_env(self.swift, env)
+
+        self.assertEqual([
+            mock.call(self.container, 'plan-environment-parameters.yaml',
+                      'Foo: bar\n'),
+            mock.call(self.container, 'plan-environment-passwords.yaml',
+                      'AdminPassword: aaaa\n'),
+            mock.call(self.container, 'plan-environment.yaml',
+                      'name: overcloud\nseparate_sections:\n'
+                      '- parameter_defaults\n- passwords\n'
+                      'template: overcloud.yaml\n'),
+        ], self.swift.put_object.call_args_list)
+
+    def test_put_env_unchanged_sections(self):
+        self.swift.url = 'http://swift/v1/AUTH_test'
+        self.swift.put_object.side_effect = ['a', 'b', 'c', 'd']
+        env = {'name': self.container, 'template': 'overcloud.yaml',
+               'parameter_defaults': {'Foo': 'bar'},
+               'passwords': {'AdminPassword': 'aaaa'}}
+        plan_utils.put_env(self.swift, env)
+        self.swift.put_object.reset_mock()
+
+        env['parameter_defaults']['Foo'] = 'baz'
+        plan_utils.put_env(self.swift, env)
+
+        # only the changed section is uploaded again
+        self.swift.put_object.assert_called_once_with(
+            self.container, 'plan-environment-parameters.yaml', 'Foo: baz\n')
+
+    def test_put_env_removed_section(self):
+        self.swift.url = 'http://swift/v1/AUTH_test'
+        self.swift.put_object.side_effect = ['a', 'b', 'c']
+        env = {'name': self.container, 'template': 'overcloud.yaml',
+               'parameter_defaults': {'Foo': 'bar'}}
+        plan_utils.put_env(self.swift, env)
+
+        del env['parameter_defaults']
+        plan_utils.put_env(self.swift, env)
+
+        self.swift.put_object.assert_called_with(
+            self.container, 'plan-environment.yaml',
+            'name: overcloud\ntemplate: overcloud.yaml\n')
+        self.swift.delete_object.assert_called_once_with(
+            self.container, 'plan-environment-parameters.yaml')
@@ -13,9 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import mock
 
+from swiftclient import exceptions as swiftexceptions
+
 from tripleo_common.tests import base
+from tripleo_common.utils import cache
 from tripleo_common.utils import swift as swift_utils
 
 
@@ -23,11 +27,10 @@ class SwiftTest(base.TestCase):
     def setUp(self):
         super(SwiftTest, self).setUp()
         self.container_name = 'overcloud'
-        self.swiftclient = mock.MagicMock()
-        self.swiftclient.get_account.return_value = ({}, [
-            {'name': self.container_name},
-            {'name': 'test'},
-        ])
+        self.swiftclient = mock.MagicMock(url='http://swift/v1/AUTH_test',
+                                          token='token')
+        self.swiftclient.head_container.return_value = {
+            'x-container-meta-usage-tripleo': 'plan'}
         self.swiftclient.get_container.return_value = (
             {'x-container-meta-usage-tripleo': 'plan'}, [
                 {'name': 'some-name.yaml'},
@@ -36,42 +39,249 @@ class SwiftTest(base.TestCase):
                 {'name': 'finally-another-name.yaml'}
             ]
         )
+        self.swiftclient.get_capabilities.return_value = {
+            'bulk_delete': {'max_deletes_per_request': 3}}
+        self.swiftclient.post_account.return_value = ({}, json.dumps({
+            'Number Deleted': 3, 'Number Not Found': 0,
+            'Response Status': '200 OK', 'Errors': []}))
+
+        session_patcher = mock.patch.object(swift_utils, 'get_session')
+        self.session = session_patcher.start().return_value
+        self.addCleanup(session_patcher.stop)
 
     def test_delete_container_success(self):
         swift_utils.empty_container(self.swiftclient, self.container_name)
 
-        mock_calls = [
-            mock.call('overcloud', 'some-name.yaml'),
-            mock.call('overcloud', 'some-other-name.yaml'),
-            mock.call('overcloud', 'yet-some-other-name.yaml'),
-            mock.call('overcloud', 'finally-another-name.yaml')
-        ]
-        self.swiftclient.delete_object.assert_has_calls(
-            mock_calls, any_order=True)
+        headers = {'Accept': 'application/json',
+                   'Content-Type': 'text/plain'}
+        self.swiftclient.post_account.assert_has_calls([
+            mock.call(headers=headers,
+                      data=b'/overcloud/some-name.yaml\n'
+                           b'/overcloud/some-other-name.yaml\n'
+                           b'/overcloud/yet-some-other-name.yaml',
+                      query_string='bulk-delete'),
+            mock.call(headers=headers,
+                      data=b'/overcloud/finally-another-name.yaml',
+                      query_string='bulk-delete'),
+        ])
+        self.swiftclient.delete_object.assert_not_called()
+
+        self.swiftclient.head_container.assert_called_once_with(
+            self.container_name)
+        self.swiftclient.get_container.assert_called_with(
+            self.container_name, full_listing=True)
+
+    def test_empty_container_forgets_plan_files(self):
+        url = 'http://swift/v1/AUTH_test/overcloud'
+        swift_utils._plan_files.set(url, ({}, 0))
+        self.addCleanup(swift_utils._plan_files.clear)
+
+        swift_utils.empty_container(self.swiftclient, self.container_name)
+
+        self.assertIsNone(swift_utils._plan_files.get(url))
+
+    def test_delete_container_without_bulk_delete(self):
+        self.swiftclient.get_capabilities.return_value = {}
+        self.session.delete.return_value = mock.Mock(status_code=204)
+
+        swift_utils.empty_container(self.swiftclient, self.container_name)
+
+        self.swiftclient.post_account.assert_not_called()
+        self.session.delete.assert_has_calls([
+            mock.call('http://swift/v1/AUTH_test/overcloud/%s' % name,
+                      headers={'X-Auth-Token': 'token'})
+            for name in ('some-name.yaml', 'some-other-name.yaml',
+                         'yet-some-other-name.yaml',
+                         'finally-another-name.yaml')
+        ], any_order=True)
 
-        self.swiftclient.get_account.assert_called()
-        self.swiftclient.get_container.assert_called_with(self.container_name)
+    def test_delete_container_bulk_delete_errors(self):
+        self.swiftclient.post_account.return_value = ({}, json.dumps({
+            'Number Deleted': 2, 'Number Not Found': 0,
+            'Response Status': '400 Bad Request',
+            'Errors': [['/overcloud/some-name.yaml', '409 Conflict']]}))
+
+        self.assertRaises(swiftexceptions.ClientException,
+                          swift_utils.empty_container,
+                          self.swiftclient, self.container_name)
 
     def test_delete_container_not_found(self):
+        self.swiftclient.head_container.side_effect = (
+            swiftexceptions.ClientException('idontexist', http_status=404))
         self.assertRaises(ValueError,
                           swift_utils.empty_container,
                           self.swiftclient, 'idontexist')
-        self.swiftclient.get_account.assert_called()
         self.swiftclient.get_container.assert_not_called()
-        self.swiftclient.delete_object.assert_not_called()
+        self.swiftclient.post_account.assert_not_called()
 
     def test_delete_container_not_a_plan(self):
-        self.swiftclient.get_container.return_value = (
-            {'x-container-meta-usage-tripleo': 'not-a-plan'}, [
-                {'name': 'some-name.yaml'},
-                {'name': 'some-other-name.yaml'},
-                {'name': 'yet-some-other-name.yaml'},
-                {'name': 'finally-another-name.yaml'}
-            ]
-        )
+        self.swiftclient.head_container.return_value = {
+            'x-container-meta-usage-tripleo': 'not-a-plan'}
         self.assertRaises(ValueError,
                           swift_utils.empty_container,
                           self.swiftclient, self.container_name)
-        self.swiftclient.get_account.assert_called()
-        self.swiftclient.get_container.assert_called()
-        self.swiftclient.delete_object.assert_not_called()
+        self.swiftclient.head_container.assert_called()
+        self.swiftclient.get_container.assert_not_called()
+        self.swiftclient.post_account.assert_not_called()
+
+
+class PlanFileFetcherTest(base.TestCase):
+    def setUp(self):
+        super(PlanFileFetcherTest, self).setUp()
+        self.swiftclient = mock.MagicMock(url='http://swift/v1/AUTH_test')
+        self.swiftclient.get_container.return_value = ({}, [
+            {'name': 'overcloud.yaml', 'hash': 'abc'},
+            {'name': 'puppet/role.yaml', 'hash': 'def'},
+        ])
+        self.addCleanup(swift_utils._plan_files.clear)
+
+        session_patcher = mock.patch.object(swift_utils, 'get_session')
+        self.session = session_patcher.start().return_value
+        self.addCleanup(session_patcher.stop)
+
+        def _get(url, headers):
+            return mock.Mock(status_code=200,
+                             content=b'contents of ' + url.encode())
+        self.session.get.side_effect = _get
+
+    def test_prefetch(self):
+        fetcher = swift_utils.PlanFileFetcher(self.swiftclient, 'overcloud',
+                                              'token')
+        fetcher.prefetch()
+
+        self.swiftclient.get_container.assert_called_once_with(
+            'overcloud', full_listing=True)
+        self.session.get.assert_has_calls([
+            mock.call('http://swift/v1/AUTH_test/overcloud/overcloud.yaml',
+                      headers={'X-Auth-Token': 'token'}),
+            mock.call('http://swift/v1/AUTH_test/overcloud/puppet/role.yaml',
+                      headers={'X-Auth-Token': 'token'}),
+        ], any_order=True)
+        self.assertEqual(
+            b'contents of http://swift/v1/AUTH_test/overcloud/overcloud.yaml',
+            fetcher.object_request(
+                'GET', 'http://swift/v1/AUTH_test/overcloud/overcloud.yaml'))
+        self.session.request.assert_not_called()
+
+    def test_prefetch_reuses_unchanged_objects(self):
+        swift_utils.PlanFileFetcher(self.swiftclient, 'overcloud',
+                                    'token').prefetch()
+        self.session.get.reset_mock()
+        self.swiftclient.get_container.return_value = ({}, [
+            {'name': 'overcloud.yaml', 'hash': 'abc'},
+            {'name': 'puppet/role.yaml', 'hash': 'changed'},
+        ])
+
+        fetcher = swift_utils.PlanFileFetcher(self.swiftclient, 'overcloud',
+                                              'token')
+        fetcher.prefetch()
+
+        self.session.get.assert_called_once_with(
+            'http://swift/v1/AUTH_test/overcloud/puppet/role.yaml',
+            headers={'X-Auth-Token': 'token'})
+        self.assertEqual(['overcloud.yaml', 'puppet/role.yaml'],
+                         sorted(fetcher.files))
+
+    def test_add(self):
+        fetcher = swift_utils.PlanFileFetcher(self.swiftclient, 'overcloud',
+                                              'token')
+        fetcher.prefetch()
+        fetcher.add('rendered.yaml', 'ghi', b'rendered')
+
+        files, size = swift_utils._plan_files.get(
+            'http://swift/v1/AUTH_test/overcloud')
+        # the fetcher has its own copy of the shared files
+        self.assertIsNot(files, fetcher.files)
+        self.assertEqual(fetcher.files, files)
+        self.assertEqual(swift_utils._files_size(files), size)
+
+    @mock.patch.object(swift_utils, '_plan_files',
+                       new_callable=lambda: cache.LRUCache(60))
+    def test_prefetch_bounded(self, mock_plan_files):
+        fetcher = swift_utils.PlanFileFetcher(self.swiftclient, 'overcloud',
+                                              'token')
+        fetcher.prefetch()
+
+        # the files are bigger than the store, they aren't kept
+        self.assertEqual(2, len(fetcher.files))
+        self.assertEqual(0, len(mock_plan_files))
+
+    def test_object_request_not_prefetched(self):
+        fetcher = swift_utils.PlanFileFetcher(self.swiftclient, 'overcloud',
+                                              'token')
+        self.session.request.return_value = mock.Mock(content=b'remote')
+
+        self.assertEqual(b'remote', fetcher.object_request(
+            'GET', 'http://other/file.yaml'))
+        self.session.request.assert_called_once_with(
+            'GET', 'http://other/file.yaml',
+            headers={'X-Auth-Token': 'token'})
+
+    def test_add_virtual(self):
+        fetcher = swift_utils.PlanFileFetcher(self.swiftclient, 'overcloud',
+                                              'token')
+        fetcher.prefetch()
+
+        url = fetcher.add_virtual('overcloud.yaml', 'virtual')
+        self.assertEqual(
+            'http://swift/v1/AUTH_test/overcloud/overcloud.yaml', url)
+        self.assertEqual('virtual', fetcher.object_request('GET', url))
+        # the virtual object isn't shared with other fetchers
+        self.assertEqual(
+            b'contents of http://swift/v1/AUTH_test/overcloud/overcloud.yaml',
+            fetcher.get('overcloud.yaml'))
+
+
+class IterObjectsTest(base.TestCase):
+    def setUp(self):
+        super(IterObjectsTest, self).setUp()
+        self.swiftclient = mock.MagicMock(url='http://swift/v1/AUTH_test')
+
+        session_patcher = mock.patch.object(swift_utils, 'get_session')
+        self.session = session_patcher.start().return_value
+        self.addCleanup(session_patcher.stop)
+
+    def test_iter_objects(self):
+        def _get(url, headers):
+            return mock.Mock(status_code=200, content=url.encode())
+        self.session.get.side_effect = _get
+        names = ['file-%d.yaml' % i for i in range(20)]
+
+        result = list(swift_utils.iter_objects(
+            self.swiftclient, 'overcloud', names, 'token', workers=2))
+
+        self.assertEqual(
+            [(name, ('http://swift/v1/AUTH_test/overcloud/%s' % name).encode())
+             for name in names], result)
+
+    def test_iter_objects_not_found(self):
+        self.session.get.return_value = mock.Mock(status_code=404,
+                                                  reason='Not Found')
+
+        objects = swift_utils.iter_objects(
+            self.swiftclient, 'overcloud', ['missing.yaml'], 'token')
+
+        self.assertRaises(swiftexceptions.ClientException, list, objects)
+
+
+class HeadContainersTest(base.TestCase):
+
+    @mock.patch.object(swift_utils, 'get_session')
+    def test_head_containers(self, mock_get_session):
+        swiftclient = mock.MagicMock(url='http://swift/v1/AUTH_test',
+                                     token='token')
+
+        def _head(url, headers):
+            if url.endswith('/deleted'):
+                return mock.Mock(status_code=404)
+            return mock.Mock(status_code=204,
+                             headers={'X-Container-Meta-Usage-Tripleo': url})
+        mock_get_session.return_value.head.side_effect = _head
+
+        self.assertEqual({
+            'overcloud': {'x-container-meta-usage-tripleo':
+                          'http://swift/v1/AUTH_test/overcloud'},
+            'logs': {'x-container-meta-usage-tripleo':
+                     'http://swift/v1/AUTH_test/logs'},
+        }, swift_utils.head_containers(swiftclient,
+                                       ['overcloud', 'logs', 'deleted']))
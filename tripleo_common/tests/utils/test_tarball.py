@@ -0,0 +1,84 @@
+# Copyright 2017 Red Hat, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import io
+import mock
+import os
+import shutil
+import tarfile
+import tempfile
+
+from tripleo_common.tests import base
+from tripleo_common.utils import tarball
+
+
+class StreamTarballTest(base.TestCase):
+
+    def test_stream_tarball(self):
+        members = [('overcloud.yaml', b'heat_template_version: 2016-10-14'),
+                   ('puppet/role.yaml', u'resources: {}')]
+
+        chunks = list(tarball.stream_tarball(iter(members)))
+
+        self.assertGreater(len(chunks), 1)
+        with tarfile.open(fileobj=io.BytesIO(b''.join(chunks))) as tar:
+            self.assertEqual(['overcloud.yaml', 'puppet/role.yaml'],
+                             tar.getnames())
+            self.assertEqual(b'resources: {}',
+                             tar.extractfile('puppet/role.yaml').read())
+
+    def test_stream_tarball_empty(self):
+        contents = b''.join(tarball.stream_tarball([]))
+
+        with tarfile.open(fileobj=io.BytesIO(contents)) as tar:
+            self.assertEqual([], tar.getnames())
+
+
+class DirectoryTarballTest(base.TestCase):
+
+    def setUp(self):
+        super(DirectoryTarballTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for path in ('overcloud.yaml', 'puppet/role.yaml',
+                     '.git/config', 'puppet/.tox/env', 'tools/script.pyc',
+                     'tools/script.py'):
+            path = os.path.join(self.directory, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('contents of %s' % os.path.basename(path))
+
+    def test_iter_directory(self):
+        self.assertEqual([
+            ('overcloud.yaml', b'contents of overcloud.yaml'),
+            ('puppet/role.yaml', b'contents of role.yaml'),
+            ('tools/script.py', b'contents of script.py'),
+        ], list(tarball.iter_directory(self.directory)))
+
+    def test_directory_extract_to_swift_container(self):
+        swift = mock.MagicMock()
+
+        tarball.directory_extract_to_swift_container(
+            swift, self.directory, 'overcloud', compresslevel=1)
+
+        swift.put_object.assert_called_once_with(
+            container='overcloud', obj='', contents=mock.ANY,
+            query_string='extract-archive=tar.gz',
+            headers={'X-Detect-Content-Type': 'true'})
+        contents = b''.join(swift.put_object.call_args[1]['contents'])
+        with tarfile.open(fileobj=io.BytesIO(contents)) as tar:
+            self.assertEqual(
+                ['overcloud.yaml', 'puppet/role.yaml', 'tools/script.py'],
+                tar.getnames())
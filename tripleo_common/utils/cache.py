@@ -0,0 +1,156 @@
+# Copyright 2017 Red Hat, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import hashlib
+import json
+import threading
+import time
+import zlib
+
+import msgpack
+
+from tripleo_common import constants
+
+
+# Sentinel telling apart missing entries from entries storing None
+_MISSING = object()
+
+
+class LRUCache(object):
+    """Thread safe, process local least recently used cache
+
+    Entries are evicted once the accumulated size of the stored values goes
+    over max_size. By default every entry has a size of one, so max_size is
+    the maximum number of entries. When a ttl (in seconds) is given, entries
+    older than that are discarded on lookup. on_evict, when given, is called
+    with the key and the value of the entries which are evicted, expired or
+    replaced, once the lock of the cache is released.
+    """
+
+    def __init__(self, max_size, ttl=None, on_evict=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size, stored_at = self._entries.pop(key)
+            except KeyError:
+                return default
+            if self.ttl is None or time.time() - stored_at <= self.ttl:
+                # re-insert to mark it as the most recently used
+                self._entries[key] = (value, size, stored_at)
+                return value
+            self.size -= size
+        self._evicted([(key, value)])
+        return default
+
+    def set(self, key, value, size=1):
+        evicted = []
+        with self._lock:
+            previous = self._pop(key, _MISSING)
+            if previous is not _MISSING and previous is not value:
+                evicted.append((key, previous))
+            if size <= self.max_size:
+                self._entries[key] = (value, size, time.time())
+                self.size += size
+                while self.size > self.max_size:
+                    oldest = next(iter(self._entries))
+                    evicted.append((oldest, self._pop(oldest)))
+        self._evicted(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _pop(self, key, default=None):
+        try:
+            value, size, _ = self._entries.pop(key)
+        except KeyError:
+            return default
+        self.size -= size
+        return value
+
+    def _evicted(self, entries):
+        if self.on_evict is not None:
+            for key, value in entries:
+                self.on_evict(key, value)
+
+
+def digest(data):
+    """Return the sha256 hex digest of the JSON representation of data
+
+    Dictionaries are serialized with sorted keys, so equal data always
+    produces the same digest.
+    """
+    serialized = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+class Codec(object):
+    """Serializes and compresses the objects stored in the cache
+
+    The contents must be jsonable. encode returns the compressed bytes and
+    the size of the serialized contents, decode does the reverse.
+    """
+
+    def __init__(self, dumps, loads):
+        self._dumps = dumps
+        self._loads = loads
+
+    def encode(self, contents, compresslevel=constants.CACHE_COMPRESSLEVEL):
+        data = self._dumps(contents)
+        return zlib.compress(data, compresslevel), len(data)
+
+    def decode(self, body):
+        try:
+            data = zlib.decompress(body)
+            return self._loads(data), len(data)
+        except Exception as err:
+            # whichever the codec, the object is unusable
+            raise ValueError("Invalid cache object: %s" % err)
+
+
+CODECS = {
+    'json+zlib': Codec(lambda contents: json.dumps(contents).encode(),
+                       lambda data: json.loads(data.decode())),
+    'msgpack+zlib': Codec(
+        lambda contents: msgpack.packb(contents, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False)),
+}
+
+
+def get_codec(name):
+    """Return the codec called name, ValueError if it is unknown."""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown cache codec %s" % name)
@@ -0,0 +1,179 @@
+# Copyright 2017 Red Hat, Inc.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import datetime
+import threading
+import time
+
+from oslo_utils import timeutils
+import six
+
+from tripleo_common.utils import cache
+
+
+def _token_expiry(context):
+    """Expiry time of the token of the context, None if unknown"""
+    expires_at = getattr(context, 'expires_at', None)
+    if isinstance(expires_at, six.string_types):
+        try:
+            expires_at = timeutils.parse_isotime(expires_at)
+        except ValueError:
+            return None
+    if isinstance(expires_at, datetime.datetime):
+        return timeutils.normalize_time(expires_at)
+
+
+class ClientRegistry(object):
+    """Process wide registry of service clients
+
+    Clients are keyed by service, project and token, so the actions run
+    with the same credentials share them along with their keep-alive HTTP
+    connections. Clients which are not thread safe are shared through a
+    PooledClient. An entry is dropped once the token it was created with
+    expired, and the idle connections of the PooledClient of a dropped or
+    evicted entry are closed.
+    """
+
+    def __init__(self, max_size):
+        self._clients = cache.LRUCache(max_size, on_evict=self._dropped)
+
+    @staticmethod
+    def _dropped(key, entry):
+        client = entry[0]
+        if isinstance(client, PooledClient):
+            client.close()
+
+    def get(self, service, context, factory):
+        """Return the client of the service, created by factory if needed"""
+        key = (service, context.project_id, context.auth_token)
+
+        entry = self._clients.get(key)
+        if entry is not None:
+            client, expires_at = entry
+            if expires_at is None or expires_at > timeutils.utcnow():
+                return client
+            entry = self._clients.pop(key)
+            if entry is not None:
+                self._dropped(key, entry)
+
+        client = factory()
+        self._clients.set(key, (client, _token_expiry(context)))
+        return client
+
+    def clear(self):
+        self._clients.clear()
+
+
+class ConnectionPool(object):
+    """Thread safe pool of connections which can't be shared by threads
+
+    A connection is checked out for the exclusive use of a thread, and
+    returned to the pool afterwards. Up to max_idle returned connections are
+    kept for reuse, the others are closed. Once the pool is closed, the
+    connections returned to it are closed too.
+    """
+
+    def __init__(self, factory, max_idle):
+        self.max_idle = max_idle
+        self._factory = factory
+        self._idle = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._factory()
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                if not self._closed and len(self._idle) < self.max_idle:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        """Close the idle connections and stop keeping returned ones"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class PooledClient(object):
+    """Thread safe client calling its methods on pooled connections
+
+    Every method call checks out a connection from the pool for its
+    duration, so the client can be shared by the actions and the threads
+    using the same credentials. The attributes given, such as the URL and
+    the token of the connections, are set on the client.
+    """
+
+    def __init__(self, pool, **attributes):
+        self._pool = pool
+        self.__dict__.update(attributes)
+
+    def close(self):
+        """Close the idle connections of the pool"""
+        self._pool.close()
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            with self._pool.connection() as conn:
+                return getattr(conn, name)(*args, **kwargs)
+        call.__name__ = name
+        return call
+
+
+class EndpointResolver(object):
+    """Memoized lookup of service endpoints
+
+    lookup is called with the service name to find its endpoint in the
+    service catalog. The result is kept per service and project for ttl
+    seconds, or until it is invalidated.
+    """
+
+    def __init__(self, lookup, ttl):
+        self.ttl = ttl
+        self._lookup = lookup
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def get(self, service, context):
+        key = (service, context.project_id)
+        with self._lock:
+            entry = self._endpoints.get(key)
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            return entry[0]
+
+        endpoint = self._lookup(service)
+        with self._lock:
+            self._endpoints[key] = (endpoint, time.time())
+        return endpoint
+
+    def invalidate(self, service=None):
+        """Forget the endpoints of a service, or all of them"""
+        with self._lock:
+            if service is None:
+                self._endpoints.clear()
+                return
+            for key in [k for k in self._endpoints if k[0] == service]:
+                del self._endpoints[key]
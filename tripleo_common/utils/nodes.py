@@ -15,11 +15,13 @@
 
 import logging
 import re
+import threading
 
-from oslo_utils import netutils
+from concurrent import futures
 import six
 
 from oslo_concurrency import processutils
+from tripleo_common import constants
 from tripleo_common import exception
 from tripleo_common.utils import glance
 
@@ -36,16 +38,22 @@ class DriverInfo(object):
         self._mapping = mapping
         self._deprecated_mapping = deprecated_mapping or {}
         self._mandatory_fields = mandatory_fields
+        # the translation of the mapped keys, and whether they are deprecated,
+        # built once so converting a key is a single lookup
+        self._keys = {key: (real, True)
+                      for key, real in self._deprecated_mapping.items()}
+        self._keys.update((key, (real, False))
+                          for key, real in self._mapping.items())
 
     def convert_key(self, key):
-        if key in self._mapping:
-            return self._mapping[key]
-        elif key in self._deprecated_mapping:
-            real = self._deprecated_mapping[key]
-            LOG.warning('Key %s is deprecated, please use %s',
-                        key, real)
+        if key in self._keys:
+            real, deprecated = self._keys[key]
+            if deprecated:
+                LOG.warning('Key %s is deprecated, please use %s',
+                            key, real)
             return real
-        elif key.startswith(self._prefix):
+
+        if key.startswith(self._prefix):
             return key
         elif key != 'pm_type' and key.startswith('pm_'):
             LOG.warning('Key %s is not supported and will not be passed',
@@ -254,10 +262,35 @@ DRIVER_INFO = {
 }
 
 
+def _compile_driver_info(driver_info):
+    """Compile the patterns of a driver handler registry into one regex
+
+    The patterns are tried in the order of the registry, the group of each
+    one is named after its index.
+    """
+    return re.compile('|'.join(
+        '(?P<d%d>%s)' % (index, driver_tpl)
+        for index, driver_tpl in enumerate(driver_info)))
+
+
+_DRIVER_RE = _compile_driver_info(DRIVER_INFO)
+_DRIVER_INFO_HANDLERS = list(DRIVER_INFO.values())
+# the handlers of the drivers already looked up, by driver name
+_DRIVER_HANDLERS = {}
+
+
 def _find_driver_handler(driver):
-    for driver_tpl, handler in DRIVER_INFO.items():
-        if re.match(driver_tpl, driver) is not None:
-            return handler
+    try:
+        return _DRIVER_HANDLERS[driver]
+    except KeyError:
+        pass
+
+    match = _DRIVER_RE.match(driver)
+    if match is not None:
+        # the outermost group of the matching pattern is the last closed
+        handler = _DRIVER_INFO_HANDLERS[int(match.lastgroup[1:])]
+        _DRIVER_HANDLERS[driver] = handler
+        return handler
 
     # FIXME(dtantsur): handle all drivers without hardcoding them
     raise exception.InvalidNode('unknown pm_type (ironic driver to use): '
@@ -273,7 +306,14 @@ def _find_node_handler(fields):
     return _find_driver_handler(driver)
 
 
-def register_ironic_node(node, client):
+def _validate_power(ironic_node_uuid, client):
+    validation = client.node.validate(ironic_node_uuid)
+    if not validation.power['result']:
+        LOG.warning('Node %s did not pass power credentials validation: %s',
+                    ironic_node_uuid, validation.power['reason'])
+
+
+def register_ironic_node(node, client, validate_power=True):
     driver_info = {}
     handler = _find_node_handler(node)
 
@@ -310,25 +350,35 @@ def register_ironic_node(node, client):
     LOG.debug('Registering node %s with ironic.', node_id)
     ironic_node = client.node.create(**create_map)
 
-    for mac in node.get("mac", []):
-        client.port.create(address=mac, node_uuid=ironic_node.uuid)
+    macs = node.get("mac", [])
+    if len(macs) > 1:
+        with futures.ThreadPoolExecutor(len(macs)) as executor:
+            jobs = [executor.submit(client.port.create, address=mac,
+                                    node_uuid=ironic_node.uuid)
+                    for mac in macs]
+        for job in jobs:
+            job.result()
+    else:
+        for mac in macs:
+            client.port.create(address=mac, node_uuid=ironic_node.uuid)
 
-    validation = client.node.validate(ironic_node.uuid)
-    if not validation.power['result']:
-        LOG.warning('Node %s did not pass power credentials validation: %s',
-                    ironic_node.uuid, validation.power['reason'])
+    if validate_power:
+        _validate_power(ironic_node.uuid, client)
 
     return ironic_node
 
 
 def _populate_node_mapping(client):
+    """Index the registered nodes by MAC address, unique ID and UUID
+
+    The nodes and their ports are listed with one paginated request each,
+    instead of one request per node for the ports.
+    """
     LOG.debug('Populating list of registered nodes.')
-    node_map = {'mac': {}, 'pm_addr': {}, 'uuids': set()}
-    nodes = client.node.list(detail=True)
+    node_map = {'mac': {}, 'pm_addr': {}, 'uuids': set(), 'nodes': {}}
+    nodes = client.node.list(detail=True, limit=0)
     for node in nodes:
-        for port in client.node.list_ports(node.uuid):
-            node_map['mac'][port.address] = node.uuid
-
+        node_map['nodes'][node.uuid] = node
         handler = _find_driver_handler(node.driver)
         unique_id = handler.unique_id_from_node(node)
         if unique_id:
@@ -336,6 +386,10 @@ def _populate_node_mapping(client):
 
         node_map['uuids'].add(node.uuid)
 
+    for port in client.port.list(detail=True, limit=0):
+        if port.node_uuid in node_map['uuids']:
+            node_map['mac'][port.address] = port.node_uuid
+
     return node_map
 
 
@@ -376,13 +430,38 @@ _NON_DRIVER_FIELDS = {'cpu': '/properties/cpus',
                       'capabilities': '/properties/capabilities'}
 
 
-def _update_or_register_ironic_node(node, node_map, client):
+# The value of the driver_info fields hidden by Ironic, such as passwords
+_MASKED_VALUE = '******'
+
+
+def _is_unchanged(ironic_node, path, value):
+    """Whether the field of the Ironic node at path already has value"""
+    parts = path.split('/')[1:]
+    current = getattr(ironic_node, parts[0], None)
+    for part in parts[1:]:
+        if not isinstance(current, dict):
+            return False
+        current = current.get(part)
+    if current is None or current == _MASKED_VALUE:
+        return False
+    if path == '/properties/capabilities':
+        try:
+            return capabilities_to_dict(current) == capabilities_to_dict(
+                value)
+        except (ValueError, TypeError):
+            return False
+    return six.text_type(current) == value
+
+
+def _update_or_register_ironic_node(node, node_map, client,
+                                    validate_power=True):
     handler = _find_node_handler(node)
     node_uuid = _get_node_id(node, handler, node_map)
 
     if node_uuid:
-        LOG.info('Node %s already registered, updating details.',
-                 node_uuid)
+        # the details of the node, when it was listed by
+        # _populate_node_mapping
+        current = node_map.get('nodes', {}).get(node_uuid)
 
         patched = {}
         for field, path in _NON_DRIVER_FIELDS.items():
@@ -397,18 +476,125 @@ def _update_or_register_ironic_node(node, node_map, client):
         for key, value in patched.items():
             if key == 'uuid':
                 continue  # not needed during update
+            value = six.text_type(value)
+            if current is not None and _is_unchanged(current, key, value):
+                continue
             node_patch.append({'path': key,
-                               'value': six.text_type(value),
+                               'value': value,
                                'op': 'add'})
+
+        if current is not None and not node_patch:
+            LOG.info('Node %s already registered and up to date.',
+                     node_uuid)
+            return current
+
+        LOG.info('Node %s already registered, updating details.',
+                 node_uuid)
         ironic_node = client.node.update(node_uuid, node_patch)
     else:
-        ironic_node = register_ironic_node(node, client)
+        ironic_node = register_ironic_node(node, client,
+                                           validate_power=validate_power)
 
     return ironic_node
 
 
-def _clean_up_extra_nodes(seen, client, remove=False):
-    all_nodes = {n.uuid for n in client.node.list()}
+def _node_map_keys(node, handler):
+    """The keys of node_map a node is known by"""
+    keys = [('mac', mac.lower()) for mac in node.get('mac', [])]
+    unique_id = handler.unique_id_from_fields(node)
+    if unique_id:
+        keys.append(('pm_addr', unique_id))
+    if node.get('uuid'):
+        keys.append(('uuids', node['uuid']))
+    return keys
+
+
+def register_nodes(nodes_list, client, node_map,
+                   workers=constants.DEFAULT_NODE_REGISTRATION_WORKERS):
+    """Register or update the nodes of nodes_list concurrently
+
+    Up to workers nodes are registered or updated at the same time. A node
+    sharing a MAC address, unique ID or UUID with a previous node of the
+    list waits for it, and is then looked up in node_map as if the nodes
+    were registered one after the other. The power credentials of the new
+    nodes are validated once they are all registered.
+
+    :param nodes_list: The list of nodes to register.
+    :param client: An Ironic client object.
+    :param node_map: The registered nodes, as built by
+                     _populate_node_mapping. It is updated with the nodes
+                     registered.
+    :param workers: The maximum number of nodes registered concurrently.
+    :return: a list of (Ironic node, error) tuples in the order of
+             nodes_list, where either the node or the error is None.
+    """
+    lock = threading.Lock()
+
+    def _register(node, keys, previous):
+        futures.wait(previous)
+        # node_map isn't changed concurrently for the keys of this node,
+        # as the nodes sharing them are done
+        ironic_node = _update_or_register_ironic_node(
+            node, node_map, client, validate_power=False)
+        with lock:
+            new = ironic_node.uuid not in node_map['uuids']
+            for kind, key in keys:
+                if kind != 'uuids':
+                    node_map[kind][key] = ironic_node.uuid
+            node_map['uuids'].add(ironic_node.uuid)
+            node_map.setdefault('nodes', {})[ironic_node.uuid] = ironic_node
+        return ironic_node, new
+
+    def _validate(ironic_node_uuid):
+        try:
+            _validate_power(ironic_node_uuid, client)
+        except Exception as err:
+            LOG.warning('Unable to validate the power credentials of node '
+                        '%s: %s', ironic_node_uuid, err)
+
+    results = []
+    with futures.ThreadPoolExecutor(workers) as executor:
+        jobs = []
+        claims = {}
+        for node in nodes_list:
+            try:
+                keys = _node_map_keys(node, _find_node_handler(node))
+            except exception.InvalidNode as err:
+                jobs.append(err)
+                continue
+            # the jobs are started in order, so the previous ones are
+            # already running when this one waits for them
+            previous = set(claims[key] for key in keys if key in claims)
+            job = executor.submit(_register, node, keys, previous)
+            claims.update((key, job) for key in keys)
+            jobs.append(job)
+
+        created = []
+        for job in jobs:
+            if isinstance(job, Exception):
+                results.append((None, job))
+                continue
+            try:
+                ironic_node, new = job.result()
+            except Exception as err:
+                results.append((None, err))
+                continue
+            results.append((ironic_node, None))
+            if new:
+                created.append(ironic_node.uuid)
+
+        # the validation results are only logged
+        list(executor.map(_validate, created))
+
+    return results
+
+
+def _clean_up_extra_nodes(seen, client, remove=False, node_map=None):
+    if node_map is not None:
+        # the nodes known to the index built by _populate_node_mapping
+        all_nodes = node_map['uuids']
+    else:
+        all_nodes = {n.uuid for n in client.node.list(limit=0)}
     remove_func = client.node.delete
     extra_nodes = all_nodes - {n.uuid for n in seen}
     for node in extra_nodes:
@@ -430,6 +616,8 @@ def register_all_nodes(nodes_list, client, remove=False, glance_client=None,
     :param kernel_name: Glance ID of the kernel to use for the nodes.
     :param ramdisk_name: Glance ID of the ramdisk to use for the nodes.
     :return: list of node objects representing the new nodes.
+    :raises: NodeRegistrationError when some of the nodes couldn't be
+             registered or updated, once all the others are.
     """
 
     LOG.debug('Registering all nodes.')
@@ -440,36 +628,64 @@ def register_all_nodes(nodes_list, client, remove=False, glance_client=None,
         glance_ids = glance.create_or_find_kernel_and_ramdisk(
             glance_client, kernel_name, ramdisk_name)
 
-    seen = []
     for node in nodes_list:
         if glance_ids['kernel'] and 'kernel_id' not in node:
             node['kernel_id'] = glance_ids['kernel']
         if glance_ids['ramdisk'] and 'ramdisk_id' not in node:
             node['ramdisk_id'] = glance_ids['ramdisk']
 
-        node = _update_or_register_ironic_node(node, node_map, client=client)
-        seen.append(node)
+    results = register_nodes(nodes_list, client, node_map)
+    errors = [(index, err) for index, (_, err) in enumerate(results)
+              if err is not None]
+    if errors:
+        raise exception.NodeRegistrationError(errors)
 
-    _clean_up_extra_nodes(seen, client, remove=remove)
+    seen = [ironic_node for ironic_node, _ in results]
+    _clean_up_extra_nodes(seen, client, remove=remove, node_map=node_map)
 
     return seen
 
 
+# The format of the MAC addresses accepted by netutils.is_valid_mac, once
+# lower cased
+_MAC_RE = re.compile('^[0-9a-f]{2}(:[0-9a-f]{2}){5}$')
+
+
 def validate_nodes(nodes_list):
     """Validate all nodes list.
 
+    All the nodes are validated in a single pass, and the failures of every
+    node are reported in the order of the list. MAC addresses are compared
+    case insensitively, as when registering the nodes.
+
     :param nodes_list: The list of nodes to register.
     :raises: InvalidNode on one or more invalid nodes
     """
     failures = []
-    unique_ids = set()
-    names = set()
-    macs = set()
+    # the handler, or the error finding it, of each pm_type
+    handlers = {}
+    # whether each field is known, by pm_type
+    known_fields = {}
+    # the index of the first node with each unique ID, name and MAC
+    unique_ids = {}
+    names = {}
+    macs = {}
     for index, node in enumerate(nodes_list):
         # Remove any comment
         node.pop("_comment", None)
 
-        handler = _find_node_handler(node)
+        pm_type = node.get('pm_type')
+        try:
+            handler = handlers[pm_type]
+        except KeyError:
+            try:
+                handler = _find_node_handler(node)
+            except exception.InvalidNode as exc:
+                handler = exc
+            handlers[pm_type] = handler
+        if isinstance(handler, exception.InvalidNode):
+            failures.append((index, handler))
+            continue
 
         try:
             handler.validate(node)
@@ -477,30 +693,38 @@ def validate_nodes(nodes_list):
             failures.append((index, exc))
 
         for mac in node.get('mac', ()):
-            if not netutils.is_valid_mac(mac):
+            if isinstance(mac, six.string_types):
+                normalized = mac.lower()
+            else:
+                normalized = mac
+            if (not isinstance(mac, six.string_types) or
+                    not _MAC_RE.match(normalized)):
                 failures.append((index, 'MAC address %s is invalid' % mac))
 
-            if mac in macs:
+            if normalized in macs:
                 failures.append(
-                    (index, 'MAC %s is not unique' % mac))
+                    (index, 'MAC %s is not unique, it is used by node #%d'
+                     % (mac, macs[normalized])))
             else:
-                macs.add(mac)
+                macs[normalized] = index
 
         unique_id = handler.unique_id_from_fields(node)
         if unique_id:
             if unique_id in unique_ids:
                 failures.append(
                     (index,
-                     "Node identified by %s is already present" % unique_id))
+                     "Node identified by %s is already present as node #%d"
+                     % (unique_id, unique_ids[unique_id])))
             else:
-                unique_ids.add(unique_id)
+                unique_ids[unique_id] = index
 
         if node.get('name'):
             if node['name'] in names:
                 failures.append(
-                    (index, 'Name "%s" is not unique' % node['name']))
+                    (index, 'Name "%s" is not unique, it is used by node #%d'
+                     % (node['name'], names[node['name']])))
             else:
-                names.add(node['name'])
+                names[node['name']] = index
 
         try:
             capabilities_to_dict(node.get('capabilities'))
@@ -508,10 +732,16 @@ def validate_nodes(nodes_list):
             failures.append(
                 (index, 'Invalid capabilities: %s' % node.get('capabilities')))
 
+        fields = known_fields.setdefault(pm_type, {})
         for field in node:
-            converted = handler.convert_key(field)
-            if (converted is None and field not in _NON_DRIVER_FIELDS and
-                    field not in ('mac', 'pm_type')):
+            try:
+                known = fields[field]
+            except KeyError:
+                known = fields[field] = (
+                    handler.convert_key(field) is not None or
+                    field in _NON_DRIVER_FIELDS or
+                    field in ('mac', 'pm_type'))
+            if not known:
                 failures.append((index, 'Unknown field %s' % field))
 
     if failures:
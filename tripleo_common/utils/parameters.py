@@ -13,6 +13,7 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import uuid
 
 from tripleo_common import exception
 from tripleo_common.utils import nodes
@@ -33,6 +34,67 @@ PARAM_EXCEPTIONS = {
     }
 }
 
+# The namespace of the IDs of the resources of flattened resource trees
+RESOURCE_ID_NAMESPACE = uuid.UUID('7d1c2f5e-4b8a-5e36-9c0d-3f6e8a1b2c4d')
+
+# The attributes of the parameters returned by Heat, and their names in the
+# flattened parameters
+PARAMETER_KEYS = dict((key, key[0].lower() + key[1:]) for key in (
+    'AllowedPattern', 'AllowedValues', 'ConstraintDescription',
+    'Constraints', 'Default', 'Description', 'Immutable', 'Label',
+    'MaxLength', 'MaxValue', 'MinLength', 'MinValue', 'NoEcho', 'Tags',
+    'Type', 'Value'))
+
+
+def _lower_first(key):
+    try:
+        return PARAMETER_KEYS[key]
+    except KeyError:
+        return key[0].lower() + key[1:]
+
+
+def flatten_resource_tree(tree, name='Root'):
+    """Flatten the nested resource tree returned by Heat's validate
+
+    Returns a dictionary with the resources, by ID, and the parameters, by
+    name. The resources reference their nested resources and their
+    parameters by ID and name. The ID of a resource is derived from its
+    path in the tree, so it is the same every time the tree is flattened.
+    """
+    resources = {}
+    parameters = {}
+    root_id = str(uuid.uuid5(RESOURCE_ID_NAMESPACE, name))
+    # depth first, in the order the resources appear in the tree
+    stack = [(root_id, name, tree)]
+    while stack:
+        key, name, data = stack.pop()
+        value = {'name': name, 'id': key}
+        if 'Type' in data:
+            value['type'] = data['Type']
+        if 'Description' in data:
+            value['description'] = data['Description']
+        if 'Parameters' in data:
+            params = data['Parameters']
+            for param, attributes in params.items():
+                if param not in parameters:
+                    flat = dict((_lower_first(k), v)
+                                for k, v in attributes.items())
+                    flat['name'] = param
+                    parameters[param] = flat
+            value['parameters'] = list(params)
+        if 'ParameterGroups' in data:
+            value['parameter_groups'] = data['ParameterGroups']
+        if 'NestedParameters' in data:
+            namespace = uuid.UUID(key)
+            nested = [(str(uuid.uuid5(namespace, nested_name)),
+                       nested_name, nested_data)
+                      for nested_name, nested_data
+                      in data['NestedParameters'].items()]
+            value['resources'] = [nested_key for nested_key, _, _ in nested]
+            stack.extend(reversed(nested))
+        resources[key] = value
+    return {'resources': resources, 'parameters': parameters}
+
 
 def get_node_count(role, baremetal_client):
     count = 0
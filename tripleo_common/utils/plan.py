@@ -13,46 +13,306 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import copy
+import logging
+import time
+
+from swiftclient import exceptions as swiftexceptions
 import yaml
 
 from tripleo_common import constants
+from tripleo_common import exception
+from tripleo_common.utils import cache
+from tripleo_common.utils import swift as swiftutils
+
+LOG = logging.getLogger(__name__)
+
+# Use the libyaml bindings when they are available, they are a lot faster
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# Short lived cache of the plan names, keyed by the account URL
+_plan_list_cache = cache.LRUCache(64, ttl=constants.PLAN_LIST_CACHE_TTL)
+
+# Parsed plan environments, keyed by the plan container URL. Entries are
+# (etag, env) tuples.
+_env_cache = cache.LRUCache(constants.ENV_CACHE_MAX_SIZE)
 
 
 def update_in_env(swift, env, key, value='', delete_key=False):
-    """Update plan environment."""
-    if delete_key:
-        try:
-            del env[key]
-        except KeyError:
-            pass
-    else:
-        try:
-            env[key].update(value)
-        except (KeyError, AttributeError):
-            env[key] = value
+    """Update plan environment.
 
-    put_env(swift, env)
+    The change is applied to the latest version of the environment with
+    update_env, env is updated in place with the result.
+    """
+    updated = update_env_key(swift, env['name'], key, value, delete_key)
+    env.clear()
+    env.update(updated)
     return env
 
 
-def get_env(swift, name):
-    """Get plan environment from Swift and convert it to a dictionary."""
-    env = yaml.safe_load(
-        swift.get_object(name, constants.PLAN_ENVIRONMENT)[1]
-    )
+def update_env_key(swift, name, key, value='', delete_key=False):
+    """Update a key of the plan environment with update_env
+
+    A dictionary value is merged into the current one. Returns the stored
+    environment.
+    """
+    def _update(env):
+        if delete_key:
+            try:
+                del env[key]
+            except KeyError:
+                pass
+        else:
+            try:
+                env[key].update(value)
+            except (KeyError, AttributeError):
+                env[key] = value
+
+    return update_env(swift, name, _update)
+
+
+def _get_object(swift, container, name):
+    """Get a YAML object and its ETag, None if it is unknown."""
+    cache_key = swiftutils.get_object_url(swift, container, name)
+    cached = _env_cache.get(cache_key)
+    try:
+        if cached is not None:
+            headers, contents = swift.get_object(
+                container, name, headers={'If-None-Match': cached[0]})
+        else:
+            headers, contents = swift.get_object(container, name)
+    except swiftexceptions.ClientException as err:
+        if cached is None or err.http_status != 304:
+            raise
+        # not modified, callers are free to change the returned data
+        return copy.deepcopy(cached[1]), cached[0]
+
+    data = yaml.load(contents, Loader=_YamlLoader)
+    etag = headers.get('etag')
+    if etag:
+        _env_cache.set(cache_key, (etag, copy.deepcopy(data)))
+    return data, etag
+
+
+def _put_object(swift, container, name, data):
+    """Store data as a YAML object, unless it is known to be unchanged."""
+    cache_key = swiftutils.get_object_url(swift, container, name)
+    cached = _env_cache.get(cache_key)
+    if cached is not None and cached[1] == data:
+        return
+
+    contents = yaml.dump(data, Dumper=_YamlDumper, default_flow_style=False)
+    try:
+        new_etag = swift.put_object(container, name, contents)
+    except swiftexceptions.ClientException:
+        _env_cache.pop(cache_key)
+        raise
+    if new_etag:
+        _env_cache.set(cache_key, (new_etag, copy.deepcopy(data)))
+    else:
+        _env_cache.pop(cache_key)
+
+
+def _get_env(swift, name):
+    """Get the plan environment and the ETags of the objects it was read from
+
+    The sections of the environment listed in the main document are read
+    from their own objects. When the object of a section is missing, the
+    copy of the section in the main document, if any, is used instead.
+    """
+    env, etag = _get_object(swift, name, constants.PLAN_ENVIRONMENT)
+    versions = {constants.PLAN_ENVIRONMENT: etag}
+    for section in env.pop(constants.PLAN_ENVIRONMENT_SECTIONS_KEY, []):
+        obj = constants.PLAN_ENVIRONMENT_SECTIONS.get(section)
+        if obj is None:
+            LOG.warning('Ignoring the unknown section %s of the environment '
+                        'of plan %s' % (section, name))
+            continue
+        try:
+            data, versions[obj] = _get_object(swift, name, obj)
+        except swiftexceptions.ClientException as err:
+            if err.http_status != 404:
+                raise
+            LOG.warning('The %s object of plan %s is missing, %s' % (
+                obj, name, 'using the %s of %s instead' % (
+                    section, constants.PLAN_ENVIRONMENT)
+                if section in env else 'ignoring its %s' % section))
+            continue
+        if section in env:
+            LOG.warning('Ignoring the %s of %s in plan %s, they are read '
+                        'from %s' % (section, constants.PLAN_ENVIRONMENT,
+                                     name, obj))
+        env[section] = data
 
     # Ensure the name is correct, as it will be used to update the
     # container later
     if env.get('name') != name:
         env['name'] = name
 
-    return env
+    return env, versions
+
+
+def get_env(swift, name):
+    """Get plan environment from Swift and convert it to a dictionary.
+
+    The parsed environment is cached along with its ETag. When it is known,
+    the object is only downloaded and parsed again if it changed.
+    """
+    return _get_env(swift, name)[0]
+
+
+def put_env(swift, env, versions=None):
+    """Convert given environment to yaml and upload it to Swift.
+
+    The sections of PLAN_ENVIRONMENT_SECTIONS are stored in their own
+    objects, and only the objects whose contents changed are uploaded. When
+    given, versions maps the objects the environment was read from to their
+    ETags, as returned by _get_env.
+    """
+    container = env['name']
+    if versions is None:
+        versions = {}
+        cached = _env_cache.get(swiftutils.get_object_url(
+            swift, container, constants.PLAN_ENVIRONMENT))
+        previous = cached[1].get(constants.PLAN_ENVIRONMENT_SECTIONS_KEY,
+                                 []) if cached is not None else []
+    else:
+        previous = [section for section, obj
+                    in constants.PLAN_ENVIRONMENT_SECTIONS.items()
+                    if obj in versions]
+
+    main = dict(env)
+    sections = []
+    for section, obj in sorted(constants.PLAN_ENVIRONMENT_SECTIONS.items()):
+        if section in main:
+            sections.append(section)
+            _put_object(swift, container, obj, main.pop(section))
+    if sections:
+        main[constants.PLAN_ENVIRONMENT_SECTIONS_KEY] = sections
+    _put_object(swift, container, constants.PLAN_ENVIRONMENT, main)
+
+    # sections which were removed from the environment
+    for section in set(previous).difference(sections):
+        obj = constants.PLAN_ENVIRONMENT_SECTIONS[section]
+        _env_cache.pop(swiftutils.get_object_url(swift, container, obj))
+        try:
+            swift.delete_object(container, obj)
+        except swiftexceptions.ClientException as err:
+            if err.http_status != 404:
+                raise
+
+
+def _lock_env(swift, name):
+    """Lock the plan environment, returns False if it is already locked
+
+    The lock is an object which is only created when it doesn't exist yet,
+    as Swift honours If-None-Match on PUT. It expires after ENV_LOCK_TTL
+    seconds, so a lock left behind by a failed update doesn't block the
+    plan for ever.
+    """
+    try:
+        swift.put_object(name, constants.PLAN_ENVIRONMENT_LOCK, '',
+                         headers={'If-None-Match': '*',
+                                  'X-Delete-After': str(
+                                      constants.ENV_LOCK_TTL)})
+    except swiftexceptions.ClientException as err:
+        if err.http_status != 412:
+            raise
+        return False
+    return True
+
+
+def _unlock_env(swift, name):
+    try:
+        swift.delete_object(name, constants.PLAN_ENVIRONMENT_LOCK)
+    except swiftexceptions.ClientException as err:
+        if err.http_status != 404:
+            # the lock expires anyway
+            LOG.warning('Failed to unlock the environment of plan %s: %s' % (
+                name, err))
+
+
+def update_env(swift, name, mutate, retries=constants.ENV_UPDATE_RETRIES):
+    """Apply a change to the plan environment under the plan lock
+
+    mutate is called with the latest version of the environment and changes
+    it in place, and the result is stored before the lock is released.
+    While another update holds the lock, it is tried again every
+    ENV_LOCK_RETRY_DELAY seconds, up to retries times. Returns the stored
+    environment. PlanEnvironmentReadError is raised when the plan or its
+    environment can't be read, so callers don't need to read it beforehand.
+
+    Updates are only serialized with the other updates going through
+    update_env. An update taking longer than ENV_LOCK_TTL seconds may
+    overlap with the next one.
+    """
+    for attempt in range(retries + 1):
+        try:
+            locked = _lock_env(swift, name)
+        except swiftexceptions.ClientException as err:
+            if err.http_status != 404:
+                raise
+            # the plan container doesn't exist
+            raise exception.PlanEnvironmentReadError(err)
+        if locked:
+            try:
+                try:
+                    env, versions = _get_env(swift, name)
+                except swiftexceptions.ClientException as err:
+                    raise exception.PlanEnvironmentReadError(err)
+                mutate(env)
+                put_env(swift, env, versions)
+                return env
+            finally:
+                _unlock_env(swift, name)
+        if attempt < retries:
+            LOG.info('The environment of plan %s is being updated, '
+                     'waiting (%d/%d)' % (name, attempt + 1, retries))
+            time.sleep(constants.ENV_LOCK_RETRY_DELAY)
+    raise swiftexceptions.ClientException(
+        'The environment of plan %s is locked by another update' % name,
+        http_status=409)
+
+
+def get_plan_generation(swift, name):
+    """Get the generation of the plan, 0 if it was never changed."""
+    headers = swift.head_container(name)
+    return int(headers.get(constants.PLAN_GENERATION_KEY, 0))
+
+
+def bump_plan_generation(swift, name):
+    """Increase the generation of the plan and return the new value
+
+    The generation is stored in the plan container metadata and any data
+    derived from the plan, such as the plan cache, is only valid for the
+    generation it was computed against. The new value is at least the
+    current time in microseconds, so concurrent bumps of the same plan are
+    unlikely to produce the same generation.
+    """
+    generation = max(get_plan_generation(swift, name) + 1,
+                     int(time.time() * 1000000))
+    swift.post_container(
+        name, {constants.PLAN_GENERATION_KEY: str(generation)})
+    return generation
+
+
+def list_plans(swift):
+    """List the names of the plan containers of the account
+
+    A plan is a container marked with the TRIPLEO_META_USAGE_KEY metadata.
+    The result is cached for PLAN_LIST_CACHE_TTL seconds.
+    """
+    plans = _plan_list_cache.get(swift.url)
+    if plans is None:
+        names = [c['name'] for c in swift.get_account(full_listing=True)[1]]
+        headers = swiftutils.head_containers(swift, names)
+        plans = [name for name in names
+                 if constants.TRIPLEO_META_USAGE_KEY in headers.get(name, {})]
+        _plan_list_cache.set(swift.url, plans)
+    return list(plans)
 
 
-def put_env(swift, env):
-    """Convert given environment to yaml and upload it to Swift."""
-    swift.put_object(
-        env['name'],
-        constants.PLAN_ENVIRONMENT,
-        yaml.safe_dump(env, default_flow_style=False)
-    )
+def invalidate_plan_list(swift):
+    """Forget the cached list of plans after creating or deleting one."""
+    _plan_list_cache.pop(swift.url)
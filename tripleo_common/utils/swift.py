@@ -13,32 +13,324 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import collections
+import json
+import logging
+import threading
+
+from concurrent import futures
+import requests
+from requests import adapters
+from six.moves.urllib import parse as urlparse
+from swiftclient import exceptions as swiftexceptions
 
 from tripleo_common import constants
+from tripleo_common.utils import cache
+
+LOG = logging.getLogger(__name__)
+
+# Process wide HTTP session used for concurrent object requests. It keeps the
+# connections to the object store alive between calls.
+_session = None
+_session_lock = threading.Lock()
+
+# Content addressed store of plan files, keyed by the container URL. Each
+# value is a (files, size) tuple, files mapping an object name to an
+# (etag, contents) tuple and size being the total size of the contents.
+_plan_files = cache.LRUCache(constants.PLAN_FILES_CACHE_MAX_SIZE)
+_plan_files_lock = threading.Lock()
+
+
+def _files_size(files):
+    return sum(len(contents) for _, contents in files.values())
+
+
+def get_session():
+    """Return the shared, connection pooling HTTP session."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = adapters.HTTPAdapter(
+                pool_connections=constants.DEFAULT_SWIFT_WORKERS,
+                pool_maxsize=constants.DEFAULT_SWIFT_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def get_object_url(swiftclient, container, name=None):
+    """Build the URL of a container or of an object within it."""
+    url = '%s/%s' % (swiftclient.url, urlparse.quote(container))
+    if name is not None:
+        url = '%s/%s' % (url, urlparse.quote(name))
+    return url
+
+
+def get_object_contents(swiftclient, container, name, token):
+    """Download an object through the shared HTTP session."""
+    url = get_object_url(swiftclient, container, name)
+    resp = get_session().get(url, headers={'X-Auth-Token': token})
+    if resp.status_code < 200 or resp.status_code >= 300:
+        raise swiftexceptions.ClientException(
+            'Object GET failed', http_path=url,
+            http_status=resp.status_code, http_reason=resp.reason)
+    return resp.content
+
+
+def iter_objects(swiftclient, container, names, token,
+                 workers=constants.DEFAULT_SWIFT_WORKERS):
+    """Yield (name, contents) for the given objects, in order
+
+    Objects are downloaded concurrently, but only a bounded window of them
+    is read ahead of the consumer so memory use does not grow with the
+    number of objects.
+    """
+    window = collections.deque()
+    names = iter(names)
+    with futures.ThreadPoolExecutor(workers) as executor:
+        for name in names:
+            window.append((name, executor.submit(
+                get_object_contents, swiftclient, container, name, token)))
+            if len(window) >= workers * 2:
+                name, job = window.popleft()
+                yield name, job.result()
+        while window:
+            name, job = window.popleft()
+            yield name, job.result()
+
+
+def _head_container(swiftclient, container):
+    url = get_object_url(swiftclient, container)
+    resp = get_session().head(url,
+                              headers={'X-Auth-Token': swiftclient.token})
+    if resp.status_code == 404:
+        return None
+    if resp.status_code < 200 or resp.status_code >= 300:
+        raise swiftexceptions.ClientException(
+            'Container HEAD failed', http_path=url,
+            http_status=resp.status_code, http_reason=resp.reason)
+    return dict((k.lower(), v) for k, v in resp.headers.items())
+
+
+def head_containers(swiftclient, names,
+                    workers=constants.DEFAULT_SWIFT_WORKERS):
+    """Get the headers of many containers concurrently
+
+    Returns a dictionary mapping the container names to their headers.
+    Containers which no longer exist are left out.
+    """
+    with futures.ThreadPoolExecutor(workers) as executor:
+        jobs = [(name, executor.submit(_head_container, swiftclient, name))
+                for name in names]
+        headers = {}
+        for name, job in jobs:
+            result = job.result()
+            if result is not None:
+                headers[name] = result
+        return headers
+
+
+class PlanFileFetcher(object):
+    """Prefetch the files of a plan container and serve them from memory
+
+    The container listing is retrieved once and every object whose ETag
+    is not already known is downloaded through a bounded pool of workers
+    sharing a keep-alive HTTP session. Unchanged objects are reused from
+    previous prefetches of the same container. Every fetcher works on its
+    own copy of the files, the objects it adds are also recorded in the
+    store shared with the next prefetches.
+    """
+
+    def __init__(self, swiftclient, container, token,
+                 workers=constants.DEFAULT_SWIFT_WORKERS):
+        self.swift = swiftclient
+        self.container = container
+        self.token = token
+        self.workers = workers
+        self.prefix = '%s/%s/' % (swiftclient.url, container)
+        self.files = {}
+        self.virtual = {}
+        self._cache_key = get_object_url(swiftclient, container)
+
+    def _fetch(self, name):
+        return get_object_contents(self.swift, self.container, name,
+                                   self.token)
+
+    def prefetch(self):
+        """Load all the objects of the container into memory."""
+        objects = self.swift.get_container(self.container,
+                                           full_listing=True)[1]
+        with _plan_files_lock:
+            known = dict(_plan_files.get(self._cache_key, ({}, 0))[0])
+
+        files = {}
+        missing = {}
+        for obj in objects:
+            cached = known.get(obj['name'])
+            if cached is not None and cached[0] == obj.get('hash'):
+                files[obj['name']] = cached
+            else:
+                missing[obj['name']] = obj.get('hash')
+
+        if missing:
+            LOG.debug('Fetching %d of %d objects from container %s' % (
+                len(missing), len(objects), self.container))
+            with futures.ThreadPoolExecutor(self.workers) as executor:
+                jobs = dict((executor.submit(self._fetch, name), name)
+                            for name in missing)
+                for job in futures.as_completed(jobs):
+                    name = jobs[job]
+                    try:
+                        files[name] = (missing[name], job.result())
+                    except Exception as err:
+                        # Leave it to be requested on demand
+                        LOG.warning('Unable to prefetch %s: %s' % (
+                            name, err))
+
+        with _plan_files_lock:
+            _plan_files.set(self._cache_key, (dict(files), _files_size(files)),
+                            _files_size(files))
+        self.files = files
+        return files
+
+    def get(self, name):
+        """Return the contents of an object, None if it is not known."""
+        cached = self.files.get(name)
+        if cached is not None:
+            return cached[1]
+
+    def add(self, name, etag, contents):
+        """Record an object written to the container after the prefetch."""
+        self.files[name] = (etag, contents)
+        with _plan_files_lock:
+            entry = _plan_files.get(self._cache_key)
+            if entry is None:
+                return
+            files, size = entry
+            previous = files.get(name)
+            if previous is not None:
+                size -= len(previous[1])
+            files[name] = (etag, contents)
+            size += len(contents)
+            _plan_files.set(self._cache_key, (files, size), size)
+
+    def add_virtual(self, name, contents):
+        """Serve contents from the URL of the object name
+
+        The virtual object is neither written to the container nor shared
+        with other fetchers, and it takes precedence over an object of the
+        same name. Returns its URL.
+        """
+        self.virtual[name] = contents
+        return self.prefix + name
+
+    def object_request(self, method, url, token=None):
+        """Object request callback for heatclient's template_utils"""
+        if method == 'GET' and url.startswith(self.prefix):
+            name = url[len(self.prefix):]
+            contents = self.virtual.get(name)
+            if contents is None:
+                contents = self.get(name)
+            if contents is not None:
+                return contents
+        return get_session().request(
+            method, url,
+            headers={'X-Auth-Token': token or self.token}).content
+
+
+def _get_bulk_delete_limit(swiftclient):
+    """Maximum number of objects deleted per bulk delete request
+
+    Returns 0 when the bulk delete middleware is not enabled.
+    """
+    try:
+        capabilities = swiftclient.get_capabilities()
+    except swiftexceptions.ClientException as err:
+        LOG.debug('Unable to retrieve the Swift capabilities: %s' % err)
+        return 0
+    bulk_delete = capabilities.get('bulk_delete') or {}
+    return bulk_delete.get('max_deletes_per_request', 0)
+
+
+def _bulk_delete(swiftclient, container, names):
+    body = '\n'.join(urlparse.quote('/%s/%s' % (container, name))
+                     for name in names)
+    _, resp = swiftclient.post_account(
+        headers={'Accept': 'application/json',
+                 'Content-Type': 'text/plain'},
+        data=body.encode('utf-8'), query_string='bulk-delete')
+    if isinstance(resp, bytes):
+        resp = resp.decode('utf-8')
+    result = json.loads(resp)
+    # objects already gone are not reported as errors
+    if result.get('Errors'):
+        raise swiftexceptions.ClientException(
+            'Bulk delete failed: %s' % result['Errors'],
+            http_status=int(result['Response Status'].split()[0]))
+
+
+def _delete_object(swiftclient, container, name, token):
+    url = get_object_url(swiftclient, container, name)
+    resp = get_session().delete(url, headers={'X-Auth-Token': token})
+    if resp.status_code != 404 and (resp.status_code < 200 or
+                                    resp.status_code >= 300):
+        raise swiftexceptions.ClientException(
+            'Object DELETE failed', http_path=url,
+            http_status=resp.status_code, http_reason=resp.reason)
+
+
+def delete_objects(swiftclient, container, names,
+                   workers=constants.DEFAULT_SWIFT_WORKERS):
+    """Delete objects from a container
+
+    The objects are deleted in batches with the bulk delete middleware when
+    it is available, else with concurrent requests through the shared HTTP
+    session.
+    """
+    names = list(names)
+    if not names:
+        return
+    max_deletes = _get_bulk_delete_limit(swiftclient)
+    if max_deletes:
+        LOG.debug('Bulk deleting %d objects from container %s' % (
+            len(names), container))
+        for i in range(0, len(names), max_deletes):
+            _bulk_delete(swiftclient, container, names[i:i + max_deletes])
+        return
+
+    LOG.debug('Deleting %d objects from container %s' % (len(names),
+                                                         container))
+    with futures.ThreadPoolExecutor(workers) as executor:
+        jobs = [executor.submit(_delete_object, swiftclient, container,
+                                name, swiftclient.token)
+                for name in names]
+        for job in jobs:
+            job.result()
 
 
 def empty_container(swiftclient, name):
-    container_names = [container["name"] for container
-                       in swiftclient.get_account()[1]]
-
-    if name in container_names:
-        headers, objects = swiftclient.get_container(name)
-        # ensure container is a plan
-        if headers.get(constants.TRIPLEO_META_USAGE_KEY) != 'plan':
-            error_text = ("The {name} container does not contain a "
-                          "TripleO deployment plan and was not "
-                          "deleted.".format(name=name))
-            raise ValueError(error_text)
-        else:
-            # FIXME(rbrady): remove delete_object loop when
-            # LP#1615830 is fixed.  See LP#1615825 for more info.
-            # delete files from plan
-            for o in objects:
-                swiftclient.delete_object(name, o['name'])
-    else:
+    try:
+        headers = swiftclient.head_container(name)
+    except swiftexceptions.ClientException as err:
+        if err.http_status != 404:
+            raise
         error_text = "The {name} container does not exist.".format(name=name)
         raise ValueError(error_text)
 
+    # ensure container is a plan
+    if headers.get(constants.TRIPLEO_META_USAGE_KEY) != 'plan':
+        error_text = ("The {name} container does not contain a "
+                      "TripleO deployment plan and was not "
+                      "deleted.".format(name=name))
+        raise ValueError(error_text)
+
+    with _plan_files_lock:
+        _plan_files.pop(get_object_url(swiftclient, name))
+    objects = swiftclient.get_container(name, full_listing=True)[1]
+    delete_objects(swiftclient, name, [o['name'] for o in objects])
+
 
 def delete_container(swiftclient, name):
     empty_container(swiftclient, name)
@@ -12,19 +12,50 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import fnmatch
+import gzip
+import io
 import logging
+import os
+import tarfile
+import time
 
 from oslo_concurrency import processutils
 
+from tripleo_common import constants
+
 LOG = logging.getLogger(__name__)
 
+# Files and directories left out of the tarballs
+EXCLUDES = ('.git', '.tox', '*.pyc', '*.pyo')
+
+
+class _ChunkBuffer(object):
+    """Write only file object accumulating what is written to it"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
 
 def create_tarball(directory, filename, options='-czf'):
     """Create a tarball of a directory."""
     LOG.debug('Creating tarball of %s at location %s' % (directory, filename))
-    processutils.execute('/usr/bin/tar', '-C', directory, options, filename,
-                         '--exclude', '.git', '--exclude', '.tox',
-                         '--exclude', '*.pyc', '--exclude', '*.pyo', '.')
+    args = ['/usr/bin/tar', '-C', directory, options, filename]
+    for exclude in EXCLUDES:
+        args.extend(['--exclude', exclude])
+    processutils.execute(*(args + ['.']))
 
 
 def tarball_extract_to_swift_container(object_client, filename, container):
@@ -38,3 +69,89 @@ def tarball_extract_to_swift_container(object_client, filename, container):
             query_string='extract-archive=tar.gz',
             headers={'X-Detect-Content-Type': 'true'}
         )
+
+
+def stream_tarball(members,
+                   compresslevel=constants.DEFAULT_TARBALL_COMPRESSLEVEL):
+    """Create a gzip compressed tarball on the fly
+
+    members is an iterable of (name, contents) tuples. The compressed data is
+    yielded in chunks as members are added, so the tarball never has to be
+    held in memory or written to disk and can be passed straight to a chunked
+    upload.
+    """
+    buf = _ChunkBuffer()
+    gz = gzip.GzipFile(filename='', mode='wb', fileobj=buf,
+                       compresslevel=compresslevel)
+    tar = tarfile.open(fileobj=gz, mode='w|')
+    now = time.time()
+    for name, contents in members:
+        if not isinstance(contents, bytes):
+            contents = contents.encode('utf-8')
+        info = tarfile.TarInfo(name)
+        info.size = len(contents)
+        info.mtime = now
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(contents))
+        data = buf.drain()
+        if data:
+            yield data
+    tar.close()
+    gz.close()
+    yield buf.drain()
+
+
+def _is_excluded(path, excludes):
+    # Like tar, a pattern excludes a path when it matches any of its parts
+    return any(fnmatch.fnmatch(part, pattern)
+               for part in path.split(os.sep) for pattern in excludes)
+
+
+def list_directory(directory, excludes=EXCLUDES):
+    """Yield the relative paths of the files of a directory"""
+    for root, dirs, files in os.walk(directory):
+        rel_root = os.path.relpath(root, directory)
+        if rel_root == os.curdir:
+            rel_root = ''
+        dirs[:] = sorted(d for d in dirs if not _is_excluded(d, excludes))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            rel_path = os.path.join(rel_root, name)
+            # Only regular files are extracted by Swift
+            if (_is_excluded(rel_path, excludes) or os.path.islink(path) or
+                    not os.path.isfile(path)):
+                continue
+            yield rel_path
+
+
+def iter_directory(directory, names=None, excludes=EXCLUDES):
+    """Yield the relative path and contents of the files of a directory
+
+    Only the files with the given relative paths are read when names is
+    provided.
+    """
+    if names is None:
+        names = list_directory(directory, excludes)
+    for rel_path in names:
+        with open(os.path.join(directory, rel_path), 'rb') as f:
+            yield rel_path, f.read()
+
+
+def directory_extract_to_swift_container(
+        object_client, directory, container,
+        compresslevel=constants.DEFAULT_TARBALL_COMPRESSLEVEL, names=None):
+    """Upload the files of a directory with a single bulk extract request
+
+    The tarball is created in process and streamed to Swift while the files
+    are being read. When names is provided only those files are uploaded.
+    """
+    LOG.debug('Uploading directory %s to Swift container %s' % (directory,
+                                                                container))
+    object_client.put_object(
+        container=container,
+        obj='',
+        contents=stream_tarball(iter_directory(directory, names),
+                                compresslevel),
+        query_string='extract-archive=tar.gz',
+        headers={'X-Detect-Content-Type': 'true'}
+    )